@@ -3,6 +3,7 @@
 import time
 import math
 import smbus2 as smbus
+from powerhorse_trace import tracer
 
 # ============================================================================
 # Raspi PCA9685 16-Channel PWM Servo Driver
@@ -15,6 +16,7 @@ class PCA9685:
   __SUBADR2            = 0x03
   __SUBADR3            = 0x04
   __MODE1              = 0x00
+  __MODE1_AI           = 0x20
   __PRESCALE           = 0xFE
   __LED0_ON_L          = 0x06
   __LED0_ON_H          = 0x07
@@ -25,10 +27,12 @@ class PCA9685:
   __ALLLED_OFF_L       = 0xFC
   __ALLLED_OFF_H       = 0xFD
 
-  def __init__(self, address, debug=False):
-    self.bus = smbus.SMBus(1)
+  def __init__(self, address, debug=False, bus=1):
+    # bus is an I2C bus number, or an object with the smbus calls (see powerhorse_sim.SimBus)
+    self.bus = smbus.SMBus(bus) if isinstance(bus, int) else bus
     self.address = address
     self.debug = debug
+    self.autoIncrement = False
     if (self.debug):
       print("Reseting PCA9685")
     self.write(self.__MODE1, 0x00)
@@ -67,6 +71,7 @@ class PCA9685:
     time.sleep(0.005)
     self.write(self.__MODE1, oldmode | 0x80)
 
+  @tracer.traced("PCA9685.setPWM")
   def setPWM(self, channel, on, off):
     "Sets a single PWM channel"
     self.write(self.__LED0_ON_L + 4*channel, on & 0xFF)
@@ -76,6 +81,25 @@ class PCA9685:
     if (self.debug):
       print("channel: %d  LED_ON: %d LED_OFF: %d" % (channel,on,off))
 
+  @tracer.traced("PCA9685.setOff")
+  def setOff(self, channel, off):
+    "Sets only the OFF count of a channel whose ON count is already 0"
+    self.write(self.__LED0_OFF_L + 4*channel, off & 0xFF)
+    self.write(self.__LED0_OFF_H + 4*channel, 0xff & (off >> 8))
+    if (self.debug):
+      print("channel: %d  LED_OFF: %d" % (channel,off))
+
+  @tracer.traced("PCA9685.writeBlock")
+  def writeBlock(self, reg, values):
+    "Writes consecutive registers from reg in one I2C transaction (at most 32 bytes)"
+    if not self.autoIncrement:
+      # the register pointer only moves on between bytes with auto-increment on
+      self.write(self.__MODE1, (self.read(self.__MODE1) & 0x7F) | self.__MODE1_AI)
+      self.autoIncrement = True
+    self.bus.write_i2c_block_data(self.address, reg, values)
+    if (self.debug):
+      print("I2C: Write %d bytes from register 0x%02X" % (len(values), reg))
+
   def setDutycycle(self, channel, pulse):
     self.setPWM(channel, 0, int(pulse * int(4096 / 100)))
 
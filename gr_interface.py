@@ -1,15 +1,137 @@
+import threading
+import time
+import traceback
 import gradio as gr
+from powerhorse_robot import JOINTS, CONTROL_RATE
+from powerhorse_scheduler import SAFETY, MOTION, COSMETIC, ALL, covers
 
-def func(slider_1, slider_2):
-    return slider_1 * 5 + slider_2
+# Operator console for one robot. The controls drive the robot's scheduler
+# in-process, and the state panel is pushed an update whenever the state changes.
 
-with gr.Blocks() as demo:
-    slider = gr.Slider(minimum=-10.2, maximum=15, label="Random Slider (Static)", randomize=True)
-    slider_1 = gr.Slider(minimum=100, maximum=200, label="Random Slider (Input 1)", randomize=True)
-    slider_2 = gr.Slider(minimum=10, maximum=23.2, label="Random Slider (Input 2)", randomize=True)
-    slider_3 = gr.Slider(value=3, label="Non random slider")
-    btn = gr.Button("Run")
-    btn.click(func, inputs=[slider_1, slider_2, slider_3], outputs=gr.Number())
+class CommandThrottle:
+    ''' Forwards slider values to a scheduler at no more than `rate` batches a second.
+
+    While a slider is dragged only the latest value per actuator is kept, so a drag
+    produces at most one command per actuator per control-loop tick however many
+    change events the browser fires.
+
+    Arguments:
+    scheduler = the robot's ActuatorScheduler
+    rate = batches per second, defaults to the control-loop rate
+    '''
+    def __init__(self, scheduler, rate=CONTROL_RATE):
+        self.scheduler = scheduler
+        self.interval = 1 / rate
+        self.pending = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread = threading.Thread(target=self._run, name="console-throttle", daemon=True)
+        self._thread.start()
+
+    def send(self, actuator, priority, op, *args):
+        with self._lock:
+            self.pending[(actuator, op)] = (actuator, priority, op, args)
+            self._wakeup.notify()
+
+    def clear(self, actuator=ALL):
+        ''' Drops values not yet forwarded, so a stop isn't followed by a stale drag value. '''
+        with self._lock:
+            for key in [key for key in self.pending if covers(actuator, key[0])]:
+                del self.pending[key]
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self.pending:
+                    self._wakeup.wait()
+                # submitted under the lock so a stop can't slip in between taking and sending them
+                for actuator, priority, op, args in self.pending.values():
+                    try:
+                        self.scheduler.submit(actuator, priority, op, *args, source="console")
+                    except Exception:
+                        # a closed scheduler or a stopped hardware owner mustn't end the thread
+                        traceback.print_exc()
+                self.pending = {}
+            time.sleep(self.interval)
+
+
+def build_console(robot):
+    ''' Builds the operator console for a Robot from the registry. '''
+    powerhorse = robot.powerhorse
+    throttle = CommandThrottle(robot.scheduler)
+
+    def stop(actuator, op, *args):
+        throttle.clear(actuator)
+        robot.scheduler.submit(actuator, SAFETY, op, *args, source="console")
+
+    def watch_state():
+        # Yields the state each time it changes. The wait times out now and then and the
+        # unchanged state is sent again, so gradio finds out about an abandoned page when
+        # the send fails instead of it holding the worker forever
+        version = -1
+        while True:
+            if powerhorse.snapshot.version == version:
+                powerhorse.snapshot.wait(None, version, 10)
+            state = powerhorse.snapshot.as_dict()
+            version = state["version"]
+            yield state
+
+    with gr.Blocks(title="PowerHorse %s" % robot.id) as demo:
+        gr.Markdown("# PowerHorse `%s`" % robot.id)
+        with gr.Row():
+            with gr.Column():
+                gr.Markdown("## Tracks")
+                track_throttle = gr.Slider(-100, 100, value=0, step=1, label="Throttle")
+                track_differential = gr.Slider(-100, 100, value=0, step=1, label="Differential")
+                stop_tracks = gr.Button("Stop tracks")
+            with gr.Column():
+                gr.Markdown("## Arm")
+                joints = [gr.Slider(-100, 100, value=0, step=1, label=joint.capitalize()) for joint in JOINTS]
+                stop_arm = gr.Button("Stop arm")
+            with gr.Column():
+                gr.Markdown("## Camera and light")
+                camera = gr.Slider(-90, 90, value=0, step=1, label="Camera angle")
+                home_camera = gr.Button("Home camera")
+                light = gr.Checkbox(label="Light", value=powerhorse.light)
+                emergency_stop = gr.Button("EMERGENCY STOP", variant="stop")
+            with gr.Column():
+                gr.Markdown("## State")
+                state = gr.JSON()
+
+        # always_last keeps the browser from queueing up every intermediate drag position
+        events = dict(trigger_mode="always_last", show_progress="hidden")
+        track_throttle.change(lambda value: throttle.send("tracks", MOTION, "set_throttle", value), track_throttle, None, **events)
+        track_differential.change(lambda value: throttle.send("tracks", MOTION, "set_differential", value), track_differential, None, **events)
+        for joint, slider in zip(JOINTS, joints):
+            slider.change(lambda value, joint=joint: throttle.send("arm." + joint, MOTION, "set_arm", joint, value), slider, None, **events)
+        camera.change(lambda value: throttle.send("camera", COSMETIC, "set_camera", int(value)), camera, None, **events)
+        light.change(lambda value: robot.scheduler.submit("light", COSMETIC, "set_light", value, source="console"), light, None, **events)
+
+        def on_stop_tracks():
+            stop("tracks", "set_tracks", 0, 0)
+            return 0, 0
+
+        def on_stop_arm():
+            stop("arm", "stop_arms")
+            return [0] * len(JOINTS)
+
+        def on_home_camera():
+            throttle.clear("camera")
+            robot.scheduler.submit("camera", COSMETIC, "set_camera", 0, source="console")
+            return 0
+
+        def on_emergency_stop():
+            stop(ALL, "stop")
+            return [0, 0] + [0] * len(JOINTS) + [0, False]
+
+        stop_tracks.click(on_stop_tracks, None, [track_throttle, track_differential])
+        stop_arm.click(on_stop_arm, None, joints)
+        home_camera.click(on_home_camera, None, camera)
+        emergency_stop.click(on_emergency_stop, None, [track_throttle, track_differential, *joints, camera, light])
+
+        demo.load(watch_state, None, state, concurrency_limit=None)
+    return demo
 
 if __name__ == "__main__":
-    demo.launch()
\ No newline at end of file
+    from powerhorse_registry import RobotRegistry
+    build_console(RobotRegistry.from_env().default).launch(server_name="0.0.0.0")
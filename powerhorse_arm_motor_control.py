@@ -6,7 +6,9 @@
 # updateed to use gpiozero library instead of RPi.GPIO  
 
 from gpiozero import PWMOutputDevice, DigitalOutputDevice, InputDevice
+import time
 from time import sleep
+from powerhorse_trace import tracer
 
 class Motor:
     ''' Class to handle interaction with the motor pins
@@ -17,6 +19,8 @@ class Motor:
     motor = string motor pin label (i.e. "MOTOR1","MOTOR2","MOTOR3","MOTOR4") identifying the pins to which
             the motor is connected.
     config = int defining which pins control "forward" and "backward" movement.
+    pins = {"e": enable, "f": forward, "r": reverse} BCM pins to use instead of the shield's
+    arrow = Arrow to use instead of making one, so an arrow shared with another user isn't claimed twice
     '''
     motorpins = {"MOTOR4":{"config":{1:{"e":32,"f":24,"r":26},2:{"e":32,"f":26,"r":24}},"arrow":1},
                  "MOTOR3":{"config":{1:{"e":19,"f":21,"r":23},2:{"e":19,"f":23,"r":21}}, "arrow":2},
@@ -24,10 +28,10 @@ class Motor:
                  "MOTOR1":{"config":{1:{"e":11,"f":15,"r":13},2:{"e":11,"f":13,"r":15}},"arrow":4}}
                  
     
-    def __init__(self, motor, config):
+    def __init__(self, motor, config, pins=None, arrow=None):
         self.testMode = False
-        self.arrow = Arrow(self.motorpins[motor]["arrow"])
-        self.pins = self.motorpins[motor]["config"][config]
+        self.arrow = arrow if arrow is not None else Arrow(self.motorpins[motor]["arrow"])
+        self.pins = pins if pins is not None else self.motorpins[motor]["config"][config]
         self.PWM = PWMOutputDevice(self.pins['e'])
         self.forward_pin = DigitalOutputDevice(self.pins['f'])
         self.reverse_pin = DigitalOutputDevice(self.pins['r'])
@@ -45,6 +49,7 @@ class Motor:
         '''
         self.testMode = state
 
+    @tracer.traced("Motor.forward")
     def forward(self, speed):
         ''' Starts the motor turning in its configured "forward" direction.
 
@@ -60,6 +65,7 @@ class Motor:
             self.forward_pin.on()
             self.reverse_pin.off()
 
+    @tracer.traced("Motor.reverse")
     def reverse(self,speed):
         ''' Starts the motor turning in its configured "reverse" direction.
 
@@ -75,6 +81,7 @@ class Motor:
             self.forward_pin.off()
             self.reverse_pin.on()
 
+    @tracer.traced("Motor.stop")
     def stop(self):
         ''' Stops power to the motor,
      '''
@@ -139,56 +146,68 @@ class Sensor:
             i.e. "IR1", "IR2", "ULTRASONIC"
         boundary = an integer specifying the minimum distance at which the sensor
             will return a Triggered response of True. 
+        pins = {"echo": pin, "trigger": pin} BCM pins to use instead of the shield's
     '''
     Triggered = False
+    # Longest wait for an ultrasonic echo, about 6 metres there and back
+    ECHO_TIMEOUT = 0.04
+
     def iRCheck(self):
         input_state = self.echo.is_active
-        if input_state:
+        if input_state and not self.Triggered:
             print("Sensor 2: Object Detected")
-            self.Triggered = True
-        else:
-            self.Triggered = False
+        self.Triggered = input_state
 
     def sonicCheck(self):
-        print("SonicCheck has been triggered")
-        time.sleep(0.333)
-        self.trigger.on()
+        self.trigger_pin.on()
         time.sleep(0.00001)
-        self.trigger.off()
-        start = time.time()
+        self.trigger_pin.off()
+        start = stop = time.time()
+        deadline = start + self.ECHO_TIMEOUT
         while not self.echo.is_active:
             start = time.time()
+            if start > deadline:
+                # no echo, nothing in range
+                self.lastRead = float("inf")
+                self.Triggered = False
+                return
         while self.echo.is_active:
             stop = time.time()
+            if stop > deadline + self.ECHO_TIMEOUT:
+                break
         elapsed = stop-start
         measure = (elapsed * 34300)/2
         self.lastRead = measure
         if self.boundary > measure:
-            print("Boundary breached")
-            print(self.boundary)
-            print(measure)
+            if not self.Triggered:
+                print("Boundary breached")
+                print(self.boundary)
+                print(measure)
             self.Triggered = True
         else:
             self.Triggered = False
         
-    sensorpins = {"IR1":{"echo":7, "check":iRCheck}, "IR2":{"echo":12, "check":iRCheck},
-                  "ULTRASONIC":{"trigger":29, "echo": 31, "check":sonicCheck}}
+    # interval is the least time between readings, the ultrasonic sensor needs its echoes to die away
+    sensorpins = {"IR1":{"echo":7, "check":iRCheck, "interval":0}, "IR2":{"echo":12, "check":iRCheck, "interval":0},
+                  "ULTRASONIC":{"trigger":29, "echo": 31, "check":sonicCheck, "interval":0.06}}
 
     def trigger(self):
         ''' Executes the relevant routine that activates and takes a reading from the specified sensor.
     
         If the specified "boundary" has been breached the Sensor's Triggered attribute gets set to True.
+        Returns Triggered, the distance measured is left in lastRead.
     ''' 
         self.config["check"](self)
-        print("Trigger Called")
+        return self.Triggered
 
-    def __init__(self, sensortype, boundary):
-        self.config = self.sensorpins[sensortype]
+    def __init__(self, sensortype, boundary, pins=None):
+        self.sensortype = sensortype
+        self.config = dict(self.sensorpins[sensortype], **(pins or {}))
         self.boundary = boundary
+        self.interval = self.config["interval"]
         self.lastRead = 0
         if "trigger" in self.config:
-            print("trigger")
-            self.trigger = DigitalOutputDevice(self.config["trigger"])
+            self.trigger_pin = DigitalOutputDevice(self.config["trigger"])
         self.echo = InputDevice(self.config["echo"]) 
 
 class Arrow():
@@ -199,11 +218,12 @@ class Arrow():
             1 = Arrow closest to the Motorshield's power pins and running clockwise round the board
             ...
             4 = Arrow closest to the motor pins.
+        pin = BCM pin to use instead of the shield's
     '''
     arrowpins={1:13,2:19,3:26,4:16}
 
-    def __init__(self, which):
-        self.pin = DigitalOutputDevice(self.arrowpins[which])
+    def __init__(self, which, pin=None):
+        self.pin = DigitalOutputDevice(pin if pin is not None else self.arrowpins[which])
         self.pin.off()
 
     def on(self):
@@ -0,0 +1,255 @@
+#!/usr/bin/python
+
+# Camera streaming for the PowerHorse.
+# One producer thread pulls frames from a source, which hands each one over encoded to
+# JPEG once, as immutable bytes. Every viewer (MJPEG or WebSocket) is sent that same bytes
+# object, so adding viewers adds no encoding and no copies of the frame, and nothing a
+# viewer is still sending can be overwritten. A viewer that falls behind simply jumps to
+# the newest frame when it is ready for another one.
+
+import asyncio
+import io
+import threading
+import time
+
+try:
+    from PIL import Image, ImageDraw
+except ImportError:
+    Image = None
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+BOUNDARY = b"frame"
+
+
+class FrameSource:
+    ''' Where frames come from. read() blocks until the next frame and returns it as JPEG bytes. '''
+    def open(self):
+        pass
+
+    def read(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class V4L2Source(FrameSource):
+    ''' Frames from a V4L2 camera such as /dev/video0, needs OpenCV.
+
+    Arguments:
+    device = path of the video device
+    width, height, fps = capture settings asked of the camera
+    quality = JPEG quality 0-100
+    '''
+    def __init__(self, device, width=640, height=480, fps=15, quality=80):
+        self.device = device
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.params = [cv2.IMWRITE_JPEG_QUALITY, quality] if cv2 else []
+        self.capture = None
+
+    def open(self):
+        if cv2 is None:
+            raise RuntimeError("OpenCV (cv2) is needed to read from %s" % self.device)
+        self.capture = cv2.VideoCapture(self.device, cv2.CAP_V4L2)
+        if not self.capture.isOpened():
+            raise RuntimeError("Could not open camera %s" % self.device)
+        self.capture.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*"MJPG"))
+        self.capture.set(cv2.CAP_PROP_FRAME_WIDTH, self.width)
+        self.capture.set(cv2.CAP_PROP_FRAME_HEIGHT, self.height)
+        self.capture.set(cv2.CAP_PROP_FPS, self.fps)
+
+    def read(self):
+        ok, frame = self.capture.read()
+        if not ok:
+            raise RuntimeError("Camera %s stopped delivering frames" % self.device)
+        ok, jpeg = cv2.imencode(".jpg", frame, self.params)
+        return jpeg.tobytes()
+
+    def close(self):
+        if self.capture is not None:
+            self.capture.release()
+            self.capture = None
+
+
+class TestPatternSource(FrameSource):
+    ''' A synthetic moving test pattern, for testing without a camera. Needs Pillow.
+    The loop of frames is encoded once when the source is opened and then replayed at `fps`.
+    '''
+    def __init__(self, width=640, height=480, fps=15, quality=80):
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.quality = quality
+        self.frames = []
+        self.index = 0
+        self.next_time = 0
+
+    def open(self):
+        if Image is None:
+            raise RuntimeError("Pillow is needed for the test pattern")
+        colours = [(255, 255, 255), (255, 255, 0), (0, 255, 255), (0, 255, 0),
+                   (255, 0, 255), (255, 0, 0), (0, 0, 255), (0, 0, 0)]
+        bar = self.width // len(colours)
+        self.frames = []
+        for n in range(self.fps):
+            image = Image.new("RGB", (self.width, self.height))
+            draw = ImageDraw.Draw(image)
+            for i, colour in enumerate(colours):
+                draw.rectangle([i * bar, 0, (i + 1) * bar, self.height], fill=colour)
+            # a marker sweeping across so frame changes are visible
+            x = n * self.width // self.fps
+            draw.rectangle([x, self.height // 2 - 10, x + 20, self.height // 2 + 10], fill=(128, 128, 128))
+            buffer = io.BytesIO()
+            image.save(buffer, "JPEG", quality=self.quality)
+            self.frames.append(buffer.getvalue())
+        self.next_time = time.monotonic()
+
+    def read(self):
+        self.next_time += 1 / self.fps
+        delay = self.next_time - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            self.next_time = time.monotonic()
+        frame = self.frames[self.index]
+        self.index = (self.index + 1) % len(self.frames)
+        return frame
+
+
+def make_source(config):
+    ''' Builds the source named by a camera config, "test" or a V4L2 device path. '''
+    settings = dict(width=config["width"], height=config["height"], fps=config["fps"], quality=config["quality"])
+    if config["source"] == "test":
+        return TestPatternSource(**settings)
+    return V4L2Source(config["source"], **settings)
+
+
+class Frame:
+    __slots__ = ("seq", "header", "data")
+
+    def __init__(self, seq, data):
+        self.seq = seq
+        self.header = b"--%s\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n" % (BOUNDARY, len(data))
+        self.data = data
+
+
+class CameraStream:
+    ''' Shares one camera between any number of viewers.
+
+    The producer thread only runs while somebody is watching.
+
+    Arguments:
+    source = the FrameSource to read from
+    linger = seconds the camera is kept running after the last viewer leaves
+    '''
+    def __init__(self, source, linger=2.0):
+        self.source = source
+        self.linger = linger
+        self.latest = None
+        self.seq = 0
+        self.viewers = 0
+        self.frames = 0
+        self.error = None
+        self._lock = threading.Lock()
+        self._waiters = []
+        self._thread = None
+
+    def _publish(self, data):
+        with self._lock:
+            self.seq += 1
+            self.frames += 1
+            self.latest = Frame(self.seq, data)
+            waiters, self._waiters = self._waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_wake, future)
+
+    def _run(self):
+        idle_since = None
+        try:
+            self.source.open()
+            while True:
+                with self._lock:
+                    if self.viewers == 0:
+                        idle_since = idle_since or time.monotonic()
+                        if time.monotonic() - idle_since > self.linger:
+                            # closed under the lock so a new viewer can't reopen it half way
+                            self.source.close()
+                            self.latest = None
+                            self._thread = None
+                            return
+                    else:
+                        idle_since = None
+                self._publish(self.source.read())
+        except Exception as e:
+            self.source.close()
+            with self._lock:
+                self.error = str(e)
+                self.latest = None
+                self._thread = None
+                waiters, self._waiters = self._waiters, []
+            for loop, future in waiters:
+                loop.call_soon_threadsafe(_wake, future)
+
+    def _join(self):
+        with self._lock:
+            self.viewers += 1
+            self.error = None
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="camera-stream", daemon=True)
+                self._thread.start()
+
+    def _leave(self):
+        with self._lock:
+            self.viewers -= 1
+
+    async def _next(self, seq):
+        # Returns the newest Frame with a sequence number above `seq`
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                if self.error:
+                    raise RuntimeError(self.error)
+                frame = self.latest
+                if frame is not None and frame.seq > seq:
+                    return frame
+                future = loop.create_future()
+                self._waiters.append((loop, future))
+            await future
+
+    async def frames_of(self):
+        ''' Async generator of (header, frame) for one viewer, the frame is the bytes every viewer shares. '''
+        self._join()
+        seq = 0
+        try:
+            while True:
+                frame = await self._next(seq)
+                seq = frame.seq
+                yield frame.header, frame.data
+        finally:
+            self._leave()
+
+    async def mjpeg(self):
+        ''' Body of a multipart/x-mixed-replace response. '''
+        async for header, frame in self.frames_of():
+            yield header
+            yield frame
+            yield b"\r\n"
+
+    def stats(self):
+        return {
+            "running": self._thread is not None,
+            "viewers": self.viewers,
+            "frames": self.frames,
+            "error": self.error,
+        }
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
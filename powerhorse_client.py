@@ -0,0 +1,352 @@
+#!/usr/bin/python
+
+# Python client for the PowerHorse control API, blocking and asyncio flavours.
+# Each client keeps a pool of keep-alive connections to its robot, so scripts don't pay
+# for a new connection per command. What the API offers is read from its OpenAPI schema
+# once: batches go out as a single POST .../batch when the API has it (one request per
+# command otherwise) and watch() long-polls with ?since= when it can instead of polling.
+# Fleet sends the same command to many robots at once and times each one.
+# A client made with a ttl leases the tracks and arm joints it moves (see powerhorse_lease.py)
+# and calls heartbeat() to keep them moving.
+#
+# Broadcasting an emergency stop from a terminal:
+#   python powerhorse_client.py --robot alpha=http://alpha.local:8000 --robot beta=http://beta.local:8000 stop
+#   python powerhorse_client.py --robot alpha=http://alpha.local:8000 --robot gamma=http://yard.local:8000/robots/gamma stop
+#
+# Against an app in the same process (e.g. for testing), pass
+# transport=httpx.ASGITransport(app=app) to the asyncio client.
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+import httpx
+
+# Longest the API holds a ?since= long-poll open, see powerhorse_control_api.LONG_POLL_TIMEOUT
+LONG_POLL_TIMEOUT = 30
+
+# The route of each command when sent on its own, relative to the robot
+ROUTES = {
+    "set_tracks": lambda throttle, differential: "tracks/%g/%g" % (throttle, differential),
+    "set_throttle": lambda throttle: "tracks/throttle/%g" % throttle,
+    "set_differential": lambda differential: "tracks/differential/%g" % differential,
+    "set_arm": lambda joint, power: "arm/%s/%g" % (joint, power),
+    "stop_arms": lambda: "arm/stop",
+    "set_light": lambda on: "light/on" if on else "light/off",
+    "toggle_light": lambda: "light/toggle",
+    "set_light_brightness": lambda level: "light/brightness/%g" % level,
+    "set_light_pattern": lambda pattern: "light/pattern/%s" % pattern,
+    "set_camera": lambda angle: "camera/rotate/%d" % angle,
+    "set_camera_tilt": lambda angle: "camera/tilt/%d" % angle,
+    "stop": lambda: "stop",
+}
+
+# The commands a client's ttl leases
+LEASED = ("set_tracks", "set_throttle", "set_differential", "set_arm")
+
+
+class PowerHorseError(Exception):
+    ''' The API answered with an error status. '''
+    def __init__(self, status, detail):
+        super().__init__("%d: %s" % (status, detail))
+        self.status = status
+        self.detail = detail
+
+
+class _Client:
+    # What the blocking and asyncio clients share, everything but the I/O
+    def __init__(self, base_url, robot, client_id, timeout, connections, ttl):
+        self.base_url = base_url
+        self.robot = robot
+        self.ttl = ttl
+        self.prefix = "/powerhorse" if robot is None else "/robots/%s" % robot
+        self.timeout = timeout
+        self._features = None
+        headers = {"X-Client-Id": client_id} if client_id else {}
+        limits = httpx.Limits(max_connections=connections, max_keepalive_connections=connections)
+        self._http_args = {"base_url": base_url, "headers": headers, "timeout": timeout, "limits": limits}
+
+    def _path(self, path):
+        return "%s/%s" % (self.prefix, path)
+
+    def _parse_features(self, schema):
+        paths = schema.get("paths", {})
+        template = "/powerhorse" if self.robot is None else "/robots/{robot_id}"
+        tracks = paths.get(template + "/tracks", {}).get("get", {})
+        return {
+            "batch": template + "/batch" in paths,
+            "long_poll": any(parameter.get("name") == "since" for parameter in tracks.get("parameters", [])),
+        }
+
+    def _check(self, response):
+        if response.status_code >= 400:
+            try:
+                detail = response.json().get("detail", response.text)
+            except ValueError:
+                detail = response.text
+            raise PowerHorseError(response.status_code, detail)
+        return response
+
+    def _params(self, op):
+        return {"ttl": self.ttl} if self.ttl and op in LEASED else None
+
+    def _batch_body(self, commands):
+        return [dict({"op": op, "args": list(args)}, **(self._params(op) or {})) for op, *args in commands]
+
+
+class PowerHorseClient(_Client):
+    ''' Blocking client for one robot.
+
+    Arguments:
+    base_url = where the API is, e.g. "http://powerhorse.local:8000"
+    robot = the robot id on an API serving several, None for the default robot
+    client_id = sent as X-Client-Id, the API rate limits per client
+    timeout = seconds to wait for an answer
+    connections = size of the keep-alive connection pool
+    transport = an httpx transport to use instead of the network
+    ttl = seconds the tracks and arm joints are leased for when moved, None for no lease
+    '''
+    def __init__(self, base_url="http://127.0.0.1:8000", robot=None, client_id=None, timeout=5.0,
+                 connections=4, transport=None, ttl=None):
+        super().__init__(base_url, robot, client_id, timeout, connections, ttl)
+        self.http = httpx.Client(transport=transport, **self._http_args)
+
+    def features(self):
+        ''' {"batch": ..., "long_poll": ...}, what the API supports, read once from its schema. '''
+        if self._features is None:
+            try:
+                self._features = self._parse_features(self._check(self.http.get("/openapi.json")).json())
+            except (httpx.HTTPError, PowerHorseError, ValueError):
+                self._features = {"batch": False, "long_poll": False}
+        return self._features
+
+    def command(self, op, *args):
+        ''' Sends one command, `op` is the PowerHorse method, e.g. command("set_tracks", 50, 0). '''
+        return self._check(self.http.put(self._path(ROUTES[op](*args)), params=self._params(op))).json()
+
+    def batch(self, commands):
+        ''' Sends [(op, *args), ...] together, returns a result per command in order:
+        {"ok": True, "result": ...} or {"ok": False, "status": 409, "detail": ...}.
+        With the batch endpoint a bad command (unknown joint, wrong arguments) raises
+        PowerHorseError and none of the batch is sent.
+        '''
+        if self.features()["batch"]:
+            return self._check(self.http.post(self._path("batch"), json=self._batch_body(commands))).json()["results"]
+        results = []
+        for op, *args in commands:
+            try:
+                results.append({"ok": True, "result": self.command(op, *args)})
+            except PowerHorseError as exc:
+                results.append({"ok": False, "status": exc.status, "detail": exc.detail})
+        return results
+
+    def state(self, section):
+        ''' The state of "tracks", "arm", "light" or "camera". '''
+        return self._check(self.http.get(self._path(section))).json()
+
+    def watch(self, section, interval=0.5):
+        ''' Yields the state of a section now and every time it changes. '''
+        long_poll = self.features()["long_poll"]
+        version = etag = None
+        while True:
+            if long_poll and version is not None:
+                response = self.http.get(self._path(section), params={"since": version},
+                                         timeout=LONG_POLL_TIMEOUT + self.timeout)
+            else:
+                response = self.http.get(self._path(section), headers={"If-None-Match": etag} if etag else {})
+            if response.status_code != 304:
+                self._check(response)
+                if response.headers.get("X-State-Version") != version:
+                    version = response.headers.get("X-State-Version")
+                    etag = response.headers.get("ETag")
+                    yield response.json()
+                    continue
+            if not long_poll:
+                time.sleep(interval)
+
+    def tracks(self, throttle, differential=0):
+        return self.command("set_tracks", throttle, differential)
+
+    def arm(self, joint, power):
+        return self.command("set_arm", joint, power)
+
+    def stop(self):
+        return self.command("stop")
+
+    def heartbeat(self):
+        ''' Renews this client's leases, returns how many it still holds (0 once they have run out). '''
+        return self._check(self.http.put(self._path("lease"))).json()["renewed"]
+
+    def close(self):
+        self.http.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class AsyncPowerHorseClient(_Client):
+    ''' asyncio client for one robot, takes the same arguments as PowerHorseClient. '''
+    def __init__(self, base_url="http://127.0.0.1:8000", robot=None, client_id=None, timeout=5.0,
+                 connections=4, transport=None, ttl=None):
+        super().__init__(base_url, robot, client_id, timeout, connections, ttl)
+        self.http = httpx.AsyncClient(transport=transport, **self._http_args)
+
+    async def features(self):
+        if self._features is None:
+            try:
+                self._features = self._parse_features(self._check(await self.http.get("/openapi.json")).json())
+            except (httpx.HTTPError, PowerHorseError, ValueError):
+                self._features = {"batch": False, "long_poll": False}
+        return self._features
+
+    async def command(self, op, *args):
+        return self._check(await self.http.put(self._path(ROUTES[op](*args)), params=self._params(op))).json()
+
+    async def batch(self, commands):
+        ''' As PowerHorseClient.batch; without the batch endpoint the commands are sent
+        concurrently over the connection pool rather than one after another.
+        '''
+        if (await self.features())["batch"]:
+            response = await self.http.post(self._path("batch"), json=self._batch_body(commands))
+            return self._check(response).json()["results"]
+
+        async def one(op, *args):
+            try:
+                return {"ok": True, "result": await self.command(op, *args)}
+            except PowerHorseError as exc:
+                return {"ok": False, "status": exc.status, "detail": exc.detail}
+        return list(await asyncio.gather(*[one(*command) for command in commands]))
+
+    async def state(self, section):
+        return self._check(await self.http.get(self._path(section))).json()
+
+    async def watch(self, section, interval=0.5):
+        long_poll = (await self.features())["long_poll"]
+        version = etag = None
+        while True:
+            if long_poll and version is not None:
+                response = await self.http.get(self._path(section), params={"since": version},
+                                               timeout=LONG_POLL_TIMEOUT + self.timeout)
+            else:
+                response = await self.http.get(self._path(section), headers={"If-None-Match": etag} if etag else {})
+            if response.status_code != 304:
+                self._check(response)
+                if response.headers.get("X-State-Version") != version:
+                    version = response.headers.get("X-State-Version")
+                    etag = response.headers.get("ETag")
+                    yield response.json()
+                    continue
+            if not long_poll:
+                await asyncio.sleep(interval)
+
+    async def tracks(self, throttle, differential=0):
+        return await self.command("set_tracks", throttle, differential)
+
+    async def arm(self, joint, power):
+        return await self.command("set_arm", joint, power)
+
+    async def stop(self):
+        return await self.command("stop")
+
+    async def heartbeat(self):
+        return self._check(await self.http.put(self._path("lease"))).json()["renewed"]
+
+    async def close(self):
+        await self.http.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+class Fleet:
+    ''' Several robots, each with its own client and connection pool.
+
+    Arguments:
+    clients = {name: AsyncPowerHorseClient}
+    '''
+    def __init__(self, clients):
+        self.clients = dict(clients)
+
+    @classmethod
+    def from_urls(cls, urls, **kwargs):
+        ''' One robot per API, urls = {name: base_url}. '''
+        return cls({name: AsyncPowerHorseClient(url, **kwargs) for name, url in urls.items()})
+
+    @classmethod
+    def from_api(cls, base_url, robot_ids, **kwargs):
+        ''' Several robots served by one API. '''
+        return cls({robot_id: AsyncPowerHorseClient(base_url, robot=robot_id, **kwargs) for robot_id in robot_ids})
+
+    async def broadcast(self, op, *args):
+        ''' Sends a command to every robot at once. Returns per robot name
+        {"ok": ..., "latency_ms": ..., "result": ...} or with "error" instead of "result".
+        '''
+        async def one(name, client):
+            start = time.perf_counter()
+            try:
+                result = await client.command(op, *args)
+                outcome = {"ok": True, "result": result}
+            except PowerHorseError as exc:
+                outcome = {"ok": False, "status": exc.status, "error": exc.detail}
+            except httpx.HTTPError as exc:
+                outcome = {"ok": False, "error": "%s: %s" % (type(exc).__name__, exc)}
+            outcome["latency_ms"] = (time.perf_counter() - start) * 1000
+            return name, outcome
+        return dict(await asyncio.gather(*[one(name, client) for name, client in self.clients.items()]))
+
+    async def stop(self):
+        ''' Emergency stop of every robot. '''
+        return await self.broadcast("stop")
+
+    async def close(self):
+        await asyncio.gather(*[client.close() for client in self.clients.values()])
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Send a command to one or more PowerHorse robots at once")
+    parser.add_argument("--robot", action="append", required=True, metavar="NAME=URL",
+                        help="a robot's API, may be repeated; NAME=URL/robots/ID for a robot on a multi-robot API")
+    parser.add_argument("--client-id", help="sent as X-Client-Id")
+    parser.add_argument("op", help="a command, e.g. stop, set_tracks, set_arm")
+    parser.add_argument("args", nargs="*", help="its arguments, numbers where they look like numbers")
+    args = parser.parse_args(argv)
+    if args.op not in ROUTES:
+        parser.error("unknown command %s, choose from %s" % (args.op, ", ".join(ROUTES)))
+
+    def value(arg):
+        try:
+            return float(arg)
+        except ValueError:
+            return {"true": True, "false": False}.get(arg.lower(), arg)
+
+    async def run():
+        clients = {}
+        for robot in args.robot:
+            name, _, url = robot.partition("=")
+            base_url, _, robot_id = url.rstrip("/").partition("/robots/")
+            clients[name] = AsyncPowerHorseClient(base_url or url, robot=robot_id or None, client_id=args.client_id)
+        async with Fleet(clients) as fleet:
+            return await fleet.broadcast(args.op, *[value(arg) for arg in args.args])
+
+    results = asyncio.run(run())
+    for name, outcome in results.items():
+        print("%-12s %-5s %7.1f ms  %s" % (name, "ok" if outcome["ok"] else "FAIL", outcome["latency_ms"],
+                                        json.dumps(outcome.get("result", outcome.get("error")))))
+    return 0 if all(outcome["ok"] for outcome in results.values()) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,227 @@
+#!/usr/bin/python
+
+# The hardware layout of a robot: which GPIO pin and PCA9685 channel everything is wired to.
+# The layout is part of the robot config (the "motor_shield", "track_channels", "arm",
+# "sensors", "camera_servos" and "lights" sections, see DEFAULT_CONFIG), is checked in full
+# when the robot is loaded, before any pin is touched, and is compiled into flat tables:
+# a JointSlot per arm joint holding its pins and, once the devices exist, the devices
+# themselves, so driving a joint is attribute access on one object found by its index.
+#
+# GPIO pins are BCM numbers or header pins written "BOARD11"; they are all turned into BCM
+# numbers, so two names for the same pin are caught as a conflict.
+#
+# Checking a robots file:
+#   python powerhorse_config.py robots.json
+
+import argparse
+import json
+import re
+import sys
+
+# Header pin -> BCM number, for the GPIO pins of the 40-pin header
+BOARD_TO_BCM = {3: 2, 5: 3, 7: 4, 8: 14, 10: 15, 11: 17, 12: 18, 13: 27, 15: 22, 16: 23, 18: 24, 19: 10,
+                21: 9, 22: 25, 23: 11, 24: 8, 26: 7, 27: 0, 28: 1, 29: 5, 31: 6, 32: 12, 33: 13, 35: 19,
+                36: 16, 37: 26, 38: 20, 40: 21}
+
+# The order of the arm joints, their index in every joint table
+JOINTS = ("shoulder", "elbow", "wrist", "gripper")
+
+# The order of the track channels in Layout.track_channels and MotorDriver
+TRACK_ROLES = (("left", "pwm"), ("left", "in1"), ("left", "in2"), ("right", "pwm"), ("right", "in1"), ("right", "in2"))
+
+SENSOR_TYPES = ("IR1", "IR2", "ULTRASONIC")
+
+
+class ConfigError(ValueError):
+    ''' Raised with every problem found in a robot's layout, one per line. '''
+
+
+def bcm(pin):
+    ''' The BCM number of a pin given as a BCM number, "GPIOnn" or "BOARDnn". Raises ValueError. '''
+    match = re.fullmatch(r"(BOARD|GPIO|BCM)?(\d+)", pin.upper()) if isinstance(pin, str) else None
+    if match is not None:
+        if match.group(1) != "BOARD":
+            return bcm(int(match.group(2)))
+        number = int(match.group(2))
+        if number not in BOARD_TO_BCM:
+            raise ValueError("header pin %d is not a GPIO pin" % number)
+        return BOARD_TO_BCM[number]
+    if isinstance(pin, int) and not isinstance(pin, bool):
+        if not 0 <= pin <= 27:
+            raise ValueError("GPIO%d does not exist, BCM pins are 0 to 27 (header pins are written \"BOARDnn\")" % pin)
+        return pin
+    raise ValueError("%r is not a pin, write a BCM number or \"BOARDnn\"" % (pin,))
+
+
+class JointSlot:
+    ''' One arm joint, compiled from the config. `motor` and `arrow` are filled in with the
+    devices by PowerHorse, everything else is known from the config alone.
+    '''
+    __slots__ = ("index", "name", "motor_label", "pins", "arrow_id", "motor", "arrow")
+
+    def __init__(self, index, name, motor_label, pins, arrow_id):
+        self.index = index
+        self.name = name
+        self.motor_label = motor_label
+        # {"e": enable, "f": forward, "r": reverse} as BCM numbers, forward and reverse already
+        # swapped round for a motor wired the other way (config 2)
+        self.pins = pins
+        self.arrow_id = arrow_id
+        self.motor = None
+        self.arrow = None
+
+
+class Layout:
+    ''' A robot's checked and compiled hardware layout.
+
+    joints = the JointSlots in JOINTS order, joint_index maps a name to its index
+    motor_arrows = shield arrow of each shield motor in use
+    arrows = {arrow id: BCM pin} of every arrow in use
+    sensors = {sensor name: (type, {"echo": pin, "trigger": pin})}
+    track_channels = PCA9685 channels in TRACK_ROLES order
+    pins = {BCM pin: what uses it}, channels = {PCA9685 channel: what uses it}
+    '''
+    def __init__(self):
+        self.joints = ()
+        self.joint_index = {}
+        self.motor_arrows = {}
+        self.arrows = {}
+        self.sensors = {}
+        self.track_channels = ()
+        self.pins = {}
+        self.channels = {}
+
+    def as_dict(self):
+        return {
+            "joints": [{"index": slot.index, "joint": slot.name, "motor": slot.motor_label, "pins": slot.pins,
+                        "arrow": slot.arrow_id} for slot in self.joints],
+            "arrows": self.arrows,
+            "sensors": {name: {"type": kind, "pins": pins} for name, (kind, pins) in self.sensors.items()},
+            "track_channels": dict(zip(["%s.%s" % role for role in TRACK_ROLES], self.track_channels)),
+            "pins": self.pins,
+            "channels": self.channels,
+        }
+
+
+def compile_layout(config):
+    ''' Checks the hardware layout of a merged robot config and compiles it into a Layout.
+    Raises ConfigError listing every problem found.
+    '''
+    problems = []
+    layout = Layout()
+    shield = config["motor_shield"]
+
+    def claim_pin(pin, user):
+        try:
+            pin = bcm(pin)
+        except ValueError as exc:
+            problems.append("%s: %s" % (user, exc))
+            return None
+        if pin in layout.pins:
+            problems.append("%s and %s are both on GPIO%d" % (layout.pins[pin], user, pin))
+        else:
+            layout.pins[pin] = user
+        return pin
+
+    def claim_channel(channel, user):
+        if isinstance(channel, bool) or not isinstance(channel, int) or not 0 <= channel <= 15:
+            problems.append("%s: PCA9685 channel %r does not exist, channels are 0 to 15" % (user, channel))
+        elif channel in layout.channels:
+            problems.append("%s and %s are both on PCA9685 channel %d" % (layout.channels[channel], user, channel))
+        else:
+            layout.channels[channel] = user
+
+    def claim_arrow(arrow_id, user):
+        arrow_id = str(arrow_id)
+        if arrow_id not in shield["arrows"]:
+            problems.append("%s: there is no arrow %s, the arrows are %s" % (user, arrow_id, ", ".join(shield["arrows"])))
+        elif arrow_id not in layout.arrows:
+            # arrows are shared, a motor and a joint may light the same one
+            layout.arrows[arrow_id] = claim_pin(shield["arrows"][arrow_id], "arrow %s" % arrow_id)
+        return arrow_id
+
+    # the arm joints and the shield motors driving them
+    slots = []
+    motors_used = {}
+    for index, joint in enumerate(JOINTS):
+        arm = config["arm"].get(joint)
+        if arm is None:
+            problems.append("arm: joint %s is missing" % joint)
+            continue
+        label = arm.get("motor")
+        motor = shield["motors"].get(label)
+        if motor is None:
+            problems.append("arm.%s: there is no motor %r, the motors are %s" % (joint, label, ", ".join(shield["motors"])))
+            continue
+        if label in motors_used:
+            problems.append("arm.%s: %s already drives %s" % (joint, label, motors_used[label]))
+            continue
+        motors_used[label] = joint
+        if arm.get("config") not in (1, 2):
+            problems.append("arm.%s: config must be 1, or 2 for a motor wired the other way round" % joint)
+            continue
+        pins = {}
+        for role, key in (("e", "enable"), ("f", "forward"), ("r", "reverse")):
+            pins[role] = claim_pin(motor[key], "%s %s (arm.%s)" % (label, key, joint))
+        if arm["config"] == 2:
+            pins["f"], pins["r"] = pins["r"], pins["f"]
+        if "arrow" in motor:
+            layout.motor_arrows[label] = claim_arrow(motor["arrow"], label)
+        slots.append(JointSlot(index, joint, label, pins, claim_arrow(arm.get("arrow"), "arm.%s" % joint)))
+    layout.joints = tuple(slots)
+    layout.joint_index = {slot.name: slot.index for slot in slots}
+
+    # the sensors on the shield's sensor header
+    for name, sensor in config["sensors"].items():
+        kind = sensor.get("type")
+        if kind not in SENSOR_TYPES or kind not in shield["sensors"]:
+            problems.append("sensors.%s: type must be one of %s" % (name, ", ".join(SENSOR_TYPES)))
+            continue
+        if not isinstance(sensor.get("boundary"), (int, float)):
+            problems.append("sensors.%s: boundary must be a number" % name)
+        pins = {role: claim_pin(pin, "%s %s (sensors.%s)" % (kind, role, name))
+                for role, pin in shield["sensors"][kind].items()}
+        layout.sensors[name] = (kind, pins)
+
+    # the PCA9685 channels: track motor driver, camera servos and lights
+    tracks = config["track_channels"]
+    channels = []
+    for side, role in TRACK_ROLES:
+        channel = tracks.get(side, {}).get(role)
+        claim_channel(channel, "tracks %s %s" % (side, role))
+        channels.append(channel)
+    layout.track_channels = tuple(channels)
+    for axis, servo in config["camera_servos"].items():
+        if servo:
+            claim_channel(servo.get("channel"), "camera %s servo" % axis)
+    for channel in config["lights"]["channels"]:
+        claim_channel(channel, "light")
+
+    if problems:
+        raise ConfigError("The robot's hardware layout has problems:\n" + "\n".join(problems))
+    return layout
+
+
+def main(argv=None):
+    from powerhorse_registry import merge_config
+    parser = argparse.ArgumentParser(description="Check the hardware layout of the robots in a robots file")
+    parser.add_argument("path", help='a robots file, {"robots": {"alpha": {...}}}')
+    parser.add_argument("--show", action="store_true", help="print each robot's compiled layout")
+    args = parser.parse_args(argv)
+    with open(args.path) as f:
+        robots = json.load(f)["robots"]
+    failed = False
+    for robot_id, config in robots.items():
+        try:
+            layout = compile_layout(merge_config(config))
+        except ConfigError as exc:
+            failed = True
+            print("%s: %s" % (robot_id, exc))
+            continue
+        print("%s: ok, %d GPIO pins and %d PCA9685 channels in use" % (robot_id, len(layout.pins), len(layout.channels)))
+        if args.show:
+            print(json.dumps(layout.as_dict(), indent=2))
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,257 +1,510 @@
-from fastapi import FastAPI
-from powerhorse_arm_motor_control import Motor, LinkedMotors, Arrow
-from powerhorse_track_motor_control import MotorControl
-from PCA9685 import PCA9685
+import asyncio
+import contextlib
+import inspect
+from typing import List, Optional
+from pydantic import BaseModel
+from fastapi import APIRouter, Depends, FastAPI, HTTPException, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from powerhorse_robot import PowerHorse, MotorDriver, JOINTS
+from powerhorse_lights import PATTERNS
+from powerhorse_registry import Robot, RobotRegistry
+from powerhorse_scheduler import SAFETY, MOTION, COSMETIC, ALL, COMMANDS, CommandCancelled, command_actuator
+from powerhorse_camera_stream import BOUNDARY
+from powerhorse_udp import start_udp
+from powerhorse_shm import OwnerUnavailable
+from powerhorse_ratelimit import ClientMiddleware, Coalesced, RateLimited, current_client, limited_stream
+from powerhorse_trace import tracer
+from powerhorse_profile import sampler, requests as request_profiler, loop_lag
+from powerhorse_trajectory import TrackPlan
 import time
 
-Dir = [
-    'forward',
-    'backward',
-]
-
-pwm = PCA9685(0x40, debug=False)
-pwm.setPWMFreq(50)
-
-class MotorDriver():
-    def __init__(self):
-        self.PWMA = 0
-        self.AIN1 = 1
-        self.AIN2 = 2
-        self.PWMB = 5
-        self.BIN1 = 3
-        self.BIN2 = 4
-
-    def MotorRun(self, motor, index, speed):
-        if speed > 100:
+registry = RobotRegistry.from_env()
+# The default robot, also served under /powerhorse
+powerhorse = registry.default.powerhorse
+
+# Longest a ?since= long-poll is held open before answering with the current state
+LONG_POLL_TIMEOUT = 30
+
+async def snapshot_response(request: Request, snapshot, section: str, since: Optional[int]):
+    # Serve the cached bytes for a section, honouring If-None-Match and ?since=
+    if since is not None:
+        await snapshot.wait_async(section, since, LONG_POLL_TIMEOUT)
+    version, body, etag = snapshot.render(section)
+    headers = {"ETag": etag, "X-State-Version": str(version)}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+def default_robot() -> Robot:
+    return registry.default
+
+def robot_by_id(robot_id: str) -> Robot:
+    robot = registry.get(robot_id)
+    if robot is None:
+        raise HTTPException(status_code=404, detail="Unknown robot %s" % robot_id)
+    return robot
+
+def lease_ttl(robot, ttl):
+    # The lease of a motion command: its ?ttl=, or the robot's default, None for no lease.
+    # A robot's default is also the longest lease a client may ask for, not one it can opt out of
+    default = robot.config["leases"]["ttl"]
+    if ttl is None:
+        ttl = default
+    elif default and not ttl > 0:
+        raise HTTPException(status_code=422, detail="ttl must be above 0, commands are leased for at most %g s" % default)
+    elif not ttl >= 0:
+        raise HTTPException(status_code=422, detail="ttl can't be negative")
+    elif default:
+        ttl = min(ttl, default)
+    return ttl or None
+
+class BatchCommand(BaseModel):
+    op: str
+    args: list = []
+    # lease for motion commands, see lease_ttl
+    ttl: Optional[float] = None
+
+def check_joint(joint):
+    if joint not in JOINTS:
+        raise HTTPException(status_code=404, detail="Unknown joint %s, choose from %s" % (joint, ", ".join(JOINTS)))
+
+def convert_arg(kind, arg):
+    # An argument converted to the type the PowerHorse method's annotation names, as the
+    # single routes' path parameters are; raises ValueError if it doesn't convert
+    if kind is bool or kind is str:
+        if isinstance(arg, kind):
+            return arg
+    elif isinstance(arg, (int, float, str)) and not isinstance(arg, bool):
+        value = float(arg)
+        if kind is float:
+            return value
+        if value.is_integer():
+            return int(value)
+    raise ValueError("%r is not %s" % (arg, "an integer" if kind is int else "a " + kind.__name__))
+
+def batch_command(command: BatchCommand):
+    # Checks a batched command before anything is sent and converts its arguments,
+    # returns (actuator, priority)
+    if command.op not in COMMANDS:
+        raise HTTPException(status_code=422, detail="Unknown command %s" % command.op)
+    signature = inspect.signature(getattr(PowerHorse, command.op))
+    try:
+        signature.bind(None, *command.args)
+        parameters = list(signature.parameters.values())[1:]
+        command.args = [convert_arg(parameter.annotation, arg) for parameter, arg in zip(parameters, command.args)]
+    except (TypeError, ValueError, OverflowError) as exc:
+        raise HTTPException(status_code=422, detail="%s: %s" % (command.op, exc))
+    if command.op == "set_arm":
+        check_joint(command.args[0])
+    if command.op == "set_light_pattern" and command.args[0] not in PATTERNS:
+        raise HTTPException(status_code=404, detail="Unknown pattern %s" % command.args[0])
+    return command_actuator(command.op, command.args)
+
+async def run_batched(robot, actuator, priority, command: BatchCommand, ttl):
+    try:
+        return {"ok": True, "result": await robot.command(actuator, priority, command.op, *command.args, ttl=ttl)}
+    except Coalesced as exc:
+        return {"ok": True, "coalesced": True, "detail": str(exc)}
+    except CommandCancelled as exc:
+        return {"ok": False, "status": 409, "detail": str(exc)}
+    except (TypeError, ValueError) as exc:
+        # refused by the PowerHorse method itself
+        return {"ok": False, "status": 422, "detail": "%s: %s" % (command.op, exc)}
+
+def camera_stream_of(robot):
+    # The camera belongs to the hardware owner when the API runs as several workers
+    if robot.camera_stream is None:
+        raise HTTPException(status_code=503, detail="The camera stream is only served in single-process mode")
+    return robot.camera_stream
+
+def robot_routes(get_robot) -> APIRouter:
+    # The control routes of one robot, `get_robot` is the dependency picking the robot.
+    # Fixed paths are declared before the parameterised ones that would otherwise shadow them.
+    router = APIRouter()
+
+    @router.get("/tracks")
+    async def get_tracks(request: Request, since: Optional[int] = None, robot: Robot = Depends(get_robot)):
+        return await snapshot_response(request, robot.powerhorse.snapshot, "tracks", since)
+
+    @router.put("/tracks/stop")
+    async def stop_tracks(robot: Robot = Depends(get_robot)):
+        return await robot.command("tracks", SAFETY, "set_tracks", 0, 0)
+
+    @router.put("/tracks/throttle/{throttle}")
+    async def set_tracks_throttle(throttle: float, ttl: Optional[float] = None, robot: Robot = Depends(get_robot)):
+        return await robot.command("tracks", MOTION, "set_throttle", throttle, ttl=lease_ttl(robot, ttl))
+
+    @router.put("/tracks/differential/{differential}")
+    async def set_tracks_differential(differential: float, ttl: Optional[float] = None, robot: Robot = Depends(get_robot)):
+        return await robot.command("tracks", MOTION, "set_differential", differential, ttl=lease_ttl(robot, ttl))
+
+    @router.put("/tracks/{throttle}/{differential}")
+    async def set_tracks(throttle: float, differential: float, ttl: Optional[float] = None, robot: Robot = Depends(get_robot)):
+        return await robot.command("tracks", MOTION, "set_tracks", throttle, differential, ttl=lease_ttl(robot, ttl))
+
+    @router.get("/trajectory")
+    async def get_trajectory(robot: Robot = Depends(get_robot)):
+        player = None if robot.remote else robot.powerhorse.trajectory
+        return player.stats() if player is not None else {"playing": False}
+
+    @router.put("/trajectory")
+    async def play_trajectory(request: Request, robot: Robot = Depends(get_robot)):
+        # The body is a plan made by `python powerhorse_trajectory.py compile`
+        if robot.remote:
+            raise HTTPException(status_code=503, detail="Track routes are only played in single-process mode")
+        try:
+            plan = TrackPlan.from_bytes(await request.body())
+        except ValueError as exc:
+            raise HTTPException(status_code=422, detail=str(exc))
+        try:
+            return await robot.command("tracks", MOTION, "play_trajectory", plan)
+        except ValueError as exc:
+            raise HTTPException(status_code=409, detail=str(exc))
+
+    @router.get("/arm")
+    async def get_arm(request: Request, since: Optional[int] = None, robot: Robot = Depends(get_robot)):
+        return await snapshot_response(request, robot.powerhorse.snapshot, "arm", since)
+
+    @router.get("/arm/{joint}")
+    async def get_arm_joint(joint: str, robot: Robot = Depends(get_robot)):
+        check_joint(joint)
+        return {"joint": joint, "power": robot.powerhorse.arm[joint]}
+
+    @router.put("/arm/stop")
+    async def stop_arm(robot: Robot = Depends(get_robot)):
+        return {"joints": await robot.command("arm", SAFETY, "stop_arms")}
+
+    @router.put("/arm/stop/{joint}")
+    async def stop_arm_joint(joint: str, robot: Robot = Depends(get_robot)):
+        check_joint(joint)
+        await robot.command("arm." + joint, SAFETY, "set_arm", joint, 0)
+        return {"joint": joint, "power": 0}
+
+    @router.put("/arm/{joint}/goto/{position}")
+    async def goto_arm_joint(joint: str, position: float, power: float = 50, robot: Robot = Depends(get_robot)):
+        check_joint(joint)
+        try:
+            future = robot.estimator.goto(joint, position, power)
+        except ValueError as exc:
+            raise HTTPException(status_code=422, detail=str(exc))
+        await asyncio.wrap_future(future)
+        return {"joint": joint, "target": robot.estimator.as_dict()["targets"].get(joint, position)}
+
+    @router.put("/arm/{joint}/{power}")
+    async def set_arm_joint(joint: str, power: float, ttl: Optional[float] = None, robot: Robot = Depends(get_robot)):
+        check_joint(joint)
+        await robot.command("arm." + joint, MOTION, "set_arm", joint, power, ttl=lease_ttl(robot, ttl))
+        return {"joint": joint, "power": power}
+
+    @router.get("/light")
+    async def get_light(request: Request, since: Optional[int] = None, robot: Robot = Depends(get_robot)):
+        return await snapshot_response(request, robot.powerhorse.snapshot, "light", since)
+
+    @router.put("/light/on")
+    async def turn_light_on(robot: Robot = Depends(get_robot)):
+        await robot.command("light", COSMETIC, "set_light", True)
+        return {"light": robot.powerhorse.light}
+
+    @router.put("/light/off")
+    async def turn_light_off(robot: Robot = Depends(get_robot)):
+        await robot.command("light", COSMETIC, "set_light", False)
+        return {"light": robot.powerhorse.light}
+
+    @router.put("/light/brightness/{level}")
+    async def set_light_brightness(level: float, robot: Robot = Depends(get_robot)):
+        await robot.command("light", COSMETIC, "set_light_brightness", level)
+        return {"light": robot.powerhorse.light, "brightness": robot.powerhorse.light_brightness}
+
+    @router.put("/light/pattern/{pattern}")
+    async def set_light_pattern(pattern: str, robot: Robot = Depends(get_robot)):
+        if pattern not in PATTERNS:
+            raise HTTPException(status_code=404, detail="Unknown pattern %s, choose from %s" % (pattern, ", ".join(PATTERNS)))
+        await robot.command("light", COSMETIC, "set_light_pattern", pattern)
+        return {"light": robot.powerhorse.light, "pattern": robot.powerhorse.light_pattern}
+
+    @router.get("/light/channels")
+    async def get_light_channels(robot: Robot = Depends(get_robot)):
+        return robot.lights.stats()
+
+    @router.put("/light/toggle")
+    async def toggle_light(robot: Robot = Depends(get_robot)):
+        return {"light": await robot.command("light", COSMETIC, "toggle_light")}
+
+    @router.get("/camera")
+    async def get_camera(request: Request, since: Optional[int] = None, robot: Robot = Depends(get_robot)):
+        return await snapshot_response(request, robot.powerhorse.snapshot, "camera", since)
+
+    @router.get("/camera/stream")
+    async def camera_stream(robot: Robot = Depends(get_robot)):
+        stream = camera_stream_of(robot)
+        return StreamingResponse(limited_stream(stream.mjpeg(), robot.limiter.open_stream()),
+                                 media_type="multipart/x-mixed-replace; boundary=%s" % BOUNDARY.decode())
+
+    @router.websocket("/camera/stream")
+    async def camera_stream_ws(websocket: WebSocket, robot: Robot = Depends(get_robot)):
+        # one binary message per JPEG frame
+        if robot.camera_stream is None:
+            await websocket.close(code=1013)
             return
-        if(motor == 0):
-            pwm.setDutycycle(self.PWMA, speed)
-            if(index == Dir[0]):
-                print ("1")
-                pwm.setLevel(self.AIN1, 0)
-                pwm.setLevel(self.AIN2, 1)
-            else:
-                print ("2")
-                pwm.setLevel(self.AIN1, 1)
-                pwm.setLevel(self.AIN2, 0)
-        else:
-            pwm.setDutycycle(self.PWMB, speed)
-            if(index == Dir[0]):
-                print ("3")
-                pwm.setLevel(self.BIN1, 0)
-                pwm.setLevel(self.BIN2, 1)
-            else:
-                print ("4")
-                pwm.setLevel(self.BIN1, 1)
-                pwm.setLevel(self.BIN2, 0)
-
-    def MotorStop(self, motor):
-        if (motor == 0):
-            pwm.setDutycycle(self.PWMA, 0)
-        else:
-            pwm.setDutycycle(self.PWMB, 0)
-
-
-
-class PowerHorse:
-    def __init__(self):
-        self.arm_motor_shoulder = Motor("MOTOR1",1)
-        self.arm_motor_elbow = Motor("MOTOR2",1)
-        self.arm_motor_wrist = Motor("MOTOR3",1)
-        self.arm_motor_gripper = Motor("MOTOR4",1)
-        self.arm_motors = {
-            "shoulder": self.arm_motor_shoulder,
-            "elbow": self.arm_motor_elbow,
-            "wrist": self.arm_motor_wrist,
-            "gripper": self.arm_motor_gripper
-        }
-
-        self.arm_all = LinkedMotors(self.arm_motor_shoulder, self.arm_motor_elbow, self.arm_motor_wrist, self.arm_motor_gripper)
-
-        self.track_motors = MotorDriver()
-
-        self.arm_arrow_shoulder = Arrow(1)
-        self.arm_arrow_elbow = Arrow(2)
-        self.arm_arrow_wrist = Arrow(3)
-        self.arm_arrow_gripper = Arrow(4)
-        self.arm_arrows = {
-            "shoulder": self.arm_arrow_shoulder,
-            "elbow": self.arm_arrow_elbow,
-            "wrist": self.arm_arrow_wrist,
-            "gripper": self.arm_arrow_gripper
-        }
-
-        self.light = False
-        self.arm = {"shoulder": 0, "elbow": 0, "wrist": 0, "gripper": 0}
-        self.camera_angle = 0
-        self.tracks = {"throttle": 0, "differential": 0}
-
-    def set_light(self, state: bool):
-        self.light = state
-
-    def set_tracks(self, throttle: float, differential: float):
-        self.tracks["throttle"] = throttle
-        self.tracks["differential"] = differential
-        
-        # Ensure throttle and differential are within the range of -100 to 100
-        throttle = max(min(throttle, 100), -100)
-        differential = max(min(differential, 100), -100)
-
-        # Determine direction index based on the sign of the throttle
-        direction_index = "forward" if throttle >= 0 else "backward"
-
-        # Calculate motor speeds based on throttle and differential values
-        abs_throttle = abs(throttle)
-        if differential == 0:
-            motor_left_speed = abs_throttle
-            motor_right_speed = abs_throttle
-        elif 0 < differential <= 50:
-            motor_left_speed = abs_throttle * (1 - differential / 50)
-            motor_right_speed = abs_throttle
-        elif differential > 50:
-            motor_left_speed = abs_throttle * ((differential - 50) / 50)
-            motor_right_speed = abs_throttle
-        elif -50 <= differential < 0:
-            motor_left_speed = abs_throttle
-            motor_right_speed = abs_throttle * (1 + differential / 50)
-        else:  # differential < -50
-            motor_left_speed = abs_throttle
-            motor_right_speed = abs_throttle * ((-differential - 50) / 50)
-
-        # Ensure motor speeds are within the range of 0 to 100
-        motor_left_speed = max(min(motor_left_speed, 100), 0)
-        motor_right_speed = max(min(motor_right_speed, 100), 0)
-
-        self.track_motors.MotorRun(0, direction_index, motor_left_speed)
-        self.track_motors.MotorRun(1, direction_index, motor_right_speed)
-
-        return self.tracks
-
-    
-    def set_arm(self, joint: str, power: float):
-        self.arm[joint] = power
-        self.arm_arrows[joint].on()
-        if power > 0:
-            self.arm_motors[joint].forward(power)
-        elif power < 0:
-            self.arm_motors[joint].backward(power)
-        else:
-            self.arm_motors[joint].stop()
-
-    def stop_arm(self, joint: str):
-        self.arm[joint] = 0
-        self.arm_arrows[joint].off()
-        self.arm_motors[joint].set_power(0)
-
-
-    def set_camera(self, angle: int):
-        self.camera_angle = angle
-
-app = FastAPI()
-powerhorse = PowerHorse()
+        try:
+            close = robot.limiter.open_stream()
+        except RateLimited as exc:
+            # 1013 is "try again later"
+            await websocket.close(code=1013, reason=str(exc))
+            return
+        await websocket.accept()
+        try:
+            async for header, frame in robot.camera_stream.frames_of():
+                await websocket.send_bytes(frame)
+        except WebSocketDisconnect:
+            pass
+        finally:
+            close()
+
+    @router.get("/camera/stream/stats")
+    async def camera_stream_stats(robot: Robot = Depends(get_robot)):
+        return camera_stream_of(robot).stats()
+
+    @router.put("/camera/rotate/{angle}")
+    async def rotate_camera(angle: int, robot: Robot = Depends(get_robot)):
+        await robot.command("camera", COSMETIC, "set_camera", angle)
+        return {"camera": robot.powerhorse.camera_angle}
+
+    @router.put("/camera/tilt/{angle}")
+    async def tilt_camera(angle: int, robot: Robot = Depends(get_robot)):
+        await robot.command("camera", COSMETIC, "set_camera_tilt", angle)
+        return {"tilt": robot.powerhorse.camera_tilt}
+
+    @router.get("/camera/servos")
+    async def get_camera_servos(robot: Robot = Depends(get_robot)):
+        return robot.servos.stats()
+
+    @router.put("/camera/stop")
+    async def stop_camera(robot: Robot = Depends(get_robot)):
+        await robot.command("camera", COSMETIC, "set_camera", 0)
+        return {"camera": robot.powerhorse.camera_angle}
+
+    @router.put("/camera/home")
+    async def home_camera(robot: Robot = Depends(get_robot)):
+        await robot.command("camera", COSMETIC, "set_camera", 0)
+        return {"camera": robot.powerhorse.camera_angle}
+
+    @router.put("/stop")
+    async def emergency_stop(robot: Robot = Depends(get_robot)):
+        await robot.command(ALL, SAFETY, "stop")
+        return {"stop": True}
+
+    @router.put("/lease")
+    async def renew_leases(robot: Robot = Depends(get_robot)):
+        # the heartbeat: renews this client's leases without going near the scheduler or the bus
+        return {"renewed": await robot.heartbeat(current_client.get())}
+
+    @router.get("/leases")
+    async def get_leases(robot: Robot = Depends(get_robot)):
+        return robot.leases.stats()
+
+    @router.post("/batch")
+    async def batch(commands: List[BatchCommand], robot: Robot = Depends(get_robot)):
+        # Several commands in one request, all sent to the scheduler together.
+        # A command the API doesn't accept rejects the whole batch before any of it is sent.
+        # Results come back in order; one command being cancelled doesn't fail the others.
+        checked = [batch_command(command) for command in commands]
+        ttls = [lease_ttl(robot, command.ttl) if priority == MOTION else None
+                for (actuator, priority), command in zip(checked, commands)]
+        results = await asyncio.gather(*[run_batched(robot, actuator, priority, command, ttl)
+                                         for (actuator, priority), command, ttl in zip(checked, commands, ttls)])
+        return {"results": results}
+
+    @router.get("/estimate")
+    async def get_estimate(robot: Robot = Depends(get_robot)):
+        return robot.estimator.as_dict()
+
+    @router.put("/estimate/reset")
+    async def reset_estimate(robot: Robot = Depends(get_robot)):
+        # call with the arm in its zero position and the vehicle at the origin
+        future = robot.estimator.reset()
+        if future is not None:
+            # with a hardware-owner process the reset is done there
+            await asyncio.wrap_future(future)
+        return robot.estimator.as_dict()
+
+    @router.get("/loop")
+    async def get_loop(robot: Robot = Depends(get_robot)):
+        return robot.loop.stats()
+
+    @router.get("/safety")
+    async def get_safety(robot: Robot = Depends(get_robot)):
+        return robot.safety.stats()
+
+    @router.get("/udp")
+    async def get_udp(robot: Robot = Depends(get_robot)):
+        return robot.udp.stats() if robot.udp else {"enabled": False}
+
+    @router.get("/scheduler")
+    async def get_scheduler(robot: Robot = Depends(get_robot)):
+        return robot.scheduler.stats()
+
+    @router.get("/limits")
+    async def get_limits(robot: Robot = Depends(get_robot)):
+        return robot.limiter.stats()
+
+    @router.get("/sim")
+    async def get_sim(robot: Robot = Depends(get_robot)):
+        # where the simulated robot really is, to set against GET .../estimate
+        if robot.simulator is None:
+            raise HTTPException(status_code=404, detail="Robot %s is not simulated" % robot.id)
+        return robot.simulator.stats()
+
+    return router
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    # The robots are built with the registry when this module is imported, their schedulers,
+    # control loops and lease timers already running. UDP listeners and the loop-lag monitor
+    # need the server's event loop, so start here; everything is stopped when the server exits.
+    loop_lag.start(asyncio.get_running_loop())
+    try:
+        for robot_id in registry.ids():
+            robot = registry.get(robot_id)
+            udp = robot.config["udp"]
+            # with several workers UDP is served by the hardware owner
+            if udp["port"] and not robot.remote:
+                robot.udp = await start_udp(robot, udp["host"], udp["port"], udp["echo_interval"])
+        yield
+    finally:
+        sampler.stop()
+        loop_lag.stop()
+        registry.close()
+
+app = FastAPI(lifespan=lifespan)
+
+@app.exception_handler(CommandCancelled)
+async def command_cancelled(request: Request, exc: CommandCancelled):
+    return JSONResponse(status_code=409, content={"detail": str(exc)})
+
+@app.exception_handler(Coalesced)
+async def command_coalesced(request: Request, exc: Coalesced):
+    # accepted, but replaced by the same client's newer command before it was sent
+    return JSONResponse(status_code=202, content={"coalesced": True, "detail": str(exc)})
+
+@app.exception_handler(RateLimited)
+async def rate_limited(request: Request, exc: RateLimited):
+    return JSONResponse(status_code=429, content={"detail": str(exc)},
+                        headers={"Retry-After": str(exc.retry_after)})
+
+@app.exception_handler(OwnerUnavailable)
+async def owner_unavailable(request: Request, exc: OwnerUnavailable):
+    return JSONResponse(status_code=503, content={"detail": str(exc)})
+
+def route_template(scope):
+    # The matched route's path with the router prefix put back, e.g. /robots/{robot_id}/tracks.
+    # Depending on the FastAPI version the route in the scope may or may not carry the prefix.
+    route = scope.get("route")
+    if route is None:
+        return scope["path"]
+    segments = scope["path"].split("/")
+    prefix = segments[:len(segments) - len(route.path.split("/")) + 1]
+    robot_id = scope.get("path_params", {}).get("robot_id")
+    return "/".join("{robot_id}" if segment == robot_id else segment for segment in prefix) + route.path
+
+class TraceMiddleware:
+    # Traces sampled requests (or any sent with "X-Trace: 1"), named after their route.
+    # Plain ASGI rather than @app.middleware to keep the cost off unsampled requests.
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        with tracer.trace(scope["path"], force=(b"x-trace", b"1") in scope["headers"]) as span:
+            await self.app(scope, receive, send)
+            span.rename("%s %s" % (scope["method"], route_template(scope)))
+
+class ProfileMiddleware:
+    # cProfiles the requests asked for with PUT /admin/profile/route
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not request_profiler.wants(scope["method"], scope["path"]):
+            return await self.app(scope, receive, send)
+        profile = request_profiler.begin()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            request_profiler.end(profile, route_template(scope))
+
+app.add_middleware(ProfileMiddleware)
+app.add_middleware(TraceMiddleware)
+app.add_middleware(ClientMiddleware)
+
+@app.get("/admin/trace")
+async def get_trace(clear: bool = False):
+    # Chrome trace format, open it in chrome://tracing or ui.perfetto.dev
+    trace = tracer.chrome_trace()
+    if clear:
+        tracer.clear()
+    return trace
+
+@app.get("/admin/trace/routes")
+async def get_trace_routes():
+    return tracer.breakdown()
+
+@app.put("/admin/trace/sample/{rate}")
+async def set_trace_sample(rate: float):
+    tracer.sample_rate = max(min(rate, 1.0), 0.0)
+    return {"sample_rate": tracer.sample_rate}
+
+@app.put("/admin/profile/start")
+async def start_profile(seconds: float = 10, interval_ms: float = 5):
+    # samples every thread's stack until `seconds` pass or /admin/profile/stop
+    try:
+        sampler.start(seconds, interval_ms / 1000)
+    except RuntimeError as exc:
+        raise HTTPException(status_code=409, detail=str(exc))
+    return sampler.status()
+
+@app.put("/admin/profile/stop")
+async def stop_profile():
+    await asyncio.to_thread(sampler.stop)
+    return sampler.status()
+
+@app.get("/admin/profile")
+async def get_profile():
+    # collapsed stacks, for flamegraph.pl or https://www.speedscope.app
+    return PlainTextResponse(sampler.collapsed(), headers={"X-Profile-Running": str(sampler.running).lower()})
+
+@app.put("/admin/profile/route")
+async def profile_route(method: str, route: str, count: int = 10):
+    # e.g. ?method=PUT&route=/powerhorse/tracks/{throttle}/{differential}
+    request_profiler.arm(method, route, count)
+    return request_profiler.status()
+
+@app.get("/admin/profile/route")
+async def get_route_profile(sort: str = "cumulative", limit: int = 50):
+    try:
+        report = request_profiler.report(sort, limit)
+    except KeyError:
+        raise HTTPException(status_code=400, detail="Unknown sort key %s" % sort)
+    return PlainTextResponse(report, headers={"X-Profile-Remaining": str(request_profiler.remaining)})
+
+@app.get("/admin/loop-lag")
+async def get_loop_lag():
+    return loop_lag.report()
+
+@app.put("/admin/loop-lag/threshold/{ms}")
+async def set_loop_lag_threshold(ms: float):
+    loop_lag.threshold = max(ms, 1) / 1000
+    return loop_lag.report()
 
 @app.get("/")
 async def root():
     return {"message": "Powerhorse Control API"}
 
-@app.get("/powerhorse/tracks")
-async def get_tracks():
-    return powerhorse.tracks
-
-@app.put("/powerhorse/tracks/{throttle}/{differential}")
-async def set_tracks(throttle: float, differential: float):
-    powerhorse.set_tracks(throttle, differential)
-    return {"throttle": throttle, "differential": differential}
-
-@app.put("/powerhorse/tracks/throttle/{throttle}")
-async def set_tracks_throttle(throttle: float):
-    powerhorse.set_tracks(throttle, powerhorse.tracks["differential"])
-    return {"throttle": throttle, "differential": powerhorse.tracks["differential"]}
-
-@app.put("/powerhorse/tracks/differential/{differential}")
-async def set_tracks_differential(differential: float):
-    powerhorse.set_tracks(powerhorse.tracks["throttle"], differential)
-    return {"throttle": powerhorse.tracks["throttle"], "differential": differential}
-
-@app.put("/powerhorse/tracks/stop")
-async def stop_tracks():
-    powerhorse.set_tracks(0, 0)
-    return {"throttle": 0, "differential": 0}
-
-@app.get("/powerhorse/arm")
-async def get_arm():
-    return {"joints": powerhorse.arm}
-
-@app.get("/powerhorse/arm/{joint}")
-async def get_arm_joint(joint: str):
-    return {"joint": joint, "power": powerhorse.arm[joint]}
-
-@app.put("/powerhorse/arm/{joint}/{power}")
-async def set_arm_joint(joint: str, power: float):
-    powerhorse.set_arm(joint, power)
-    return {"joint": joint, "power": power}
-
-@app.put("/powerhorse/arm/stop")
-async def stop_arm():
-    powerhorse.set_arm("shoulder", 0)
-    powerhorse.set_arm("elbow", 0)
-    powerhorse.set_arm("wrist", 0)
-    powerhorse.set_arm("gripper", 0)
-    return {"joints": powerhorse.arm}
-
-@app.put("/powerhorse/arm/stop/{joint}")
-async def stop_arm_joint(joint: str):
-    powerhorse.set_arm(joint, 0)
-    return {"joint": joint, "power": 0}
-
-@app.get("/powerhorse/light")
-async def get_light():
-    return {"light": powerhorse.light}
-
-@app.put("/powerhorse/light/on")
-async def turn_light_on():
-    powerhorse.set_light(True)
-    return {"light": powerhorse.light}
-
-@app.put("/powerhorse/light/off")
-async def turn_light_off():
-    powerhorse.set_light(False)
-    return {"light": powerhorse.light}
-
-@app.put("/powerhorse/light/toggle")
-async def toggle_light():
-    if powerhorse.light:
-        powerhorse.set_light(False)
-    else:
-        powerhorse.set_light(True)
-    return {"light": powerhorse.light}
-
-@app.get("/powerhorse/camera")
-async def get_camera():
-    return {"camera": powerhorse.camera_angle}
-
-@app.put("/powerhorse/camera/rotate/{angle}")
-async def rotate_camera(angle: int):
-    powerhorse.set_camera(angle)
-    return {"camera": powerhorse.camera_angle}
-
-@app.put("/powerhorse/camera/stop")
-async def stop_camera():
-    powerhorse.set_camera(0)
-    return {"camera": powerhorse.camera_angle}
-
-@app.put("/powerhorse/camera/home")
-async def home_camera():
-    powerhorse.set_camera(0)
-    return {"camera": powerhorse.camera_angle}
-
-@app.put("/powerhorse/stop")
-async def emergency_stop():
-    powerhorse.set_tracks(0, 0)
-    powerhorse.set_arm("shoulder", 0)
-    powerhorse.set_arm("elbow", 0)
-    powerhorse.set_arm("wrist", 0)
-    powerhorse.set_arm("gripper", 0)
-    powerhorse.set_light(False)
-    powerhorse.set_camera(0)
-    return {"stop": True}
+@app.get("/robots")
+async def list_robots():
+    return {"robots": registry.ids(), "default": registry.default_id}
+
+app.include_router(robot_routes(default_robot), prefix="/powerhorse")
+app.include_router(robot_routes(robot_by_id), prefix="/robots/{robot_id}")
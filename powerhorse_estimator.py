@@ -0,0 +1,152 @@
+#!/usr/bin/python
+
+# Dead-reckoning state estimator.
+# The PowerHorse has no encoders, so where the arm joints and the vehicle have got
+# to is estimated by integrating the commanded duty over time on every control-loop
+# tick: a calibrated speed per joint, and a differential-drive model for the tracks.
+# All six actuators are updated together as one NumPy vector.
+
+import math
+import threading
+
+import numpy as np
+
+from powerhorse_robot import JOINTS
+from powerhorse_scheduler import MOTION
+
+# Seconds a goto may wait in the scheduler before its target is given up on
+GOTO_START_TIMEOUT = 1.0
+
+
+def check_goto_power(config, joint, power):
+    ''' Raises ValueError if a goto at `power` would never move `joint`: inside its deadband
+    the estimate stands still, so the target would never be reached nor given up on.
+    `config` is the "estimator" section of the robot config.
+    '''
+    deadband = config["joints"][joint]["deadband"]
+    if not abs(power) > deadband:
+        raise ValueError("A power of %g doesn't move the %s, goto needs more than its deadband of %g" % (power, joint, deadband))
+
+
+class Estimator:
+    ''' Estimates joint positions (degrees) and the vehicle pose (metres, radians).
+
+    Arguments:
+    powerhorse = the PowerHorse whose commanded duty is integrated
+    scheduler = its scheduler, used to stop joints that reach a goto target
+    config = the "estimator" section of the robot config
+    '''
+    def __init__(self, powerhorse, scheduler, config):
+        self.powerhorse = powerhorse
+        self.scheduler = scheduler
+        self.config = config
+        joints = [config["joints"][joint] for joint in JOINTS]
+        tracks = config["tracks"]
+        # speed at full duty and deadband for the 4 joints then the left and right tracks
+        self.speed = np.array([joint["speed"] for joint in joints] + [tracks["speed"]] * 2, dtype=float)
+        self.deadband = np.array([joint["deadband"] for joint in joints] + [tracks["deadband"]] * 2, dtype=float)
+        self.lower = np.array([joint["min"] for joint in joints], dtype=float)
+        self.upper = np.array([joint["max"] for joint in joints], dtype=float)
+        self.track_width = tracks["width"]
+        self.tolerance = config["tolerance"]
+        self.duty = np.zeros(6)
+        self.positions = np.zeros(4)
+        self.pose = np.zeros(3)
+        self.velocity = np.zeros(2)
+        # goto targets and the power they were started with, nan where there is none
+        self.targets = np.full(4, np.nan)
+        self.target_power = np.full(4, np.nan)
+        # whether the goto command has been applied yet, and when it was asked for
+        self.started = np.zeros(4, dtype=bool)
+        self.requested = np.zeros(4)
+        self.last = None
+        self._lock = threading.Lock()
+
+    def tick(self, now):
+        powerhorse = self.powerhorse
+        duty = self.duty
+        duty[:4] = powerhorse.arm_power
+        duty[4:] = powerhorse.track_duty
+        with self._lock:
+            if self.last is None:
+                self.last = now
+                return
+            dt = now - self.last
+            self.last = now
+
+            # duty inside the deadband doesn't overcome friction
+            speeds = np.where(np.abs(duty) > self.deadband, np.clip(duty, -100, 100) / 100, 0.0) * self.speed
+            self.positions = np.clip(self.positions + speeds[:4] * dt, self.lower, self.upper)
+
+            left, right = speeds[4], speeds[5]
+            v = (left + right) / 2
+            w = (right - left) / self.track_width
+            x, y, heading = self.pose
+            if abs(w) < 1e-9:
+                x += v * dt * math.cos(heading)
+                y += v * dt * math.sin(heading)
+            else:
+                # exact integration along the arc
+                radius = v / w
+                x += radius * (math.sin(heading + w * dt) - math.sin(heading))
+                y -= radius * (math.cos(heading + w * dt) - math.cos(heading))
+            heading = (heading + w * dt + math.pi) % (2 * math.pi) - math.pi
+            self.pose[:] = (x, y, heading)
+            self.velocity[:] = (v, w)
+
+            active = ~np.isnan(self.targets)
+            if not active.any():
+                return
+            applied = duty[:4] == self.target_power
+            self.started |= active & applied
+            # somebody else has taken over the joint, or the goto never got applied (e.g. a stop
+            # cancelled it), so forget the target
+            overridden = active & ((self.started & ~applied) | (~self.started & (now - self.requested > GOTO_START_TIMEOUT)))
+            # targets are within the joint limits, so a joint pinned at a limit still gets there
+            remaining = (self.targets - self.positions) * np.sign(self.target_power)
+            reached = active & self.started & ~overridden & (remaining <= self.tolerance)
+            done = overridden | reached
+            self.targets[done] = np.nan
+            self.target_power[done] = np.nan
+            self.started[done] = False
+        for i in np.flatnonzero(reached):
+            joint = JOINTS[i]
+            self.scheduler.submit("arm." + joint, MOTION, "set_arm", joint, 0, source="estimator")
+
+    def goto(self, joint, position, power=50):
+        ''' Drives a joint towards an estimated position, it is stopped when the estimate gets there.
+        Raises ValueError for a power inside the joint's deadband, see check_goto_power.
+        '''
+        i = JOINTS.index(joint)
+        check_goto_power(self.config, joint, power)
+        with self._lock:
+            position = float(np.clip(position, self.lower[i], self.upper[i]))
+            error = position - self.positions[i]
+            if abs(error) <= self.tolerance:
+                self.targets[i] = np.nan
+                self.target_power[i] = np.nan
+                return self.scheduler.submit("arm." + joint, MOTION, "set_arm", joint, 0, source="estimator")
+            power = math.copysign(abs(power), error)
+            self.targets[i] = position
+            self.target_power[i] = power
+            self.started[i] = False
+            self.requested[i] = self.last if self.last is not None else 0.0
+        return self.scheduler.submit("arm." + joint, MOTION, "set_arm", joint, power, source="estimator")
+
+    def reset(self, positions=None, pose=None):
+        ''' Sets the estimate, e.g. after homing the arm. Defaults to all zeros. '''
+        with self._lock:
+            self.positions[:] = positions if positions is not None else 0.0
+            self.pose[:] = pose if pose is not None else 0.0
+            self.targets[:] = np.nan
+            self.target_power[:] = np.nan
+            self.started[:] = False
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "joints": {joint: float(self.positions[i]) for i, joint in enumerate(JOINTS)},
+                "targets": {joint: float(self.targets[i]) for i, joint in enumerate(JOINTS) if not np.isnan(self.targets[i])},
+                "pose": {"x": float(self.pose[0]), "y": float(self.pose[1]), "heading": float(self.pose[2])},
+                "velocity": {"linear": float(self.velocity[0]), "angular": float(self.velocity[1])},
+            }
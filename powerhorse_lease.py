@@ -0,0 +1,203 @@
+#!/usr/bin/python
+
+# Command leases.
+# A motion command on the tracks or an arm joint may be leased for a number of seconds
+# (its TTL): unless the client that sent it renews the lease in time, the actuator is
+# stopped with a safety command. Renewing is cheap, it only moves the lease's expiry on
+# and sends nothing to the scheduler or the bus. A lease is renewed by a heartbeat
+# (PUT .../lease), by any other command from the same client, and for UDP teleop by every
+# setpoint frame of the stream.
+#
+# All of a robot's leases share one timer thread and one heap of expiry times. Renewals
+# don't touch the heap: when an entry comes due and its lease has been renewed since, it
+# is pushed back with the new expiry, so the heap only holds about one entry per lease.
+# Times are taken from the robot's clock. A simulated robot keeps virtual time, and instead
+# of the timer thread its leases are expired by a tick on its control loop (see tick).
+
+import heapq
+import threading
+import time
+
+from powerhorse_scheduler import SAFETY, covers
+
+
+def leasable(actuator):
+    return actuator == "tracks" or actuator.startswith("arm.")
+
+
+class Lease:
+    __slots__ = ("actuator", "holder", "ttl", "expires", "deadline")
+
+    def __init__(self, actuator, holder, ttl, now):
+        self.actuator = actuator
+        self.holder = holder
+        self.ttl = ttl
+        self.expires = now + ttl
+        # expiry of the lease's entry in the heap, earlier than `expires` once renewed
+        self.deadline = self.expires
+
+
+class LeaseKeeper:
+    ''' The leases on a robot's actuators, stopped through its scheduler when they expire.
+
+    Arguments:
+    scheduler = the robot's scheduler
+    config = the "leases" section of the robot config
+    name = used to name the timer thread
+    clock = returns the time in seconds, the robot's clock
+    '''
+    def __init__(self, scheduler, config, name="powerhorse", clock=time.monotonic):
+        self.scheduler = scheduler
+        self.clock = clock
+        self.name = name
+        self.max_ttl = config["max"]
+        self.leases = {}
+        # holder -> actuators it holds leases on
+        self.held = {}
+        self.counters = {"granted": 0, "renewed": 0, "heartbeats": 0, "released": 0, "expired": 0}
+        self._heap = []
+        self._order = 0
+        self._running = True
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread = None
+
+    def start(self):
+        ''' Starts the timer thread, for leases on the wall clock. '''
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="leases-%s" % self.name, daemon=True)
+            self._thread.start()
+
+    def grant(self, actuator, holder, ttl):
+        ''' Leases an actuator to `holder` for `ttl` seconds, taking over any lease on it. '''
+        ttl = min(ttl, self.max_ttl)
+        now = self.clock()
+        with self._lock:
+            self.counters["granted"] += 1
+            lease = self.leases.get(actuator)
+            if lease is not None and lease.holder == holder:
+                lease.ttl = ttl
+                lease.expires = now + ttl
+                # only a shorter lease needs an earlier entry in the heap
+                if lease.expires < lease.deadline:
+                    self._push(lease)
+                return
+            if lease is not None:
+                self._drop(lease)
+            lease = self.leases[actuator] = Lease(actuator, holder, ttl, now)
+            self.held.setdefault(holder, set()).add(actuator)
+            self._push(lease)
+
+    def release(self, actuator):
+        ''' Ends the leases on the actuators `actuator` covers, without stopping them. '''
+        with self._lock:
+            for lease in [lease for lease in self.leases.values() if covers(actuator, lease.actuator)]:
+                self._drop(lease)
+                self.counters["released"] += 1
+
+    def renew(self, holder):
+        ''' Renews every lease `holder` holds, returns how many. '''
+        now = self.clock()
+        with self._lock:
+            actuators = self.held.get(holder, ())
+            for actuator in actuators:
+                lease = self.leases[actuator]
+                lease.expires = now + lease.ttl
+            self.counters["renewed"] += len(actuators)
+            return len(actuators)
+
+    def heartbeat(self, holder):
+        self.counters["heartbeats"] += 1
+        return self.renew(holder)
+
+    def update(self, actuator, holder, ttl):
+        ''' Follows a command `holder` has just had run: with a ttl the actuator is leased,
+        without one the leases it covers end, as the command has taken over from them.
+        The holder's other leases are renewed either way.
+        '''
+        if ttl and leasable(actuator):
+            self.grant(actuator, holder, ttl)
+        else:
+            self.release(actuator)
+        if holder is not None:
+            self.renew(holder)
+
+    def _push(self, lease):
+        # called with the lock held
+        self._order += 1
+        lease.deadline = lease.expires
+        heapq.heappush(self._heap, (lease.deadline, self._order, lease))
+        if self._heap[0][2] is lease:
+            self._wakeup.notify()
+
+    def _drop(self, lease):
+        # called with the lock held, its heap entries are skipped when they come due
+        del self.leases[lease.actuator]
+        actuators = self.held[lease.holder]
+        actuators.discard(lease.actuator)
+        if not actuators:
+            del self.held[lease.holder]
+
+    def _expire(self, now):
+        # called with the lock held, drops the leases that have run out by `now` and returns them
+        expired = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, order, lease = heapq.heappop(self._heap)
+            if self.leases.get(lease.actuator) is not lease or deadline != lease.deadline:
+                # released, taken over or pushed again since
+                continue
+            if lease.expires > now:
+                self._push(lease)
+            else:
+                self._drop(lease)
+                self.counters["expired"] += 1
+                expired.append(lease)
+        return expired
+
+    def _due(self):
+        # Waits for leases to expire and returns them, None once closed
+        with self._lock:
+            while self._running:
+                now = self.clock()
+                expired = self._expire(now)
+                if expired:
+                    return expired
+                self._wakeup.wait(self._heap[0][0] - now if self._heap else None)
+        return None
+
+    def _stop(self, expired):
+        for lease in expired:
+            if lease.actuator == "tracks":
+                self.scheduler.submit("tracks", SAFETY, "set_tracks", 0, 0, source="lease")
+            else:
+                joint = lease.actuator[len("arm."):]
+                self.scheduler.submit(lease.actuator, SAFETY, "set_arm", joint, 0, source="lease")
+
+    def _run(self):
+        while True:
+            expired = self._due()
+            if expired is None:
+                return
+            self._stop(expired)
+
+    def tick(self, now):
+        ''' Stops the actuators whose leases have run out by `now`, for a control loop to call
+        in place of the timer thread.
+        '''
+        with self._lock:
+            expired = self._expire(now)
+        self._stop(expired)
+
+    def close(self):
+        with self._lock:
+            self._running = False
+            self._wakeup.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    def stats(self):
+        now = self.clock()
+        with self._lock:
+            leases = {lease.actuator: {"holder": lease.holder, "ttl": lease.ttl, "remaining": lease.expires - now}
+                      for lease in self.leases.values()}
+            return dict(self.counters, max_ttl=self.max_ttl, leases=leases)
@@ -0,0 +1,121 @@
+#!/usr/bin/python
+
+# Lights on PCA9685 channels, with brightness levels and patterns.
+# Brightness is the channel's PWM duty, so a steady light costs nothing once written.
+# With several lights each one's pulse starts at a different point (phase) of the PWM
+# period, spreading their switching edges so they don't all draw current at once.
+#
+# The PCA9685 has one PWM frequency for all 16 channels, at least 24 Hz and here set for
+# the motors and servos, so the chip can't blink a light slowly enough to see on its own.
+# Patterns (blink, pulse, strobe) are precomputed tables of duty per step that the control
+# loop steps through; a step only costs a write when the duty changes, two register writes
+# per light, so the bus traffic of a pattern is fixed by its table and never by the host.
+
+import math
+import threading
+
+GAMMA = 2.2
+
+
+def _brightness_table():
+    # perceived brightness 0-100 to 12-bit duty
+    return [int(round(4095 * (level / 100) ** GAMMA)) for level in range(101)]
+
+BRIGHTNESS = _brightness_table()
+
+
+def _pattern(name, rate):
+    # The pattern as brightness scales, 0 to 1, one per step at `rate` steps a second
+    if name == "blink":
+        # 1 Hz, half on
+        return [1.0] * (rate // 2) + [0.0] * (rate - rate // 2)
+    if name == "pulse":
+        # breathing, 2 seconds a breath
+        steps = 2 * rate
+        return [(1 - math.cos(2 * math.pi * i / steps)) / 2 for i in range(steps)]
+    if name == "strobe":
+        # a one-step flash 4 times a second
+        period = max(rate // 4, 2)
+        return [1.0] + [0.0] * (period - 1)
+    return [1.0]
+
+PATTERNS = ("solid", "blink", "pulse", "strobe")
+
+
+class Lights:
+    ''' The lights of a robot on PCA9685 channels, all showing the same brightness and pattern.
+
+    Arguments:
+    pwm = the PCA9685 they are connected to
+    config = the "lights" section of the robot config, {"channels": [12, 13]}
+    rate = steps a second of the patterns, the rate tick() is called at
+    '''
+    def __init__(self, pwm, config, rate):
+        self.pwm = pwm
+        self.rate = rate
+        self.channels = list(config["channels"])
+        # where in the PWM period each light's pulse starts
+        self.phases = [i * 4096 // len(self.channels) for i in range(len(self.channels))]
+        self.on = False
+        self.brightness = 100
+        self.pattern = "solid"
+        self.steps = [1.0]
+        self.started = None
+        self.duty = None
+        self.writes = 0
+        self._lock = threading.Lock()
+
+    def set(self, on=None, brightness=None, pattern=None):
+        with self._lock:
+            if on is not None:
+                self.on = on
+            if brightness is not None:
+                self.brightness = max(min(int(round(brightness)), 100), 0)
+            if pattern is not None:
+                if pattern not in PATTERNS:
+                    raise ValueError("Unknown light pattern %r, choose from %s" % (pattern, ", ".join(PATTERNS)))
+                self.pattern = pattern
+                self.steps = _pattern(pattern, self.rate)
+                # the pattern starts from its first step on the next tick
+                self.started = None
+            # a steady light is written straight away, a pattern on the next tick
+            if not self.on or len(self.steps) == 1:
+                self._write(self._duty(0))
+
+    def _duty(self, step):
+        if not self.on:
+            return 0
+        # rounding the scaled level through the table keeps the gamma curve
+        return BRIGHTNESS[int(round(self.brightness * self.steps[step]))]
+
+    def _write(self, duty):
+        if duty == self.duty:
+            return
+        for channel, phase in zip(self.channels, self.phases):
+            if duty == 0:
+                # the full-off bit, not a zero-length pulse
+                self.pwm.setPWM(channel, 0, 4096)
+            elif duty >= 4095:
+                # the full-on bit
+                self.pwm.setPWM(channel, 4096, 0)
+            elif self.duty in (None, 0, 4095):
+                # coming from full off or on, the ON count has to be put back too
+                self.pwm.setPWM(channel, phase, (phase + duty) % 4096)
+            else:
+                # the pulse keeps its start, only the end moves
+                self.pwm.setOff(channel, (phase + duty) % 4096)
+            self.writes += 1
+        self.duty = duty
+
+    def tick(self, now):
+        if len(self.steps) == 1 or not self.on:
+            return
+        with self._lock:
+            if self.started is None:
+                self.started = now
+            step = int((now - self.started) * self.rate + 0.5) % len(self.steps)
+            self._write(self._duty(step))
+
+    def stats(self):
+        return {"channels": self.channels, "on": self.on, "brightness": self.brightness,
+                "pattern": self.pattern, "duty": self.duty, "writes": self.writes}
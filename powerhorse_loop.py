@@ -0,0 +1,74 @@
+#!/usr/bin/python
+
+# The control loop of a robot: one thread calling each registered task's
+# tick(now) at CONTROL_RATE. Anything that has to advance with time (the state
+# estimator, and so on) is a tick function rather than a thread of its own, so
+# the whole lot can also be stepped by hand.
+
+import threading
+import time
+import traceback
+
+from powerhorse_robot import CONTROL_RATE
+
+
+class ControlLoop:
+    ''' Calls tick functions at a fixed rate.
+
+    Arguments:
+    name = used to name the loop thread
+    rate = ticks per second
+    '''
+    def __init__(self, name, rate=CONTROL_RATE):
+        self.name = name
+        self.interval = 1 / rate
+        self.tasks = []
+        self.ticks = 0
+        self.overruns = 0
+        self.max_tick = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add(self, tick):
+        ''' Registers a function called as tick(now) with the monotonic time of the tick. '''
+        self.tasks.append(tick)
+
+    def step(self, now):
+        for tick in self.tasks:
+            try:
+                tick(now)
+            except Exception:
+                # one broken task mustn't stop the others
+                traceback.print_exc()
+        self.ticks += 1
+
+    def _run(self):
+        next_tick = time.monotonic()
+        while not self._stop.is_set():
+            started = time.monotonic()
+            self.step(started)
+            elapsed = time.monotonic() - started
+            self.max_tick = max(self.max_tick, elapsed)
+            next_tick += self.interval
+            delay = next_tick - time.monotonic()
+            if delay < 0:
+                # running late, skip the ticks that were missed rather than bunching them up
+                self.overruns += 1
+                next_tick = time.monotonic()
+                delay = 0
+            self._stop.wait(delay)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="loop-%s" % self.name, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        return {"rate": 1 / self.interval, "ticks": self.ticks, "overruns": self.overruns,
+                "max_tick_ms": self.max_tick * 1000}
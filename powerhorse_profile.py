@@ -0,0 +1,249 @@
+#!/usr/bin/python
+
+# On-demand profiling of the running API, so a latency spike can be looked at without a
+# restart losing the state it happened in:
+#   - SamplingProfiler samples the stacks of every thread for a while, giving collapsed
+#     stacks (one "frame;frame;frame count" line per stack) for flamegraph.pl or speedscope
+#   - RequestProfiler runs cProfile over the next N requests to one route, giving pstats
+#   - LoopLagMonitor watches the asyncio event loop from a thread of its own and keeps the
+#     stack of anything that blocks it for longer than a threshold
+
+import asyncio
+import cProfile
+import inspect
+import io
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, deque
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return "%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), frame.f_lineno)
+
+
+def _stack(frame):
+    # outermost call first
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    return names[::-1]
+
+
+def _coroutine_of(frame):
+    # The innermost coroutine on a stack, the one that is blocking. The outermost is the
+    # server's task for the request (anyio's or uvicorn's), the same for every route.
+    while frame is not None:
+        code = frame.f_code
+        if code.co_flags & inspect.CO_COROUTINE:
+            return getattr(code, "co_qualname", code.co_name)
+        frame = frame.f_back
+    return None
+
+
+class SamplingProfiler:
+    ''' Samples the stack of every thread at a fixed interval.
+
+    Arguments:
+    interval = seconds between samples
+    '''
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = Counter()
+        self.count = 0
+        self.started = None
+        self.until = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds, interval=None):
+        if self.running:
+            raise RuntimeError("The sampling profiler is already running")
+        if interval is not None:
+            self.interval = interval
+        self.samples = Counter()
+        self.count = 0
+        self.started = time.time()
+        self.until = time.monotonic() + seconds
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stop.is_set() and time.monotonic() < self.until:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = [names.get(ident, str(ident))] + _stack(frame)
+                self.samples[";".join(stack)] += 1
+            self.count += 1
+            self._stop.wait(self.interval)
+
+    def collapsed(self):
+        ''' The samples so far as collapsed stacks, heaviest first. '''
+        return "".join("%s %d\n" % (stack, count) for stack, count in self.samples.most_common())
+
+    def status(self):
+        return {"running": self.running, "started": self.started, "samples": self.count,
+                "interval_ms": self.interval * 1000, "stacks": len(self.samples)}
+
+
+class RequestProfiler:
+    ''' cProfiles the next `count` requests to one route. Requests run on the event loop
+    alongside others, so whatever else the loop does meanwhile shows up too; only one
+    request is profiled at a time.
+    '''
+    def __init__(self):
+        self.method = None
+        self.path = None
+        self.pattern = None
+        self.remaining = 0
+        self.profiled = 0
+        self.stats = None
+        self._busy = False
+
+    def arm(self, method, path, count):
+        ''' Profiles the next `count` requests to the route `path`, a template like
+        /powerhorse/arm/{joint}/{power}.
+        '''
+        self.method = method.upper()
+        self.path = path
+        # the route a request went to is only known once it has run, the pattern picks out the candidates
+        self.pattern = re.compile("^%s$" % re.sub(r"\\\{[^/]*?\\\}", "[^/]+", re.escape(path)))
+        self.remaining = count
+        self.profiled = 0
+        self.stats = None
+
+    def wants(self, method, path):
+        return (self.remaining > 0 and not self._busy and method == self.method
+                and self.pattern.match(path) is not None)
+
+    def begin(self):
+        self._busy = True
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def end(self, profile, route):
+        ''' Keeps the profile if the request turned out to be for the armed route. '''
+        profile.disable()
+        self._busy = False
+        if self.remaining <= 0 or route != self.path:
+            return
+        self.remaining -= 1
+        self.profiled += 1
+        if self.stats is None:
+            self.stats = pstats.Stats(profile)
+        else:
+            self.stats.add(profile)
+
+    def report(self, sort="cumulative", limit=50):
+        if self.stats is None:
+            return ""
+        out = io.StringIO()
+        self.stats.stream = out
+        self.stats.sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+    def status(self):
+        return {"method": self.method, "route": self.path, "remaining": self.remaining, "profiled": self.profiled}
+
+
+class LoopLagMonitor:
+    ''' Reports whatever blocks an asyncio event loop for longer than `threshold` seconds.
+    A task on the loop beats at a quarter of the threshold, a watchdog thread takes the
+    loop thread's stack when the beat is late. The stall is put down to the innermost
+    coroutine on that stack, the route or task that blocked; nothing is asked of the
+    blocked loop from the watchdog thread.
+
+    Arguments:
+    threshold = seconds the loop may be blocked before it is reported
+    keep = number of stalls kept
+    '''
+    def __init__(self, threshold=0.05, keep=50):
+        self.threshold = threshold
+        self.stalls = deque(maxlen=keep)
+        self.max_lag = 0.0
+        self.beat = time.monotonic()
+        self._stall = None
+        self._loop_thread = None
+        self._task = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, loop):
+        # started again after a stop, e.g. by a test client running the app's startup twice
+        self._stop.clear()
+        self._stall = None
+        self._loop_thread = threading.get_ident()
+        self.beat = time.monotonic()
+        self._task = loop.create_task(self._beat())
+        self._thread = threading.Thread(target=self._watch, name="loop-lag", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+        if self._thread is not None:
+            self._thread.join()
+        self._task = None
+        self._thread = None
+
+    async def _beat(self):
+        while True:
+            interval = self.threshold / 4
+            expected = time.monotonic() + interval
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            lag = now - expected
+            self.max_lag = max(self.max_lag, lag)
+            stall = self._stall
+            if stall is not None:
+                # the loop is free again, now it's known how long it was held up
+                stall["blocked_ms"] = (now - stall["since"]) * 1000
+                self._stall = None
+            self.beat = now
+
+    def _watch(self):
+        while not self._stop.wait(self.threshold / 2):
+            late = time.monotonic() - self.beat
+            if late < self.threshold or self._stall is not None:
+                continue
+            frame = sys._current_frames().get(self._loop_thread)
+            stall = {
+                "at": time.time(),
+                "since": self.beat,
+                "blocked_ms": late * 1000,
+                "task": _coroutine_of(frame),
+                "stack": traceback.format_stack(frame) if frame is not None else [],
+            }
+            self._stall = stall
+            self.stalls.append(stall)
+
+    def report(self):
+        stalls = [{key: value for key, value in stall.items() if key != "since"} for stall in self.stalls]
+        return {"threshold_ms": self.threshold * 1000, "max_lag_ms": self.max_lag * 1000, "stalls": stalls}
+
+
+sampler = SamplingProfiler()
+requests = RequestProfiler()
+# The threshold can be set with POWERHORSE_LAG_THRESHOLD_MS
+loop_lag = LoopLagMonitor(float(os.environ.get("POWERHORSE_LAG_THRESHOLD_MS", "50")) / 1000)
@@ -0,0 +1,221 @@
+#!/usr/bin/python
+
+# Per-client rate limits for the actuator routes.
+# Every API client (the X-Client-Id header, or its address) gets a token bucket per
+# actuator and command, and a share of the robot's bus budget: the bus rate is split
+# evenly between the clients that have sent a command recently, so one client spamming
+# can only ever use its own share. A command over the limit isn't rejected, it waits
+# for a token; if a newer one for the same actuator and command arrives meanwhile the
+# waiting one is dropped (answered 202 "coalesced") so the latest value always wins.
+# Stops are never limited. Camera streams are limited to a number per client and are
+# refused with 429 over that.
+
+import asyncio
+import contextvars
+import time
+
+from powerhorse_scheduler import SAFETY
+
+# The client making the current request, set by ClientMiddleware
+current_client = contextvars.ContextVar("current_client", default=None)
+
+# Seconds a client refused a stream is told to wait before retrying
+STREAM_RETRY_AFTER = 5
+
+# Seconds a client is remembered for after its last command, for its stats
+FORGET = 60
+
+
+class Coalesced(Exception):
+    ''' A command was replaced by a newer one from the same client before it could be sent. '''
+
+
+class RateLimited(Exception):
+    ''' Refused outright, try again after `retry_after` seconds. '''
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "last")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = now
+
+    def delay(self, now):
+        ''' Seconds until a token is available, 0 if there is one now. '''
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class ClientLimits:
+    def __init__(self, share, now):
+        self.share = share
+        self.buckets = {}
+        # (actuator, op) -> future of the command waiting for a token
+        self.waiting = {}
+        self.streams = 0
+        self.last = now
+        self.admitted = 0
+        self.delayed = 0
+        self.coalesced = 0
+        self.refused_streams = 0
+
+    def stats(self):
+        return {"admitted": self.admitted, "delayed": self.delayed, "coalesced": self.coalesced,
+                "waiting": len(self.waiting), "streams": self.streams, "refused_streams": self.refused_streams,
+                "share": self.share.rate}
+
+
+class RateLimiter:
+    ''' The limits of one robot. Only used from the API's event loop.
+
+    Arguments:
+    config = the "limits" section of the robot config
+    '''
+    def __init__(self, config):
+        self.bus_rate = config["bus_rate"]
+        self.actuator_rate = config["actuator_rate"]
+        self.burst = config["burst"]
+        self.max_streams = config["streams"]
+        self.idle = config["idle"]
+        self.clients = {}
+        # the clients the bus is shared out between: those that have sent a command recently,
+        # or have one waiting or a stream open
+        self.active = set()
+        self._sweep_at = 0.0
+
+    def _client(self, client, now):
+        if now >= self._sweep_at:
+            self._sweep(now)
+        limits = self.clients.get(client)
+        if limits is None:
+            limits = self.clients[client] = ClientLimits(TokenBucket(self.bus_rate, self.burst, now), now)
+        limits.last = now
+        if client not in self.active:
+            self.active.add(client)
+            self._share()
+        return limits
+
+    def _share(self):
+        # shares the bus out again, only needed when the active clients change
+        rate = self.bus_rate / max(len(self.active), 1)
+        for client in self.active:
+            self.clients[client].share.rate = rate
+
+    def _sweep(self, now):
+        # Done once every `idle` seconds rather than on every command, so a client stops
+        # counting as active between `idle` and twice that after its last command.
+        # Clients gone for longer than FORGET are forgotten altogether.
+        self._sweep_at = now + self.idle
+        before = len(self.active)
+        for client, limits in list(self.clients.items()):
+            if limits.waiting or limits.streams or now - limits.last < self.idle:
+                continue
+            self.active.discard(client)
+            if now - limits.last > FORGET:
+                del self.clients[client]
+        if len(self.active) != before:
+            self._share()
+
+    async def admit(self, actuator, priority, op):
+        ''' Waits until the current client may send a command, raises Coalesced if a newer
+        one has replaced it in the meantime. Returns straight away for stops and for
+        commands not made through the API.
+        '''
+        client = current_client.get()
+        if client is None or priority == SAFETY:
+            return
+        now = time.monotonic()
+        limits = self._client(client, now)
+        key = (actuator, op)
+        bucket = limits.buckets.get(key)
+        if bucket is None:
+            bucket = limits.buckets[key] = TokenBucket(self.actuator_rate, self.burst, now)
+
+        previous = limits.waiting.get(key)
+        if previous is None and bucket.delay(now) == 0 and limits.share.delay(now) == 0:
+            bucket.take()
+            limits.share.take()
+            limits.admitted += 1
+            return
+        if previous is not None:
+            previous.set_result(None)
+            limits.coalesced += 1
+        replaced = asyncio.get_running_loop().create_future()
+        limits.waiting[key] = replaced
+        try:
+            while True:
+                now = time.monotonic()
+                delay = max(bucket.delay(now), limits.share.delay(now))
+                if delay == 0:
+                    bucket.take()
+                    limits.share.take()
+                    limits.delayed += 1
+                    return
+                await asyncio.wait([replaced], timeout=delay)
+                if replaced.done():
+                    raise Coalesced("%s %s was replaced by a newer command" % (actuator, op))
+        finally:
+            if limits.waiting.get(key) is replaced:
+                del limits.waiting[key]
+
+    def open_stream(self):
+        ''' Takes one of the current client's stream slots, returns the function that gives it back. '''
+        client = current_client.get()
+        limits = self._client(client, time.monotonic())
+        if limits.streams >= self.max_streams:
+            limits.refused_streams += 1
+            raise RateLimited("%s already has %d streams open" % (client, limits.streams), STREAM_RETRY_AFTER)
+        limits.streams += 1
+        def close():
+            limits.streams -= 1
+        return close
+
+    def stats(self):
+        self._sweep(time.monotonic())
+        clients = {client: limits.stats() for client, limits in self.clients.items()}
+        totals = {name: sum(stats[name] for stats in clients.values())
+                  for name in ("admitted", "delayed", "coalesced", "refused_streams")}
+        return {"bus_rate": self.bus_rate, "actuator_rate": self.actuator_rate, "burst": self.burst,
+                "streams": self.max_streams, "active": len(self.active), "totals": totals, "clients": clients}
+
+
+async def limited_stream(stream, close):
+    ''' Passes a streaming body through, giving its stream slot back when it ends. '''
+    try:
+        async for chunk in stream:
+            yield chunk
+    finally:
+        close()
+
+
+def client_of(scope):
+    for name, value in scope["headers"]:
+        if name == b"x-client-id":
+            return value.decode("latin-1")
+    client = scope.get("client")
+    return client[0] if client else "unknown"
+
+
+class ClientMiddleware:
+    # Makes the client of each request known to the rate limiter
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            return await self.app(scope, receive, send)
+        token = current_client.set(client_of(scope))
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_client.reset(token)
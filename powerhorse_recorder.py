@@ -0,0 +1,138 @@
+#!/usr/bin/python
+
+# Flight recorder for the PowerHorse.
+# Every actuator command is appended as a fixed-size binary record to a ring file
+# that is memory-mapped, so recording is a struct.pack_into and nothing more. The
+# pages belong to the kernel, so the log survives the API crashing; flush() (called
+# on shutdown) also gets it to disk in case the Pi loses power.
+#
+# Reading a recording:
+#   python powerhorse_recorder.py /var/lib/powerhorse/default.rec --actuator tracks --last 50
+
+import argparse
+import datetime
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+
+MAGIC = b"PHFR"
+VERSION = 1
+# magic, version, record size, capacity, records written so far
+HEADER = struct.Struct("<4sHHIQ")
+HEADER_SIZE = 64
+# sequence, time, source, actuator, op, 4 values, left/only duty, right duty
+RECORD = struct.Struct("<IdBBBx4f2f")
+
+# Codes are stored in the records, only ever append to these
+SOURCES = ("other", "api", "udp", "console", "estimator", "safety", "trajectory", "sim", "lease")
+ACTUATORS = ("all", "tracks", "shoulder", "elbow", "wrist", "gripper", "camera", "light")
+OPS = ("stop", "set_tracks", "set_arm", "stop_arm", "set_camera", "set_light", "set_camera_tilt",
+       "set_light_brightness", "set_light_pattern", "play_trajectory")
+
+SOURCE_CODES = {name: code for code, name in enumerate(SOURCES)}
+ACTUATOR_CODES = {name: code for code, name in enumerate(ACTUATORS)}
+OP_CODES = {name: code for code, name in enumerate(OPS)}
+
+
+class FlightRecorder:
+    ''' Appends command records to a memory-mapped ring file.
+
+    Arguments:
+    path = file to record into, reopened and appended to if it already holds a recording
+    capacity = number of records kept before the oldest are overwritten
+    '''
+    def __init__(self, path, capacity=100000):
+        self.path = path
+        size = HEADER_SIZE + capacity * RECORD.size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fresh = os.fstat(fd).st_size != size
+            if fresh:
+                os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        magic, version, record_size, existing, head = HEADER.unpack_from(self.map, 0)
+        if fresh or (magic, version, record_size, existing) != (MAGIC, VERSION, RECORD.size, capacity):
+            head = 0
+            HEADER.pack_into(self.map, 0, MAGIC, VERSION, RECORD.size, capacity, head)
+        self.capacity = capacity
+        self.head = head
+        self._lock = threading.Lock()
+
+    def record(self, source, actuator, op, values=(), duty=(0.0, 0.0)):
+        ''' Appends one record. `values` are up to four command arguments. '''
+        values = tuple(values) + (0.0,) * (4 - len(values))
+        with self._lock:
+            head = self.head
+            RECORD.pack_into(self.map, HEADER_SIZE + (head % self.capacity) * RECORD.size,
+                             head & 0xFFFFFFFF, time.time(), SOURCE_CODES.get(source, 0),
+                             ACTUATOR_CODES[actuator], OP_CODES[op], *values, *duty)
+            # the count is only moved on once the record is complete, a torn write is never read back
+            self.head = head + 1
+            struct.pack_into("<Q", self.map, 12, self.head)
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+
+
+def read_records(path):
+    ''' Yields the records of a recording as dicts, oldest first. '''
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, version, record_size, capacity, head = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+        raise ValueError("%s is not a PowerHorse flight recording" % path)
+    for index in range(max(0, head - capacity), head):
+        seq, timestamp, source, actuator, op, *rest = RECORD.unpack_from(data, HEADER_SIZE + (index % capacity) * record_size)
+        if seq != index & 0xFFFFFFFF:
+            continue
+        yield {
+            "index": index,
+            "time": timestamp,
+            "source": SOURCES[source] if source < len(SOURCES) else str(source),
+            "actuator": ACTUATORS[actuator] if actuator < len(ACTUATORS) else str(actuator),
+            "op": OPS[op] if op < len(OPS) else str(op),
+            "values": rest[:4],
+            "duty": rest[4:],
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Decode a PowerHorse flight recording")
+    parser.add_argument("path")
+    parser.add_argument("--actuator", action="append", help="only this actuator, may be repeated")
+    parser.add_argument("--source", action="append", help="only commands from this source, may be repeated")
+    parser.add_argument("--op", action="append", help="only this command, may be repeated")
+    parser.add_argument("--since", type=float, help="only the last SINCE seconds")
+    parser.add_argument("--last", type=int, help="only the last LAST matching records")
+    parser.add_argument("--json", action="store_true", help="one JSON object per line")
+    args = parser.parse_args(argv)
+
+    since = time.time() - args.since if args.since is not None else None
+    records = [record for record in read_records(args.path)
+               if (not args.actuator or record["actuator"] in args.actuator)
+               and (not args.source or record["source"] in args.source)
+               and (not args.op or record["op"] in args.op)
+               and (since is None or record["time"] >= since)]
+    if args.last is not None:
+        records = records[-args.last:]
+    for record in records:
+        if args.json:
+            print(json.dumps(record))
+        else:
+            when = datetime.datetime.fromtimestamp(record["time"]).isoformat(timespec="milliseconds")
+            values = " ".join("%g" % value for value in record["values"])
+            duty = " ".join("%g" % value for value in record["duty"])
+            print("%s %-7s %-8s %-10s values=[%s] duty=[%s]" % (when, record["source"], record["actuator"], record["op"], values, duty))
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,186 @@
+#!/usr/bin/python
+
+# Registry of the robots controlled by one API process.
+# Each robot has its own PCA9685, motors and sensors, and its own actuator
+# scheduler thread so that a slow I2C bus on one robot never holds up another.
+
+import copy
+import json
+import os
+import time
+
+from powerhorse_robot import PowerHorse, DEFAULT_CONFIG
+from powerhorse_scheduler import ActuatorScheduler
+from powerhorse_camera_stream import CameraStream, make_source
+from powerhorse_recorder import FlightRecorder
+from powerhorse_loop import ControlLoop
+from powerhorse_estimator import Estimator
+from powerhorse_ratelimit import RateLimiter, current_client
+from powerhorse_safety import SafetyMonitor
+from powerhorse_lease import LeaseKeeper
+
+
+def merge_config(config, defaults=DEFAULT_CONFIG):
+    ''' Returns a copy of `defaults` with `config` laid over it, recursively. '''
+    merged = copy.deepcopy(defaults)
+    for key, value in config.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_config(value, merged[key])
+        else:
+            merged[key] = value
+    # addresses in JSON may be written as "0x40"
+    if isinstance(merged.get("address"), str):
+        merged["address"] = int(merged["address"], 0)
+    return merged
+
+
+class Robot:
+    ''' One PowerHorse together with its config and actuator scheduler. '''
+    # see powerhorse_shm.RemoteRobot
+    remote = False
+    powerhorse_class = PowerHorse
+    # the Simulator stepping a powerhorse_sim.SimRobot
+    simulator = None
+
+    def __init__(self, robot_id, config):
+        self.id = robot_id
+        self.config = merge_config(config)
+        self.powerhorse = self.powerhorse_class(self.config)
+        recorder = self.config["recorder"]
+        if recorder["path"]:
+            self.powerhorse.recorder = FlightRecorder(recorder["path"] % {"robot": robot_id}, recorder["capacity"])
+        self.scheduler = ActuatorScheduler(self.powerhorse, robot_id)
+        camera = self.config["camera"]
+        self.camera_stream = CameraStream(make_source(camera))
+        # started with the API when a UDP port is configured
+        self.udp = None
+        self.estimator = Estimator(self.powerhorse, self.scheduler, self.config["estimator"])
+        self.loop = ControlLoop(robot_id)
+        self.loop.add(self.estimator.tick)
+        self.lights = self.powerhorse.lights
+        self.loop.add(self.lights.tick)
+        self.safety = SafetyMonitor(self.powerhorse, self.scheduler, self.config["safety"])
+        self.sensor_loop = ControlLoop("%s-sensors" % robot_id, self.config["safety"]["rate"])
+        self.sensor_loop.add(self.safety.tick)
+        # servos take a new pulse width once per PWM period, there's no point going faster
+        self.servos = self.powerhorse.camera_servos
+        self.servo_loop = ControlLoop("%s-servos" % robot_id, self.config["pca9685"]["freq"])
+        self.servo_loop.add(self.servos.tick)
+        self.limiter = RateLimiter(self.config["limits"])
+        self.leases = LeaseKeeper(self.scheduler, self.config["leases"], robot_id, self.clock)
+        self.start()
+
+    def loops(self):
+        ''' The control loops that have something to do. '''
+        loops = [self.loop]
+        if self.powerhorse.sensors:
+            loops.append(self.sensor_loop)
+        if self.servos.servos:
+            loops.append(self.servo_loop)
+        return loops
+
+    def clock(self):
+        ''' The robot's time in seconds, powerhorse_sim.SimRobot keeps a virtual one. '''
+        return time.monotonic()
+
+    def start(self):
+        # each loop on a thread of its own, powerhorse_sim.SimRobot steps them on a virtual clock instead
+        for loop in self.loops():
+            loop.start()
+        self.leases.start()
+
+    async def command(self, actuator, priority, op, *args, source="api", ttl=None):
+        ''' Runs a PowerHorse method through the scheduler, see ActuatorScheduler.submit.
+        Commands from API clients are rate limited first, see RateLimiter.admit.
+        A motion command with a `ttl` leases its actuator to the client, see LeaseKeeper.update.
+        '''
+        await self.limiter.admit(actuator, priority, op)
+        result = await self.scheduler.run(actuator, priority, op, *args, source=source)
+        self.leases.update(actuator, current_client.get(), ttl)
+        return result
+
+    async def heartbeat(self, holder):
+        ''' Renews every lease `holder` holds, returns how many, see LeaseKeeper.heartbeat. '''
+        return self.leases.heartbeat(holder)
+
+    def close(self):
+        self.servo_loop.stop()
+        self.sensor_loop.stop()
+        self.loop.stop()
+        if self.udp is not None:
+            self.udp.transport.close()
+        self.leases.close()
+        self.scheduler.close()
+        if self.powerhorse.recorder is not None:
+            self.powerhorse.recorder.close()
+
+
+class RobotRegistry:
+    ''' The robots served by the API, keyed by robot id.
+    The first robot added is the default one, served under /powerhorse.
+    '''
+    def __init__(self, robot_class=Robot):
+        self.robots = {}
+        self.default_id = None
+        self.robot_class = robot_class
+
+    def add(self, robot_id, config=None):
+        if robot_id in self.robots:
+            raise ValueError("Robot %r is already registered" % robot_id)
+        config = config or {}
+        robot_class = self.robot_class
+        if robot_class is Robot and config.get("sim", {}).get("enabled"):
+            from powerhorse_sim import SimRobot
+            robot_class = SimRobot
+        robot = robot_class(robot_id, config)
+        self.robots[robot_id] = robot
+        if self.default_id is None:
+            self.default_id = robot_id
+        return robot
+
+    def get(self, robot_id):
+        return self.robots.get(robot_id)
+
+    @property
+    def default(self):
+        return self.robots[self.default_id]
+
+    def ids(self):
+        return list(self.robots)
+
+    def close(self):
+        for robot in self.robots.values():
+            robot.close()
+
+    @classmethod
+    def load(cls, path, robot_class=Robot):
+        ''' Builds a registry from a JSON file of the form
+        {"robots": {"alpha": {"pca9685": {"address": "0x40"}}, "beta": {...}}}
+        '''
+        with open(path) as f:
+            robots = json.load(f)["robots"]
+        registry = cls(robot_class)
+        for robot_id, config in robots.items():
+            registry.add(robot_id, config)
+        return registry
+
+    @classmethod
+    def from_env(cls):
+        ''' Loads the file named by POWERHORSE_ROBOTS, or a single "default" robot.
+        With POWERHORSE_SHM=1 the robots are the ones of a running hardware-owner
+        process (python powerhorse_shm.py) instead of being driven from this one.
+        With POWERHORSE_SIM=1 every robot is simulated, see powerhorse_sim.py.
+        '''
+        robot_class = Robot
+        if os.environ.get("POWERHORSE_SHM", "0") not in ("", "0"):
+            from powerhorse_shm import RemoteRobot
+            robot_class = RemoteRobot
+        elif os.environ.get("POWERHORSE_SIM", "0") not in ("", "0"):
+            from powerhorse_sim import SimRobot
+            robot_class = SimRobot
+        path = os.environ.get("POWERHORSE_ROBOTS")
+        if path:
+            return cls.load(path, robot_class)
+        registry = cls(robot_class)
+        registry.add("default")
+        return registry
@@ -0,0 +1,347 @@
+#!/usr/bin/python
+
+from powerhorse_arm_motor_control import Motor, LinkedMotors, Arrow, Sensor
+from powerhorse_state import StateSnapshot
+from powerhorse_scheduler import current_source
+from powerhorse_trace import tracer
+from powerhorse_servo import CameraServos
+from powerhorse_lights import Lights, PATTERNS
+from powerhorse_config import JOINTS, TRACK_ROLES, compile_layout
+from PCA9685 import PCA9685
+
+Dir = [
+    'forward',
+    'backward',
+]
+
+# Rate in Hz of the control loop, the fastest anything is sent to the actuators
+CONTROL_RATE = 20
+
+# Configuration of a single robot, anything missing from a robot's own config
+# is filled in from here (see powerhorse_registry.merge_config)
+DEFAULT_CONFIG = {
+    "pca9685": {"bus": 1, "address": 0x40, "freq": 50},
+    # GPIO pins of the motor shield (see powerhorse_config.py), BCM numbers or "BOARDnn" header pins.
+    # Each motor lights its own arrow, an arm joint may name another to light as well.
+    "motor_shield": {
+        "motors": {
+            "MOTOR1": {"enable": "BOARD11", "forward": "BOARD15", "reverse": "BOARD13", "arrow": 4},
+            "MOTOR2": {"enable": "BOARD22", "forward": "BOARD16", "reverse": "BOARD18", "arrow": 3},
+            "MOTOR3": {"enable": "BOARD19", "forward": "BOARD21", "reverse": "BOARD23", "arrow": 2},
+            "MOTOR4": {"enable": "BOARD32", "forward": "BOARD24", "reverse": "BOARD26", "arrow": 1},
+        },
+        "arrows": {"1": "BOARD33", "2": "BOARD35", "3": "BOARD37", "4": "BOARD36"},
+        "sensors": {
+            "IR1": {"echo": "BOARD7"},
+            "IR2": {"echo": "BOARD12"},
+            "ULTRASONIC": {"trigger": "BOARD29", "echo": "BOARD31"},
+        },
+    },
+    # PCA9685 channels of the track motor driver
+    "track_channels": {"left": {"pwm": 0, "in1": 1, "in2": 2}, "right": {"pwm": 5, "in1": 3, "in2": 4}},
+    "arm": {
+        "shoulder": {"motor": "MOTOR1", "config": 1, "arrow": 1},
+        "elbow": {"motor": "MOTOR2", "config": 1, "arrow": 2},
+        "wrist": {"motor": "MOTOR3", "config": 1, "arrow": 3},
+        "gripper": {"motor": "MOTOR4", "config": 1, "arrow": 4},
+    },
+    # e.g. {"front": {"type": "ULTRASONIC", "boundary": 20}}
+    "sensors": {},
+    # source is a V4L2 device or "test" for a synthetic test pattern
+    "camera": {"source": "/dev/video0", "width": 640, "height": 480, "fps": 15, "quality": 80},
+    # UDP teleop listener (see powerhorse_udp.py), off unless a port is given
+    "udp": {"host": "0.0.0.0", "port": None, "echo_interval": 0.1},
+    # flight recorder ring file (see powerhorse_recorder.py), off unless given a path,
+    # e.g. "/var/lib/powerhorse/%(robot)s.rec"
+    "recorder": {"path": None, "capacity": 100000},
+    # dead-reckoning calibration (see powerhorse_estimator.py): joint speed in degrees a second
+    # at full duty, track speed in metres a second at full duty, deadbands in % duty
+    "estimator": {
+        "joints": {
+            "shoulder": {"speed": 30, "deadband": 15, "min": -90, "max": 90},
+            "elbow": {"speed": 40, "deadband": 15, "min": -120, "max": 120},
+            "wrist": {"speed": 60, "deadband": 10, "min": -90, "max": 90},
+            "gripper": {"speed": 50, "deadband": 10, "min": 0, "max": 60},
+        },
+        "tracks": {"speed": 0.4, "deadband": 20, "width": 0.25},
+        "tolerance": 1.0,
+    },
+    # per-client limits on the PUT routes (see powerhorse_ratelimit.py): commands a second the bus
+    # is shared out from, commands a second per actuator and client, burst size, camera streams per client
+    "limits": {"bus_rate": 200, "actuator_rate": CONTROL_RATE, "burst": 5, "streams": 2, "idle": 2.0},
+    # sensor safety rules (see powerhorse_safety.py), e.g.
+    # [{"sensor": "front", "action": "stop"}, {"sensor": "front", "action": "cap", "near": 10, "far": 60}]
+    "safety": {"rate": 100, "rules": []},
+    # camera servos on spare PCA9685 channels (see powerhorse_servo.py), None where not fitted, e.g.
+    # "pan": {"channel": 14, "min_pulse_us": 500, "max_pulse_us": 2500, "min_angle": -90, "max_angle": 90, "speed": 120}
+    "camera_servos": {"pan": None, "tilt": None},
+    # PCA9685 channels driving the lights (see powerhorse_lights.py)
+    "lights": {"channels": []},
+    # command leases (see powerhorse_lease.py): seconds a motion command from an API client is leased for
+    # when it doesn't give a ?ttl= (None for no lease), the longest lease allowed, and the lease of UDP
+    # setpoints, which every frame renews (None for none)
+    "leases": {"ttl": None, "max": 30, "udp": 1.0},
+    # simulation (see powerhorse_sim.py): speed is virtual seconds per wall second (0 as fast as
+    # possible), motor_lag the tracks' time constant in seconds, slip the fraction of track speed lost,
+    # arena [xmin, ymin, xmax, ymax] and obstacles [{"x", "y", "r"}] in metres, sensors where each sensor
+    # points, e.g. {"front": {"angle": 0}} in degrees from straight ahead, range and noise in cm
+    "sim": {"enabled": False, "speed": 1.0, "motor_lag": 0.15, "slip": 0.0, "arena": [-5, -5, 5, 5],
+            "obstacles": [], "sensors": {}, "range": 400, "noise": 0.0, "seed": 0, "radius": 0.2},
+}
+
+def mix_tracks(throttle, differential):
+    ''' Mixes a throttle and differential (-100 to 100) into whether the tracks go forward
+    and the left and right track speeds (0 to 100). powerhorse_trajectory.mix_tracks_array does the same over
+    whole routes and has to be kept in step with this.
+    '''
+    # Ensure throttle and differential are within the range of -100 to 100
+    throttle = max(min(throttle, 100), -100)
+    differential = max(min(differential, 100), -100)
+
+    # Determine direction based on the sign of the throttle
+    forward = throttle >= 0
+
+    # Calculate motor speeds based on throttle and differential values
+    abs_throttle = abs(throttle)
+    if differential == 0:
+        motor_left_speed = abs_throttle
+        motor_right_speed = abs_throttle
+    elif 0 < differential <= 50:
+        motor_left_speed = abs_throttle * (1 - differential / 50)
+        motor_right_speed = abs_throttle
+    elif differential > 50:
+        motor_left_speed = abs_throttle * ((differential - 50) / 50)
+        motor_right_speed = abs_throttle
+    elif -50 <= differential < 0:
+        motor_left_speed = abs_throttle
+        motor_right_speed = abs_throttle * (1 + differential / 50)
+    else:  # differential < -50
+        motor_left_speed = abs_throttle
+        motor_right_speed = abs_throttle * ((-differential - 50) / 50)
+
+    # Ensure motor speeds are within the range of 0 to 100
+    motor_left_speed = max(min(motor_left_speed, 100), 0)
+    motor_right_speed = max(min(motor_right_speed, 100), 0)
+
+    return forward, motor_left_speed, motor_right_speed
+
+
+class MotorDriver():
+    def __init__(self, pwm, channels=(0, 1, 2, 5, 3, 4)):
+        self.pwm = pwm
+        # PCA9685 channels in powerhorse_config.TRACK_ROLES order
+        self.channels = tuple(channels)
+        self.PWMA, self.AIN1, self.AIN2, self.PWMB, self.BIN1, self.BIN2 = self.channels
+        # by motor index, so running a motor needs no branching on which one it is
+        self.speed_channels = (self.PWMA, self.PWMB)
+        self.input_channels = ((self.AIN1, self.AIN2), (self.BIN1, self.BIN2))
+
+    def MotorRun(self, motor, index, speed):
+        if speed > 100:
+            return
+        self.run(motor, index == Dir[0], speed)
+
+    @tracer.traced("MotorDriver.run")
+    def run(self, motor, forward, speed):
+        in1, in2 = self.input_channels[motor]
+        self.pwm.setDutycycle(self.speed_channels[motor], speed)
+        self.pwm.setLevel(in1, 0 if forward else 1)
+        self.pwm.setLevel(in2, 1 if forward else 0)
+
+    def MotorStop(self, motor):
+        self.pwm.setDutycycle(self.speed_channels[motor], 0)
+
+
+
+class PowerHorse:
+    # the hardware classes, powerhorse_sim.SimPowerHorse swaps them for simulated ones
+    pwm_class = PCA9685
+    motor_class = Motor
+    arrow_class = Arrow
+    sensor_class = Sensor
+
+    def __init__(self, config=DEFAULT_CONFIG):
+        self.config = config
+        # checked before any pin is touched, raises powerhorse_config.ConfigError
+        self.layout = layout = compile_layout(config)
+
+        pca = config["pca9685"]
+        self.pwm = self.pwm_class(pca["address"], debug=False, bus=pca["bus"])
+        self.pwm.setPWMFreq(pca["freq"])
+
+        arrows = {arrow_id: self.arrow_class(int(arrow_id), pin) for arrow_id, pin in layout.arrows.items()}
+        # the arm joints in JOINTS order, each slot holding its joint's motor and arrow
+        self.joints = layout.joints
+        self.joint_index = layout.joint_index
+        for slot in self.joints:
+            slot.arrow = arrows[slot.arrow_id]
+            slot.motor = self.motor_class(slot.motor_label, None, pins=slot.pins, arrow=arrows[layout.motor_arrows[slot.motor_label]])
+        self.arm_motors = {slot.name: slot.motor for slot in self.joints}
+        self.arm_arrows = {slot.name: slot.arrow for slot in self.joints}
+        self.arm_all = LinkedMotors(*[slot.motor for slot in self.joints])
+
+        self.track_motors = MotorDriver(self.pwm, layout.track_channels)
+        self.camera_servos = CameraServos(self.pwm, pca["freq"], config["camera_servos"])
+        self.lights = Lights(self.pwm, config["lights"], CONTROL_RATE)
+
+        self.sensors = {}
+        for name, sensor in config["sensors"].items():
+            self.sensors[name] = self.sensor_class(sensor["type"], sensor["boundary"], layout.sensors[name][1])
+
+        self.light = False
+        self.light_brightness = 100
+        self.light_pattern = "solid"
+        self.arm = {"shoulder": 0, "elbow": 0, "wrist": 0, "gripper": 0}
+        # the same powers by joint index, for whatever reads them every tick
+        self.arm_power = [0] * len(JOINTS)
+        self.camera_angle = 0
+        self.camera_tilt = 0
+        self.tracks = {"throttle": 0, "differential": 0}
+        # signed duty last written to the left and right tracks, negative is backward
+        self.track_duty = (0.0, 0.0)
+        # lowest and highest throttle allowed, narrowed by the safety rules
+        self.throttle_limits = (-100, 100)
+        self.snapshot = StateSnapshot(self)
+        self.recorder = None
+        # TrackPlayer of the route being played, see powerhorse_trajectory.py
+        self.trajectory = None
+
+    def _record(self, actuator, op, values=(), duty=(0.0, 0.0)):
+        if self.recorder is not None:
+            self.recorder.record(current_source.get(), actuator, op, values, duty)
+
+    def set_light(self, state: bool):
+        self.lights.set(on=state)
+        if self.light != state:
+            self.light = state
+            self.snapshot.mark_changed("light")
+        self._record("light", "set_light", (state,), (self.light_brightness / 100 if state else 0.0, 0.0))
+
+    def set_light_brightness(self, level: float):
+        # 0 to 100, turns the light on unless 0
+        level = max(min(int(round(level)), 100), 0)
+        self.lights.set(on=level > 0, brightness=level)
+        if self.light_brightness != level or self.light != (level > 0):
+            self.light_brightness = level
+            self.light = level > 0
+            self.snapshot.mark_changed("light")
+        self._record("light", "set_light_brightness", (level,), (level / 100, 0.0))
+
+    def set_light_pattern(self, pattern: str):
+        # one of PATTERNS, turns the light on
+        self.lights.set(on=True, pattern=pattern)
+        if self.light_pattern != pattern or not self.light:
+            self.light_pattern = pattern
+            self.light = True
+            self.snapshot.mark_changed("light")
+        self._record("light", "set_light_pattern", (PATTERNS.index(pattern),), (self.light_brightness / 100, 0.0))
+
+    def toggle_light(self):
+        self.set_light(not self.light)
+        return self.light
+
+    def set_tracks(self, throttle: float, differential: float):
+        # any other command to the tracks ends a route being played
+        self.stop_trajectory()
+        low, high = self.throttle_limits
+        throttle = max(min(throttle, high), low)
+        if self.tracks["throttle"] != throttle or self.tracks["differential"] != differential:
+            self.tracks["throttle"] = throttle
+            self.tracks["differential"] = differential
+            self.snapshot.mark_changed("tracks")
+
+        forward, motor_left_speed, motor_right_speed = mix_tracks(throttle, differential)
+
+        self.track_motors.run(0, forward, motor_left_speed)
+        self.track_motors.run(1, forward, motor_right_speed)
+
+        sign = 1 if forward else -1
+        self.track_duty = (sign * motor_left_speed, sign * motor_right_speed)
+        self._record("tracks", "set_tracks", (throttle, differential), self.track_duty)
+
+        return dict(self.tracks)
+
+    def play_trajectory(self, plan):
+        # plays a compiled route (a powerhorse_trajectory.TrackPlan) on the tracks
+        low, high = self.throttle_limits
+        summary = plan.summary()
+        if summary["throttle"][0] < low or summary["throttle"][1] > high:
+            raise ValueError("The route needs a throttle of %g to %g, the tracks are limited to %g to %g"
+                             % (summary["throttle"][0], summary["throttle"][1], low, high))
+        player = plan.player(self)
+        self.stop_trajectory()
+        self._record("tracks", "play_trajectory", (plan.ticks, plan.rate))
+        self.trajectory = player
+        player.start()
+        return summary
+
+    def stop_trajectory(self):
+        if self.trajectory is not None:
+            self.trajectory.stop()
+            self.trajectory = None
+
+    # Single-axis updates read the other axis when they run rather than when they
+    # were requested, so queued commands never work from a stale value
+    def set_throttle(self, throttle: float):
+        return self.set_tracks(throttle, self.tracks["differential"])
+
+    def set_differential(self, differential: float):
+        return self.set_tracks(self.tracks["throttle"], differential)
+
+
+    def set_arm(self, joint: str, power: float):
+        self._drive_joint(self.joints[self.joint_index[joint]], power)
+
+    def _drive_joint(self, slot, power):
+        if self.arm_power[slot.index] != power:
+            self.arm_power[slot.index] = power
+            self.arm[slot.name] = power
+            self.snapshot.mark_changed("arm")
+        self._record(slot.name, "set_arm", (power,), (power, 0.0))
+        slot.arrow.on()
+        if power > 0:
+            slot.motor.forward(power)
+        elif power < 0:
+            slot.motor.reverse(-power)
+        else:
+            slot.motor.stop()
+
+    def stop_arm(self, joint: str):
+        slot = self.joints[self.joint_index[joint]]
+        if self.arm_power[slot.index] != 0:
+            self.arm_power[slot.index] = 0
+            self.arm[joint] = 0
+            self.snapshot.mark_changed("arm")
+        self._record(joint, "stop_arm")
+        slot.arrow.off()
+        slot.motor.stop()
+
+
+    def stop_arms(self):
+        for slot in self.joints:
+            self._drive_joint(slot, 0)
+        return dict(self.arm)
+
+    def set_camera(self, angle: int):
+        # the pan servo gets there in its own time, see CameraServos
+        angle = self.camera_servos.move_to("pan", angle)
+        if self.camera_angle != angle:
+            self.camera_angle = angle
+            self.snapshot.mark_changed("camera")
+        self._record("camera", "set_camera", (angle,))
+
+    def set_camera_tilt(self, angle: int):
+        angle = self.camera_servos.move_to("tilt", angle)
+        if self.camera_tilt != angle:
+            self.camera_tilt = angle
+            self.snapshot.mark_changed("camera")
+        self._record("camera", "set_camera_tilt", (angle,))
+
+    def stop(self):
+        # Emergency stop: everything off and back to rest
+        self._record("all", "stop")
+        self.set_tracks(0, 0)
+        self.stop_arms()
+        self.set_light(False)
+        self.set_camera(0)
+        self.set_camera_tilt(0)
@@ -0,0 +1,118 @@
+#!/usr/bin/python
+
+# Sensor safety rules.
+# The robot's sensors are read on a loop of their own (the ultrasonic sensor blocks
+# for its echo, so it's kept off the control loop) and the rules bound to a sensor
+# are evaluated straight after each of its readings. Rules narrow the throttle the
+# tracks accept:
+#   {"sensor": "front", "action": "stop"}                        no forward throttle while triggered
+#   {"sensor": "front", "action": "cap", "near": 10, "far": 60}  forward throttle capped from 0 at
+#                                                                `near` cm to 100 at `far` cm
+# with "direction": "backward" for sensors at the back. When the tracks are already going
+# faster than allowed they are slowed with a safety command straight from the sensor
+# thread, with no client round trip involved.
+
+import threading
+import time
+
+from powerhorse_scheduler import SAFETY
+
+ACTIONS = ("stop", "cap")
+DIRECTIONS = ("forward", "backward")
+
+
+class SafetyMonitor:
+    ''' Reads the sensors of a PowerHorse and applies the safety rules to its tracks.
+
+    Arguments:
+    powerhorse = the PowerHorse whose sensors are read and tracks limited
+    scheduler = its scheduler, the tracks are slowed through it
+    config = the "safety" section of the robot config
+    '''
+    def __init__(self, powerhorse, scheduler, config):
+        self.powerhorse = powerhorse
+        self.scheduler = scheduler
+        self.rules = []
+        for rule in config["rules"]:
+            rule = dict(rule)
+            rule.setdefault("direction", "forward")
+            sensor = powerhorse.sensors.get(rule["sensor"])
+            if sensor is None:
+                raise ValueError("Safety rule for unknown sensor %r" % rule["sensor"])
+            if rule["action"] not in ACTIONS or rule["direction"] not in DIRECTIONS:
+                raise ValueError("Safety rule %r: action must be one of %s and direction one of %s" % (rule, ACTIONS, DIRECTIONS))
+            if rule["action"] == "cap" and sensor.sensortype != "ULTRASONIC":
+                raise ValueError("Safety rule %r: only the ultrasonic sensor measures distance" % rule)
+            # throttle currently allowed by the rule, in its direction
+            rule["limit"] = 100
+            self.rules.append(rule)
+        self.next_read = dict.fromkeys(powerhorse.sensors, 0.0)
+        self.readings = 0
+        self.trips = 0
+        self.latencies = []
+        self.latency_total = 0.0
+        self.latency_count = 0
+        self._lock = threading.Lock()
+
+    def tick(self, now):
+        for name, sensor in self.powerhorse.sensors.items():
+            if now < self.next_read[name]:
+                continue
+            self.next_read[name] = now + sensor.interval
+            sensor.trigger()
+            self.readings += 1
+            self.evaluate(name, sensor, time.perf_counter())
+
+    def evaluate(self, name, sensor, read_at):
+        ''' Applies the rules of sensor `name` to the reading it has just taken at `read_at`. '''
+        for rule in self.rules:
+            if rule["sensor"] != name:
+                continue
+            if rule["action"] == "stop":
+                rule["limit"] = 0 if sensor.Triggered else 100
+            else:
+                near, far = rule["near"], rule["far"]
+                rule["limit"] = 100 * max(min((sensor.lastRead - near) / (far - near), 1.0), 0.0)
+        forward = min([rule["limit"] for rule in self.rules if rule["direction"] == "forward"], default=100)
+        backward = min([rule["limit"] for rule in self.rules if rule["direction"] == "backward"], default=100)
+        limits = (-backward, forward)
+        powerhorse = self.powerhorse
+        if limits == powerhorse.throttle_limits:
+            return
+        # new commands are held to the limits from here on, the one running now gets slowed below
+        powerhorse.throttle_limits = limits
+        throttle = powerhorse.tracks["throttle"]
+        if -backward <= throttle <= forward:
+            return
+        self.trips += 1
+        future = self.scheduler.submit("tracks", SAFETY, "set_throttle", max(min(throttle, forward), -backward),
+                                       source="safety")
+        future.add_done_callback(lambda future: self._applied(read_at))
+
+    def _applied(self, read_at):
+        latency = time.perf_counter() - read_at
+        with self._lock:
+            self.latencies = (self.latencies + [latency])[-100:]
+            self.latency_total += latency
+            self.latency_count += 1
+
+    def stats(self):
+        with self._lock:
+            latencies = list(self.latencies)
+            mean = self.latency_total / self.latency_count if self.latency_count else 0.0
+        sensors = {}
+        for name, sensor in self.powerhorse.sensors.items():
+            distance = sensor.lastRead if sensor.sensortype == "ULTRASONIC" else None
+            sensors[name] = {"type": sensor.sensortype, "triggered": sensor.Triggered,
+                             "distance": distance if distance != float("inf") else None}
+        low, high = self.powerhorse.throttle_limits
+        return {
+            "rules": self.rules,
+            "sensors": sensors,
+            "throttle_limits": {"backward": -low, "forward": high},
+            "readings": self.readings,
+            "trips": self.trips,
+            # from the reading that tripped a rule to the slowed throttle being applied
+            "latency_ms": {"last": latencies[-1] * 1000 if latencies else None, "mean": mean * 1000,
+                           "max": max(latencies) * 1000 if latencies else None},
+        }
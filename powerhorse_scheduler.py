@@ -0,0 +1,241 @@
+#!/usr/bin/python
+
+# Single-writer actuator scheduler.
+# All hardware commands for a robot go through one thread that always runs the
+# most urgent pending command first. Commands are named PowerHorse methods
+# ("set_tracks", "set_arm", ...) so they can be coalesced, counted and, later on,
+# sent across process boundaries.
+
+import asyncio
+import contextvars
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+from powerhorse_trace import tracer
+
+# Priority classes, lower runs first
+SAFETY = 0
+MOTION = 1
+COSMETIC = 2
+PRIORITY_NAMES = {SAFETY: "safety", MOTION: "motion", COSMETIC: "cosmetic"}
+
+# Actuator that stands for every actuator of the robot, used by the emergency stop
+ALL = "*"
+
+# The commands clients may send (batches, scripted missions) and the actuator and priority
+# each is scheduled as; set_arm's actuator is its joint's, see command_actuator
+COMMANDS = {
+    "set_tracks": ("tracks", MOTION),
+    "set_throttle": ("tracks", MOTION),
+    "set_differential": ("tracks", MOTION),
+    "set_arm": ("arm", MOTION),
+    "stop_arms": ("arm", SAFETY),
+    "set_light": ("light", COSMETIC),
+    "toggle_light": ("light", COSMETIC),
+    "set_light_brightness": ("light", COSMETIC),
+    "set_light_pattern": ("light", COSMETIC),
+    "set_camera": ("camera", COSMETIC),
+    "set_camera_tilt": ("camera", COSMETIC),
+    "stop": (ALL, SAFETY),
+}
+
+
+def command_actuator(op, args):
+    ''' The (actuator, priority) a command from COMMANDS is scheduled as. '''
+    actuator, priority = COMMANDS[op]
+    if op == "set_arm":
+        actuator = "arm." + args[0]
+    return actuator, priority
+
+# Where the command being run came from ("api", "udp", ...), for the flight recorder
+current_source = contextvars.ContextVar("command_source", default="other")
+
+
+class CommandCancelled(Exception):
+    ''' Raised to the submitter of a command that was dropped by a stop before it ran. '''
+
+
+class Command:
+    __slots__ = ("actuator", "priority", "op", "args", "source", "futures", "order", "submitted", "context")
+
+    def __init__(self, actuator, priority, op, args, source, order):
+        self.actuator = actuator
+        self.priority = priority
+        self.op = op
+        self.args = args
+        self.source = source
+        self.futures = []
+        self.order = order
+        # time the oldest coalesced submitter started waiting
+        self.submitted = time.perf_counter()
+        # context of a traced submitter, so the spans on the writer thread join its trace
+        self.context = None
+
+
+def covers(actuator, other):
+    ''' True if a stop on `actuator` also applies to `other`, e.g. "arm" covers "arm.wrist". '''
+    return actuator == ALL or other == actuator or other.startswith(actuator + ".")
+
+
+class PriorityStats:
+    __slots__ = ("executed", "coalesced", "cancelled", "wait_total", "wait_max")
+
+    def __init__(self):
+        self.executed = 0
+        self.coalesced = 0
+        self.cancelled = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def as_dict(self):
+        return {
+            "executed": self.executed,
+            "coalesced": self.coalesced,
+            "cancelled": self.cancelled,
+            "wait_ms_mean": (self.wait_total / self.executed * 1000) if self.executed else 0.0,
+            "wait_ms_max": self.wait_max * 1000,
+        }
+
+
+class ActuatorScheduler:
+    ''' Runs commands against `target` from a single thread in priority order.
+
+    Pending commands are coalesced per (actuator, op, priority): a newer command
+    replaces the waiting one and takes its place at the back of its class, and
+    everybody who submitted the replaced one gets the result of the newer one.
+    A SAFETY command cancels all pending lower-priority work on the actuators it covers.
+
+    Arguments:
+    target = object whose methods are the commands, i.e. a PowerHorse
+    name = used to name the writer thread
+    '''
+    def __init__(self, target, name="powerhorse"):
+        self.target = target
+        self.pending = {}
+        self.stats_by_priority = {priority: PriorityStats() for priority in PRIORITY_NAMES}
+        self._order = 0
+        self._running = True
+        self._busy = False
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._idle = threading.Condition(self._lock)
+        self._thread = threading.Thread(target=self._run, name="scheduler-%s" % name, daemon=True)
+        self._thread.start()
+
+    def submit(self, actuator, priority, op, *args, source="other"):
+        ''' Queues a command and returns a concurrent.futures.Future for its result.
+        `source` says where it came from, e.g. "api", and ends up in the flight recorder.
+        '''
+        future = Future()
+        key = (actuator, op, priority)
+        with self._lock:
+            if not self._running:
+                raise RuntimeError("Scheduler is closed")
+            self._order += 1
+            if priority == SAFETY:
+                self._cancel_covered(actuator)
+            command = self.pending.pop(key, None)
+            if command is None:
+                command = Command(actuator, priority, op, args, source, self._order)
+            else:
+                self.stats_by_priority[priority].coalesced += 1
+                command.args = args
+                command.source = source
+                command.order = self._order
+            command.futures.append(future)
+            if tracer.active():
+                command.context = contextvars.copy_context()
+            self.pending[key] = command
+            self._wakeup.notify()
+        return future
+
+    async def run(self, actuator, priority, op, *args, source="other"):
+        ''' Submits a command and waits for it from asyncio. '''
+        return await asyncio.wrap_future(self.submit(actuator, priority, op, *args, source=source))
+
+    def _cancel_covered(self, actuator):
+        # called with the lock held
+        for key, command in list(self.pending.items()):
+            if command.priority > SAFETY and covers(actuator, command.actuator):
+                del self.pending[key]
+                self.stats_by_priority[command.priority].cancelled += len(command.futures)
+                error = CommandCancelled("%s %s was cancelled by a stop" % (command.op, command.actuator))
+                for future in command.futures:
+                    _resolve(future, error=error)
+
+    def _next(self):
+        # The handful of actuators keeps the pending dict tiny, a scan beats keeping a heap in sync
+        with self._lock:
+            while self._running and not self.pending:
+                self._wakeup.wait()
+            if not self.pending:
+                return None
+            key = min(self.pending, key=lambda k: (self.pending[k].priority, self.pending[k].order))
+            self._busy = True
+            return self.pending.pop(key)
+
+    def wait_idle(self, timeout=None):
+        ''' Blocks until every command submitted so far has run. Returns False on a timeout. '''
+        with self._lock:
+            return self._idle.wait_for(lambda: not self.pending and not self._busy, timeout)
+
+    def _run(self):
+        while True:
+            command = self._next()
+            if command is None:
+                return
+            wait = time.perf_counter() - command.submitted
+            stats = self.stats_by_priority[command.priority]
+            stats.executed += 1
+            stats.wait_total += wait
+            stats.wait_max = max(stats.wait_max, wait)
+            try:
+                if command.context is not None:
+                    result = command.context.run(self._execute, command)
+                else:
+                    result = self._execute(command)
+            except Exception as e:
+                for future in command.futures:
+                    _resolve(future, error=e)
+            else:
+                for future in command.futures:
+                    _resolve(future, result)
+            with self._lock:
+                self._busy = False
+                if not self.pending:
+                    self._idle.notify_all()
+
+    def _execute(self, command):
+        current_source.set(command.source)
+        tracer.record("scheduler.queue", command.submitted, time.perf_counter())
+        with tracer.span("%s.%s" % (type(self.target).__name__, command.op)):
+            return getattr(self.target, command.op)(*command.args)
+
+    def stats(self):
+        with self._lock:
+            depth = {name: 0 for name in PRIORITY_NAMES.values()}
+            for command in self.pending.values():
+                depth[PRIORITY_NAMES[command.priority]] += 1
+        return {
+            "depth": sum(depth.values()),
+            "depth_by_priority": depth,
+            "priorities": {PRIORITY_NAMES[p]: s.as_dict() for p, s in self.stats_by_priority.items()},
+        }
+
+    def close(self):
+        ''' Lets the commands already queued run, then stops the writer thread. '''
+        with self._lock:
+            self._running = False
+            self._wakeup.notify()
+        self._thread.join()
+
+
+def _resolve(future, result=None, error=None):
+    # The submitter may have given up (e.g. the HTTP client went away) and cancelled it
+    try:
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+    except InvalidStateError:
+        pass
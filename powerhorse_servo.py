@@ -0,0 +1,99 @@
+#!/usr/bin/python
+
+# Camera pan and tilt servos on spare PCA9685 channels.
+# A servo's pulse width, looked up from a table precomputed for the chip's PWM
+# frequency, is written to the channel's OFF register at the full 12-bit resolution
+# (about 0.4 of a degree at 50 Hz). set_camera only sets a target; the servo is
+# moved towards it at a limited speed by a loop running at the PWM frequency, so one
+# request gives a smooth sweep without the client sending the angles in between.
+# Only the servo loop writes to a servo's channel.
+
+import threading
+
+# Table entries per degree
+RESOLUTION = 10
+
+# Anything a servo's config leaves out
+SERVO_DEFAULTS = {"channel": None, "min_pulse_us": 500, "max_pulse_us": 2500,
+                  "min_angle": -90, "max_angle": 90, "speed": 120}
+
+
+class Servo:
+    ''' A hobby servo on a PCA9685 channel, moved at a limited speed.
+
+    Arguments:
+    pwm = the PCA9685 it is connected to
+    freq = the PCA9685's PWM frequency in Hz
+    config = {"channel": 14, "min_pulse_us": 500, "max_pulse_us": 2500,
+              "min_angle": -90, "max_angle": 90, "speed": 120}, speed in degrees a second
+    '''
+    def __init__(self, pwm, freq, config):
+        config = dict(SERVO_DEFAULTS, **config)
+        self.pwm = pwm
+        self.channel = config["channel"]
+        self.min_angle = config["min_angle"]
+        self.max_angle = config["max_angle"]
+        self.speed = config["speed"]
+        # one 4096th of the PWM period in microseconds
+        counts_per_us = freq * 4096 / 1e6
+        steps = int((self.max_angle - self.min_angle) * RESOLUTION) + 1
+        low, high = config["min_pulse_us"], config["max_pulse_us"]
+        self.table = [int(round((low + (high - low) * i / (steps - 1)) * counts_per_us)) for i in range(steps)]
+        self.target = self.position = min(max(0.0, self.min_angle), self.max_angle)
+        self.written = None
+        self.writes = 0
+        self.last = None
+        self._lock = threading.Lock()
+
+    def move_to(self, angle):
+        with self._lock:
+            self.target = min(max(angle, self.min_angle), self.max_angle)
+        return self.target
+
+    def counts(self, angle):
+        return self.table[int(round((angle - self.min_angle) * RESOLUTION))]
+
+    def tick(self, now):
+        with self._lock:
+            dt = now - self.last if self.last is not None else 0.0
+            self.last = now
+            step = self.speed * dt
+            self.position += max(min(self.target - self.position, step), -step)
+            counts = self.counts(self.position)
+        if self.written is None:
+            self.pwm.setPWM(self.channel, 0, counts)
+        elif counts != self.written:
+            # the ON count stays 0, only the OFF registers need writing
+            self.pwm.setOff(self.channel, counts)
+        else:
+            return
+        self.written = counts
+        self.writes += 1
+
+    def stats(self):
+        return {"channel": self.channel, "target": self.target, "position": self.position,
+                "pulse_counts": self.written, "writes": self.writes, "moving": self.position != self.target}
+
+
+class CameraServos:
+    ''' The camera's pan and tilt servos, either of which may not be fitted.
+
+    Arguments:
+    pwm = the PCA9685 they are connected to
+    freq = the PCA9685's PWM frequency in Hz
+    config = the "camera_servos" section of the robot config, {"pan": {...} or None, "tilt": ...}
+    '''
+    def __init__(self, pwm, freq, config):
+        self.servos = {axis: Servo(pwm, freq, servo) for axis, servo in config.items() if servo}
+
+    def move_to(self, axis, angle):
+        ''' Sets the angle `axis` is heading for, clipped to its range. Returns the angle. '''
+        servo = self.servos.get(axis)
+        return servo.move_to(angle) if servo is not None else angle
+
+    def tick(self, now):
+        for servo in self.servos.values():
+            servo.tick(now)
+
+    def stats(self):
+        return {axis: servo.stats() for axis, servo in self.servos.items()}
@@ -0,0 +1,580 @@
+#!/usr/bin/python
+
+# Multi-worker deployment: one hardware-owner process, many API worker processes.
+#
+# Only the owner touches the PCA9685 and GPIO pins. It creates a shared memory
+# block per robot holding
+#   - a state block the owner publishes after every change, guarded by a seqlock
+#     (the sequence is odd while a write is in progress and readers retry),
+#   - a stats area with the owner's scheduler/loop/UDP stats as JSON, also seqlocked,
+#   - one command ring per API worker. Each worker claims a ring with flock() and
+#     is its only writer; every ring entry has its own seqlock sequence and a
+#     status byte the owner fills in when the command has run.
+# The API workers serve the routes from this block instead of building hardware.
+# Command leases (powerhorse_lease.py) are kept by the owner, where the commands run: each
+# entry carries the client that sent it and its lease TTL, and a heartbeat is an entry too.
+#
+# Start the owner first, then the API with POWERHORSE_SHM=1 and as many workers as wanted:
+#   python powerhorse_shm.py &
+#   POWERHORSE_SHM=1 fastapi run --workers 4 powerhorse_control_api.py
+
+import asyncio
+import fcntl
+import json
+import math
+import os
+import signal
+import struct
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from powerhorse_robot import JOINTS
+from powerhorse_lights import PATTERNS
+from powerhorse_registry import RobotRegistry, merge_config
+from powerhorse_state import StateSnapshot, SECTIONS
+from powerhorse_scheduler import SAFETY, CommandCancelled
+from powerhorse_udp import start_udp
+from powerhorse_ratelimit import RateLimiter, current_client
+from powerhorse_recorder import SOURCES
+from powerhorse_estimator import check_goto_power
+
+MAGIC = b"PHSM"
+VERSION = 5
+SLOTS = 16
+RING = 64
+
+# magic, version, slots, ring entries, owner pid, epoch, owner heartbeat
+HEADER = struct.Struct("<4sHHII8sd")
+# seq, snapshot version, section versions, throttle, differential, left/right duty,
+# joints, camera pan, camera tilt, light, light brightness, light pattern, estimated joints, goto targets, pose,
+# velocity
+STATE = struct.Struct("<IxxxxQ4Q4d4dddddd4d4d3d2d")
+STATS_SIZE = 4096
+# seq, json length
+STATS = struct.Struct("<II")
+# head (worker), tail (owner)
+SLOT = struct.Struct("<QQ")
+# seq, status, source, actuator, op, priority, request, 4 args, lease ttl, lease holder (the client)
+ENTRY = struct.Struct("<IBBBBBxxxQ4dd32s")
+# where the owner leaves what an op returns, over its first argument, before setting the status
+RETURNED_OFFSET = 20
+
+STATE_OFFSET = 64
+STATS_OFFSET = STATE_OFFSET + STATE.size
+SLOTS_OFFSET = STATS_OFFSET + STATS.size + STATS_SIZE
+SLOT_SIZE = SLOT.size + RING * ENTRY.size
+SIZE = SLOTS_OFFSET + SLOTS * SLOT_SIZE
+
+PENDING, DONE, CANCELLED, FAILED = 0, 1, 2, 3
+
+# Codes used in the command entries, sources are the flight recorder's
+ACTUATORS = ("*", "tracks", "arm", "camera", "light") + tuple("arm." + joint for joint in JOINTS)
+OPS = ("stop", "set_tracks", "set_throttle", "set_differential", "set_arm", "stop_arm", "stop_arms",
+       "set_light", "toggle_light", "set_camera", "goto", "reset_estimate", "set_camera_tilt",
+       "set_light_brightness", "set_light_pattern", "renew_leases")
+# ops whose first argument is a joint name, sent as its index in JOINTS
+JOINT_OPS = ("set_arm", "stop_arm", "goto")
+
+# The owner is considered gone when its heartbeat is older than this
+OWNER_TIMEOUT = 1.0
+
+
+class OwnerUnavailable(Exception):
+    ''' The hardware-owner process isn't running or has stopped responding. '''
+
+
+def block_name(robot_id):
+    return "powerhorse-%s" % robot_id
+
+
+def _attach(name):
+    # Before Python 3.13 attaching registers the block with the resource tracker,
+    # which would unlink it when this worker exits
+    block = shared_memory.SharedMemory(name)
+    try:
+        resource_tracker.unregister(block._name, "shared_memory")
+    except Exception:
+        pass
+    return block
+
+
+def _encode_args(op, args):
+    args = list(args)
+    if op in JOINT_OPS:
+        args[0] = JOINTS.index(args[0])
+    if op == "set_light_pattern":
+        args[0] = PATTERNS.index(args[0])
+    return [float(arg) for arg in args] + [math.nan] * (4 - len(args))
+
+
+def _decode_args(op, values):
+    args = [value for value in values if not math.isnan(value)]
+    if op in JOINT_OPS:
+        args[0] = JOINTS[int(args[0])]
+    if op == "set_light":
+        args[0] = bool(args[0])
+    if op in ("set_camera", "set_camera_tilt"):
+        args[0] = int(args[0])
+    if op == "set_light_pattern":
+        args[0] = PATTERNS[int(args[0])]
+    return args
+
+
+def read_seqlocked(buf, offset, layout, timeout=OWNER_TIMEOUT):
+    ''' Reads a struct guarded by a seqlock at `offset`, retrying while it is being written.
+    A write that doesn't finish within `timeout` seconds means the owner died in the middle
+    of it, and raises OwnerUnavailable.
+    '''
+    deadline = time.monotonic() + timeout
+    while True:
+        before = struct.unpack_from("<I", buf, offset)[0]
+        if not before & 1:
+            values = layout.unpack_from(buf, offset)
+            if struct.unpack_from("<I", buf, offset)[0] == before:
+                return values
+        if time.monotonic() > deadline:
+            raise OwnerUnavailable("A write to shared memory was never finished, the hardware owner has stopped")
+
+
+class SharedMemoryOwner:
+    ''' Runs in the hardware-owner process: feeds commands from the API workers to a
+    Robot's scheduler and publishes the robot's state for them.
+
+    Arguments:
+    robot = a local Robot from the registry
+    '''
+    def __init__(self, robot):
+        self.robot = robot
+        name = block_name(robot.id)
+        try:
+            # left behind by an owner that didn't shut down cleanly
+            stale = shared_memory.SharedMemory(name)
+            stale.close()
+            stale.unlink()
+        except FileNotFoundError:
+            pass
+        self.block = shared_memory.SharedMemory(name, create=True, size=SIZE)
+        self.buf = self.block.buf
+        self.epoch = os.urandom(4).hex().encode()
+        HEADER.pack_into(self.buf, 0, MAGIC, VERSION, SLOTS, RING, os.getpid(), self.epoch, time.time())
+        self.robot.powerhorse.snapshot.epoch = self.epoch.decode()
+        self.published = -1
+        self.published_estimate = b""
+        # the state is published from the event loop and from the scheduler's writer thread,
+        # as commands finish, and its seqlock only allows one writer at a time
+        self._publish_lock = threading.Lock()
+        self.stats_published = 0
+        self.lost = 0
+
+    def _write_seqlocked(self, offset, write):
+        # `write` packs the payload with the odd sequence number it is given, the even one
+        # is only stored once the payload is complete, as RemoteScheduler.submit does
+        seq = struct.unpack_from("<I", self.buf, offset)[0]
+        struct.pack_into("<I", self.buf, offset, seq + 1)
+        write(seq + 1)
+        struct.pack_into("<I", self.buf, offset, seq + 2)
+
+    def publish_state(self):
+        powerhorse = self.robot.powerhorse
+        snapshot = powerhorse.snapshot
+        estimator = self.robot.estimator
+        with self._publish_lock:
+            version = snapshot.version
+            # the estimate moves on without the snapshot changing, while joints run and on a reset
+            estimate = np.concatenate((estimator.positions, estimator.targets, estimator.pose, estimator.velocity))
+            if version == self.published and estimate.tobytes() == self.published_estimate:
+                return
+            self.published = version
+            self.published_estimate = estimate.tobytes()
+            values = [snapshot.versions[section] for section in SECTIONS]
+            values += [powerhorse.tracks["throttle"], powerhorse.tracks["differential"]]
+            values += list(powerhorse.track_duty)
+            values += powerhorse.arm_power
+            values += [powerhorse.camera_angle, powerhorse.camera_tilt, 1.0 if powerhorse.light else 0.0,
+                       powerhorse.light_brightness, PATTERNS.index(powerhorse.light_pattern)]
+            values += estimate.tolist()
+            self._write_seqlocked(STATE_OFFSET, lambda seq: STATE.pack_into(self.buf, STATE_OFFSET, seq, version, *values))
+
+    def publish_stats(self):
+        robot = self.robot
+        stats = json.dumps({
+            "scheduler": robot.scheduler.stats(),
+            "loop": robot.loop.stats(),
+            "udp": robot.udp.stats() if robot.udp else {"enabled": False},
+            "safety": robot.safety.stats(),
+            "servos": robot.servos.stats(),
+            "lights": robot.lights.stats(),
+            "leases": robot.leases.stats(),
+            "lost_commands": self.lost,
+        }).encode()[:STATS_SIZE]
+        def write(seq):
+            STATS.pack_into(self.buf, STATS_OFFSET, seq, len(stats))
+            self.buf[STATS_OFFSET + STATS.size:STATS_OFFSET + STATS.size + len(stats)] = stats
+        self._write_seqlocked(STATS_OFFSET, write)
+
+    def _finish(self, offset, request, op, future):
+        if future.cancelled():
+            status = CANCELLED
+        elif future.exception() is not None:
+            status = CANCELLED if isinstance(future.exception(), CommandCancelled) else FAILED
+        else:
+            status = DONE
+        # the state goes out before the status so the worker sees the result with it
+        self.publish_state()
+        # a worker that took over the slot may have reused the entry by now
+        if struct.unpack_from("<Q", self.buf, offset + 12)[0] == request:
+            if op == "renew_leases":
+                struct.pack_into("<d", self.buf, offset + RETURNED_OFFSET, future.result())
+            struct.pack_into("<B", self.buf, offset + 4, status)
+
+    def _run_command(self, offset, values):
+        seq, status, source, actuator, op, priority, request, *args, ttl, holder = values
+        op = OPS[op]
+        args = _decode_args(op, args)
+        source = SOURCES[source] if source < len(SOURCES) else "other"
+        holder = holder.rstrip(b"\0").decode("utf-8", "replace") or None
+        leases = self.robot.leases
+        if op == "goto":
+            try:
+                future = self.robot.estimator.goto(*args)
+            except ValueError as exc:
+                # checked by the worker already, unless its config differs from ours
+                future = Future()
+                future.set_exception(exc)
+        elif op == "reset_estimate":
+            self.robot.estimator.reset()
+            future = Future()
+            future.set_result(None)
+        elif op == "renew_leases":
+            future = Future()
+            future.set_result(leases.heartbeat(holder))
+        else:
+            actuator = ACTUATORS[actuator]
+            future = self.robot.scheduler.submit(actuator, priority, op, *args, source=source)
+
+            def lease(future):
+                # as Robot.command does once a command has run, before the worker hears of it
+                if not future.cancelled() and future.exception() is None:
+                    leases.update(actuator, holder, ttl)
+            future.add_done_callback(lease)
+        future.add_done_callback(lambda future: self._finish(offset, request, op, future))
+
+    def poll(self):
+        ''' Picks up new commands from every worker ring and publishes state. Returns how many were run. '''
+        struct.pack_into("<d", self.buf, HEADER.size - 8, time.time())
+        count = 0
+        for slot in range(SLOTS):
+            base = SLOTS_OFFSET + slot * SLOT_SIZE
+            head, tail = SLOT.unpack_from(self.buf, base)
+            if head == tail:
+                continue
+            if head - tail > RING:
+                # the worker lapped us, the oldest entries are gone
+                self.lost += head - tail - RING
+                tail = head - RING
+            while tail < head:
+                offset = base + SLOT.size + (tail % RING) * ENTRY.size
+                values = read_seqlocked(self.buf, offset, ENTRY)
+                self._run_command(offset, values)
+                tail += 1
+                count += 1
+            struct.pack_into("<Q", self.buf, base + 8, tail)
+        self.publish_state()
+        now = time.monotonic()
+        if now - self.stats_published > 1.0:
+            self.stats_published = now
+            self.publish_stats()
+        return count
+
+    def close(self):
+        self.buf = None
+        self.block.close()
+        self.block.unlink()
+
+
+class RemoteScheduler:
+    ''' Worker-side stand-in for an ActuatorScheduler, writing commands to this worker's ring. '''
+    def __init__(self, remote):
+        self.remote = remote
+        self.buf = remote.buf
+        self.base = SLOTS_OFFSET + remote.slot * SLOT_SIZE
+        self.outstanding = {}
+        self._lock = threading.Lock()
+
+    def submit(self, actuator, priority, op, *args, source="other", holder=None, ttl=None):
+        ''' As ActuatorScheduler.submit, `holder` and `ttl` are the lease the owner keeps for the command. '''
+        self.remote.check_owner()
+        future = Future()
+        with self._lock:
+            head, tail = SLOT.unpack_from(self.buf, self.base)
+            offset = self.base + SLOT.size + (head % RING) * ENTRY.size
+            if offset in self.outstanding:
+                raise OwnerUnavailable("The hardware owner is not keeping up, command ring is full")
+            seq = struct.unpack_from("<I", self.buf, offset)[0]
+            struct.pack_into("<I", self.buf, offset, seq + 1)
+            ENTRY.pack_into(self.buf, offset, seq + 1, PENDING, SOURCES.index(source) if source in SOURCES else 0,
+                            ACTUATORS.index(actuator), OPS.index(op), priority, head, *_encode_args(op, args),
+                            ttl or 0.0, (holder or "").encode()[:32])
+            struct.pack_into("<I", self.buf, offset, seq + 2)
+            struct.pack_into("<Q", self.buf, self.base, head + 1)
+            self.outstanding[offset] = (future, op)
+        self.remote.wake()
+        return future
+
+    async def run(self, actuator, priority, op, *args, source="other", holder=None, ttl=None):
+        return await asyncio.wrap_future(self.submit(actuator, priority, op, *args, source=source, holder=holder, ttl=ttl))
+
+    def resolve(self):
+        # Called by the refresher. The statuses are read before the state: the owner publishes
+        # the state before it sets a status, so the state read after them is at least as new
+        # as every command seen finished here.
+        with self._lock:
+            finished = []
+            for offset, (future, op) in list(self.outstanding.items()):
+                status = self.buf[offset + 4]
+                if status != PENDING:
+                    del self.outstanding[offset]
+                    returned = struct.unpack_from("<d", self.buf, offset + RETURNED_OFFSET)[0]
+                    finished.append((future, op, status, returned))
+        self.remote.refresh()
+        for future, op, status, returned in finished:
+            if status == DONE:
+                future.set_result(int(returned) if op == "renew_leases" else self.remote.result_of(op))
+            elif status == CANCELLED:
+                future.set_exception(CommandCancelled("%s was cancelled by a stop" % op))
+            else:
+                future.set_exception(RuntimeError("%s failed in the hardware owner" % op))
+
+    def stats(self):
+        return self.remote.owner_stats().get("scheduler", {})
+
+
+class RemotePowerHorse:
+    ''' The state of a PowerHorse as last published by the owner, with a StateSnapshot over it. '''
+    def __init__(self):
+        self.tracks = {"throttle": 0, "differential": 0}
+        self.track_duty = (0.0, 0.0)
+        self.arm = {joint: 0 for joint in JOINTS}
+        self.arm_power = [0] * len(JOINTS)
+        self.camera_angle = 0
+        self.camera_tilt = 0
+        self.light = False
+        self.light_brightness = 100
+        self.light_pattern = "solid"
+        self.snapshot = StateSnapshot(self)
+
+
+class RemoteEstimator:
+    def __init__(self, remote):
+        self.remote = remote
+        self.positions = [0.0] * 4
+        self.targets = [math.nan] * 4
+        self.pose = [0.0] * 3
+        self.velocity = [0.0] * 2
+
+    def goto(self, joint, position, power=50):
+        check_goto_power(self.remote.config["estimator"], joint, power)
+        return self.remote.scheduler.submit("arm." + joint, 1, "goto", joint, position, power, source="api")
+
+    def reset(self):
+        return self.remote.scheduler.submit("*", 1, "reset_estimate")
+
+    def as_dict(self):
+        return {
+            "joints": dict(zip(JOINTS, self.positions)),
+            "targets": {joint: target for joint, target in zip(JOINTS, self.targets) if not math.isnan(target)},
+            "pose": dict(zip(("x", "y", "heading"), self.pose)),
+            "velocity": dict(zip(("linear", "angular"), self.velocity)),
+        }
+
+
+class RemoteStats:
+    # Stands in for a part of the robot (loop, udp, ...) whose stats the owner publishes
+    def __init__(self, remote, key):
+        self.remote = remote
+        self.key = key
+
+    def stats(self):
+        return self.remote.owner_stats().get(self.key, {})
+
+
+class RemoteRobot:
+    ''' A robot owned by the hardware-owner process, as seen from an API worker.
+    Offers what the routes use of a Robot: command(), scheduler, powerhorse state,
+    estimator and stats. The camera stream is only available in single-process mode.
+    '''
+    remote = True
+    # a simulated robot is stepped by the hardware owner
+    simulator = None
+
+    def __init__(self, robot_id, config):
+        self.id = robot_id
+        self.config = merge_config(config)
+        self.block = _attach(block_name(robot_id))
+        self.buf = self.block.buf
+        magic, version, slots, ring, pid, epoch, heartbeat = HEADER.unpack_from(self.buf, 0)
+        if magic != MAGIC or version != VERSION or (slots, ring) != (SLOTS, RING):
+            raise RuntimeError("Shared memory %s was not created by a compatible owner" % block_name(robot_id))
+        self.slot, self.slot_lock = self._claim_slot()
+        self.powerhorse = RemotePowerHorse()
+        self.powerhorse.snapshot.epoch = epoch.decode()
+        self.scheduler = RemoteScheduler(self)
+        self.estimator = RemoteEstimator(self)
+        self.loop = RemoteStats(self, "loop")
+        self.udp = RemoteStats(self, "udp")
+        self.safety = RemoteStats(self, "safety")
+        self.servos = RemoteStats(self, "servos")
+        self.lights = RemoteStats(self, "lights")
+        # kept by the owner, where the commands are run
+        self.leases = RemoteStats(self, "leases")
+        self.camera_stream = None
+        # limits are kept per worker
+        self.limiter = RateLimiter(self.config["limits"])
+        self.seen = -1
+        self.seen_seq = 0
+        self._stats = (0, {})
+        self._wakeup = threading.Event()
+        self._running = True
+        self.refresh()
+        self._thread = threading.Thread(target=self._run, name="shm-%s" % robot_id, daemon=True)
+        self._thread.start()
+
+    def _claim_slot(self):
+        # A slot is ours for as long as we hold its lock file, the kernel frees it if we die
+        for slot in range(SLOTS):
+            path = os.path.join(tempfile.gettempdir(), "%s.slot%d.lock" % (block_name(self.id), slot))
+            f = open(path, "w")
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return slot, f
+            except BlockingIOError:
+                f.close()
+        raise RuntimeError("All %d command slots of %s are taken" % (SLOTS, self.id))
+
+    def check_owner(self):
+        heartbeat = struct.unpack_from("<d", self.buf, HEADER.size - 8)[0]
+        if time.time() - heartbeat > OWNER_TIMEOUT:
+            raise OwnerUnavailable("The hardware owner of %s is not running" % self.id)
+
+    def refresh(self):
+        ''' Copies the owner's latest state in and wakes long-polls for the sections that changed. '''
+        values = read_seqlocked(self.buf, STATE_OFFSET, STATE)
+        if values[0] == self.seen_seq:
+            return
+        self.seen_seq = values[0]
+        # the estimate is republished without the state's version changing
+        self.estimator.positions = list(values[19:23])
+        self.estimator.targets = list(values[23:27])
+        self.estimator.pose = list(values[27:30])
+        self.estimator.velocity = list(values[30:32])
+        version = values[1]
+        if version == self.seen:
+            return
+        self.seen = version
+        section_versions = values[2:6]
+        (throttle, differential, left, right, s, e, w, g, camera, tilt, light, brightness, pattern) = values[6:19]
+        powerhorse = self.powerhorse
+        powerhorse.tracks = {"throttle": throttle, "differential": differential}
+        powerhorse.track_duty = (left, right)
+        powerhorse.arm = dict(zip(JOINTS, (s, e, w, g)))
+        powerhorse.arm_power = [s, e, w, g]
+        powerhorse.camera_angle = int(camera)
+        powerhorse.camera_tilt = int(tilt)
+        powerhorse.light = bool(light)
+        powerhorse.light_brightness = int(brightness)
+        powerhorse.light_pattern = PATTERNS[int(pattern)]
+        snapshot = powerhorse.snapshot
+        changed = [section for section, v in zip(SECTIONS, section_versions) if v != snapshot.versions[section]]
+        snapshot.mark_changed(*changed, versions=dict(zip(SECTIONS, section_versions)), version=version)
+
+    def result_of(self, op):
+        # what the ops return in the owner, rebuilt from the published state
+        powerhorse = self.powerhorse
+        if op in ("set_tracks", "set_throttle", "set_differential"):
+            return dict(powerhorse.tracks)
+        if op == "stop_arms":
+            return dict(powerhorse.arm)
+        if op == "toggle_light":
+            return powerhorse.light
+        return None
+
+    def owner_stats(self):
+        seq = struct.unpack_from("<I", self.buf, STATS_OFFSET)[0]
+        if seq != self._stats[0]:
+            while True:
+                seq, length = read_seqlocked(self.buf, STATS_OFFSET, STATS)
+                data = bytes(self.buf[STATS_OFFSET + STATS.size:STATS_OFFSET + STATS.size + length])
+                if struct.unpack_from("<I", self.buf, STATS_OFFSET)[0] == seq:
+                    break
+            self._stats = (seq, json.loads(data) if data else {})
+        return self._stats[1]
+
+    def wake(self):
+        self._wakeup.set()
+
+    def _run(self):
+        # Poll quickly while commands are outstanding, lazily otherwise
+        while self._running:
+            try:
+                self.scheduler.resolve()
+            except OwnerUnavailable:
+                # the owner died in the middle of a write, commands get 503 from check_owner
+                self._wakeup.wait(OWNER_TIMEOUT)
+                self._wakeup.clear()
+                continue
+            if self.scheduler.outstanding:
+                time.sleep(0.001)
+            else:
+                self._wakeup.wait(0.01)
+                self._wakeup.clear()
+
+    async def command(self, actuator, priority, op, *args, source="api", ttl=None):
+        await self.limiter.admit(actuator, priority, op)
+        return await self.scheduler.run(actuator, priority, op, *args, source=source, holder=current_client.get(), ttl=ttl)
+
+    async def heartbeat(self, holder):
+        return await self.scheduler.run("*", SAFETY, "renew_leases", source="api", holder=holder)
+
+    def close(self):
+        self._running = False
+        self._thread.join()
+        self.scheduler.buf = None
+        self.buf = None
+        self.block.close()
+        self.slot_lock.close()
+
+
+def main():
+    registry = RobotRegistry.from_env()
+    owners = [SharedMemoryOwner(registry.get(robot_id)) for robot_id in registry.ids()]
+    print("Hardware owner serving %s" % ", ".join(block_name(robot_id) for robot_id in registry.ids()))
+
+    async def run():
+        for owner in owners:
+            udp = owner.robot.config["udp"]
+            if udp["port"]:
+                owner.robot.udp = await start_udp(owner.robot, udp["host"], udp["port"], udp["echo_interval"])
+        while True:
+            busy = sum(owner.poll() for owner in owners)
+            # a command just arrived, others are likely to follow close behind
+            await asyncio.sleep(0 if busy else 0.001)
+
+    # so the shared memory is unlinked when stopped by a service manager too
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for owner in owners:
+            owner.close()
+        registry.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,469 @@
+#!/usr/bin/python
+
+# Simulation mode: the whole control stack on simulated hardware.
+# The PCA9685 writes into a register file, the gpiozero motors, arrows and sensors are
+# plain objects, and a physics-lite model moves the tracks and joints from what was
+# actually written to them: duty read back from the PCA9685 registers and the motor pins,
+# the estimator's calibration as the true speeds, a lag on the track motors, slip, and an
+# arena with obstacles that the ultrasonic and IR sensors see and the robot bumps into.
+#
+# A Simulator steps the model and the robot's control loops (estimator, lights, safety,
+# servos) on a virtual clock, so a simulated robot runs as fast as the host can step it.
+# Serving a simulated robot:
+#   POWERHORSE_SIM=1 uvicorn powerhorse_control_api:app
+# or "sim": {"enabled": true} in its config, its clock paced by "sim": {"speed": ...}.
+#
+# Running scripted missions, as fast as possible, e.g. in CI:
+#   python powerhorse_sim.py mission.json [more.json ...]
+# A mission is {"config": {robot config}, "duration": seconds,
+#               "steps": [{"at": 0, "op": "set_tracks", "args": [60, 0]}, ...],
+#               "expect": {"model.pose.x": [1.0, 2.0], "safety.trips": [1, 1]}}
+# where op is one of powerhorse_scheduler.COMMANDS or "goto", and each expectation is a
+# dotted path into the report printed at the end with the lowest and highest value
+# allowed. The exit status is 1 if any expectation isn't met.
+
+import argparse
+import contextlib
+import json
+import math
+import random
+import sys
+import threading
+import time
+
+import numpy as np
+
+from PCA9685 import PCA9685
+from powerhorse_arm_motor_control import Motor, Arrow, Sensor
+from powerhorse_robot import PowerHorse, JOINTS
+from powerhorse_registry import Robot, merge_config
+from powerhorse_scheduler import COMMANDS, command_actuator
+from powerhorse_trajectory import LED0_ON_L
+
+MODE1 = 0x00
+MODE1_AI = 0x20
+# the full-on and full-off bits of a channel's ON_H and OFF_H registers
+FULL = 0x10
+
+
+class SimBus:
+    ''' Stands in for the I2C bus of a PCA9685, keeping its registers. '''
+    def __init__(self):
+        self.regs = bytearray(256)
+        self.writes = 0
+
+    def write_byte_data(self, address, reg, value):
+        self.regs[reg] = value
+        self.writes += 1
+
+    def read_byte_data(self, address, reg):
+        return self.regs[reg]
+
+    def write_i2c_block_data(self, address, reg, values):
+        if self.regs[MODE1] & MODE1_AI:
+            self.regs[reg:reg + len(values)] = bytes(values)
+        else:
+            # without auto-increment every byte lands on the same register
+            self.regs[reg] = values[-1]
+        self.writes += 1
+
+    def duty(self, channel):
+        ''' The fraction of the PWM period a channel is on for. '''
+        on_l, on_h, off_l, off_h = self.regs[LED0_ON_L + 4 * channel:LED0_ON_L + 4 * channel + 4]
+        if off_h & FULL:
+            return 0.0
+        if on_h & FULL:
+            return 1.0
+        return (((off_h & 0x0F) << 8 | off_l) - ((on_h & 0x0F) << 8 | on_l)) % 4096 / 4096
+
+
+class SimPCA9685(PCA9685):
+    def __init__(self, address, debug=False, bus=1):
+        super().__init__(address, debug, SimBus())
+
+
+class SimPin:
+    ''' Stands in for a gpiozero output or input device. '''
+    def __init__(self, pin):
+        self.pin = pin
+        self.value = 0
+
+    def on(self):
+        self.value = 1
+
+    def off(self):
+        self.value = 0
+
+    @property
+    def is_active(self):
+        return bool(self.value)
+
+    def close(self):
+        pass
+
+
+class SimMotor(Motor):
+    def __init__(self, motor, config, pins=None, arrow=None):
+        self.testMode = False
+        self.arrow = arrow if arrow is not None else SimArrow(self.motorpins[motor]["arrow"])
+        self.pins = pins if pins is not None else self.motorpins[motor]["config"][config]
+        self.PWM = SimPin(self.pins['e'])
+        self.forward_pin = SimPin(self.pins['f'])
+        self.reverse_pin = SimPin(self.pins['r'])
+
+    def power(self):
+        # signed % duty the motor is being driven at
+        direction = self.forward_pin.value - self.reverse_pin.value
+        return 100 * self.PWM.value * direction
+
+
+class SimArrow(Arrow):
+    def __init__(self, which, pin=None):
+        self.pin = SimPin(pin if pin is not None else self.arrowpins[which])
+
+
+class SimSensor(Sensor):
+    ''' A sensor reading the distance to whatever it points at from a SimModel.
+    The IR sensors are triggered closer than their boundary, in cm like the ultrasonic one.
+    '''
+    def __init__(self, sensortype, boundary, pins=None):
+        self.sensortype = sensortype
+        self.config = dict(self.sensorpins[sensortype], **(pins or {}))
+        self.boundary = boundary
+        self.interval = self.config["interval"]
+        self.lastRead = 0
+        # set by the SimModel, the angle is from straight ahead in radians
+        self.model = None
+        self.angle = 0.0
+
+    def trigger(self):
+        distance = self.model.distance(self.angle)
+        if self.sensortype == "ULTRASONIC":
+            self.lastRead = distance
+        self.Triggered = self.boundary > distance
+        return self.Triggered
+
+
+class SimPowerHorse(PowerHorse):
+    pwm_class = SimPCA9685
+    motor_class = SimMotor
+    arrow_class = SimArrow
+    sensor_class = SimSensor
+
+
+class SimModel:
+    ''' Physics-lite model of a PowerHorse, moved by what is written to its simulated hardware.
+
+    Arguments:
+    powerhorse = the SimPowerHorse driving the model, its sensors read from it
+    config = the robot config, its "sim" section and the "estimator" calibration as the true speeds
+    '''
+    def __init__(self, powerhorse, config):
+        self.powerhorse = powerhorse
+        sim = config["sim"]
+        joints = [config["estimator"]["joints"][joint] for joint in JOINTS]
+        tracks = config["estimator"]["tracks"]
+        self.joint_speed = np.array([joint["speed"] for joint in joints], dtype=float)
+        self.joint_deadband = np.array([joint["deadband"] for joint in joints], dtype=float)
+        self.lower = np.array([joint["min"] for joint in joints], dtype=float)
+        self.upper = np.array([joint["max"] for joint in joints], dtype=float)
+        self.track_speed = tracks["speed"] * (1 - sim["slip"])
+        self.track_deadband = tracks["deadband"]
+        self.track_width = tracks["width"]
+        self.motor_lag = sim["motor_lag"]
+        self.radius = sim["radius"]
+        self.arena = tuple(sim["arena"])
+        self.obstacles = [(obstacle["x"], obstacle["y"], obstacle["r"]) for obstacle in sim["obstacles"]]
+        self.range = sim["range"]
+        self.noise = sim["noise"]
+        self.random = random.Random(sim["seed"])
+        for name, sensor in powerhorse.sensors.items():
+            sensor.model = self
+            sensor.angle = math.radians(sim["sensors"].get(name, {}).get("angle", 0))
+        self.time = 0.0
+        self.joints = np.zeros(4)
+        self.pose = np.zeros(3)
+        # left and right track speeds in metres a second
+        self.speeds = np.zeros(2)
+        self.odometer = 0.0
+        self.collisions = 0
+        self.blocked = False
+        self._lock = threading.Lock()
+
+    def track_duty(self):
+        # signed % duty of the left and right tracks, read back from the PCA9685 registers
+        bus = self.powerhorse.pwm.bus
+        driver = self.powerhorse.track_motors
+        duty = np.zeros(2)
+        for i, (channel, (in1, in2)) in enumerate(zip(driver.speed_channels, driver.input_channels)):
+            direction = (bus.duty(in2) > 0.5) - (bus.duty(in1) > 0.5)
+            duty[i] = 100 * bus.duty(channel) * direction
+        return duty
+
+    def step(self, dt):
+        duty = self.track_duty()
+        power = np.array([slot.motor.power() for slot in self.powerhorse.joints])
+        with self._lock:
+            self.time += dt
+            speeds = np.where(np.abs(power) > self.joint_deadband, power / 100, 0.0) * self.joint_speed
+            self.joints = np.clip(self.joints + speeds * dt, self.lower, self.upper)
+
+            # the tracks take a while to get up to speed
+            target = np.where(np.abs(duty) > self.track_deadband, duty / 100, 0.0) * self.track_speed
+            response = 1 - math.exp(-dt / self.motor_lag) if self.motor_lag > 0 else 1.0
+            self.speeds += (target - self.speeds) * response
+            # settled, rather than creeping towards it for ever
+            settled = np.abs(target - self.speeds) < 1e-6
+            self.speeds[settled] = target[settled]
+            left, right = self.speeds
+            v = (left + right) / 2
+            w = (right - left) / self.track_width
+            x, y, heading = self.pose
+            if abs(w) < 1e-9:
+                x += v * dt * math.cos(heading)
+                y += v * dt * math.sin(heading)
+            else:
+                radius = v / w
+                x += radius * (math.sin(heading + w * dt) - math.sin(heading))
+                y -= radius * (math.cos(heading + w * dt) - math.cos(heading))
+            heading = (heading + w * dt + math.pi) % (2 * math.pi) - math.pi
+            if self.hits(x, y):
+                # stopped dead against the wall or obstacle, it can still turn on the spot
+                if not self.blocked:
+                    self.collisions += 1
+                self.blocked = True
+                self.speeds[:] = 0.0
+                self.pose[2] = heading
+            else:
+                self.blocked = False
+                self.odometer += math.hypot(x - self.pose[0], y - self.pose[1])
+                self.pose[:] = (x, y, heading)
+
+    def hits(self, x, y):
+        xmin, ymin, xmax, ymax = self.arena
+        r = self.radius
+        if x - r < xmin or x + r > xmax or y - r < ymin or y + r > ymax:
+            return True
+        return any((x - ox) ** 2 + (y - oy) ** 2 < (r + radius) ** 2 for ox, oy, radius in self.obstacles)
+
+    def distance(self, angle):
+        ''' cm from a sensor at the edge of the robot, pointing `angle` from straight ahead,
+        to the nearest wall or obstacle, inf beyond the sensor's range.
+        '''
+        with self._lock:
+            x, y, heading = (float(value) for value in self.pose)
+        direction = heading + angle
+        dx, dy = math.cos(direction), math.sin(direction)
+        x += self.radius * dx
+        y += self.radius * dy
+        xmin, ymin, xmax, ymax = self.arena
+        hits = []
+        if dx > 1e-12:
+            hits.append((xmax - x) / dx)
+        elif dx < -1e-12:
+            hits.append((xmin - x) / dx)
+        if dy > 1e-12:
+            hits.append((ymax - y) / dy)
+        elif dy < -1e-12:
+            hits.append((ymin - y) / dy)
+        for ox, oy, radius in self.obstacles:
+            # where the ray meets the circle, t^2 + 2bt + c = 0
+            b = dx * (x - ox) + dy * (y - oy)
+            c = (x - ox) ** 2 + (y - oy) ** 2 - radius ** 2
+            if b * b >= c:
+                t = -b - math.sqrt(b * b - c)
+                if t >= 0:
+                    hits.append(t)
+        distance = max(min(hits, default=math.inf), 0.0) * 100
+        if self.noise:
+            distance = max(distance + self.random.gauss(0, self.noise), 0.0)
+        return distance if distance <= self.range else math.inf
+
+    def state(self):
+        with self._lock:
+            return {
+                "time": self.time,
+                "pose": {"x": float(self.pose[0]), "y": float(self.pose[1]), "heading": float(self.pose[2])},
+                "tracks": {"left": float(self.speeds[0]), "right": float(self.speeds[1])},
+                "joints": {joint: float(self.joints[i]) for i, joint in enumerate(JOINTS)},
+                "odometer": self.odometer,
+                "collisions": self.collisions,
+                "blocked": self.blocked,
+                "bus_writes": self.powerhorse.pwm.bus.writes,
+            }
+
+
+class Simulator:
+    ''' Steps a SimRobot's model and control loops on a virtual clock.
+    Every step waits for the commands the loops submitted (safety slow-downs, goto stops)
+    to be run, so a simulated run doesn't depend on how fast the host is.
+
+    Arguments:
+    robot = the SimRobot
+    speed = virtual seconds per wall second when started, 0 for as fast as possible
+    '''
+    def __init__(self, robot, speed):
+        self.robot = robot
+        self.model = robot.model
+        self.loops = robot.loops()
+        self.dt = min(loop.interval for loop in self.loops)
+        self.due = [0.0] * len(self.loops)
+        self.speed = speed
+        self.now = 0.0
+        self.steps = 0
+        # wall seconds spent stepping
+        self.busy = 0.0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def step(self):
+        with self._lock:
+            started = time.perf_counter()
+            self.steps += 1
+            # counted in steps so the clock doesn't drift through adding up dt
+            self.now = self.steps * self.dt
+            self.model.step(self.dt)
+            for i, loop in enumerate(self.loops):
+                if self.now >= self.due[i] - 1e-9:
+                    loop.step(self.now)
+                    self.due[i] += loop.interval
+            self.robot.scheduler.wait_idle()
+            self.busy += time.perf_counter() - started
+
+    def run_until(self, when):
+        while self.now + self.dt / 2 < when:
+            self.step()
+
+    def command(self, op, *args):
+        ''' Runs a command as a mission step, before the next step of the clock. '''
+        if op == "goto":
+            future = self.robot.estimator.goto(*args)
+        else:
+            actuator, priority = command_actuator(op, args)
+            future = self.robot.scheduler.submit(actuator, priority, op, *args, source="sim")
+        self.robot.scheduler.wait_idle()
+        return future
+
+    def _run(self):
+        started, start = time.monotonic(), self.now
+        while not self._stop.is_set():
+            self.step()
+            if self.speed:
+                delay = started + (self.now - start) / self.speed - time.monotonic()
+                if delay > 0:
+                    self._stop.wait(delay)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="sim-%s" % self.robot.id, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        return {"time": self.now, "speed": self.speed, "steps": self.steps, "step_ms": self.dt * 1000,
+                "wall": self.busy, "speedup": self.now / self.busy if self.busy else None,
+                "model": self.model.state()}
+
+
+class SimRobot(Robot):
+    ''' A Robot on simulated hardware, its control loops stepped by a Simulator.
+    The camera shows the test pattern unless the config names another source.
+    '''
+    powerhorse_class = SimPowerHorse
+
+    def __init__(self, robot_id, config):
+        super().__init__(robot_id, merge_config(config, {"camera": {"source": "test"}}))
+
+    def clock(self):
+        return self.simulator.now
+
+    def start(self):
+        sim = self.config["sim"]
+        self.model = SimModel(self.powerhorse, self.config)
+        # leases run out on the virtual clock, checked on every tick of the control loop
+        self.loop.add(self.leases.tick)
+        self.simulator = Simulator(self, sim["speed"])
+        # with a speed of None the clock is only stepped by hand, as missions do
+        if sim["speed"] is not None:
+            self.simulator.start()
+
+    def close(self):
+        self.simulator.stop()
+        super().close()
+
+
+def lookup(report, path):
+    value = report
+    for key in path.split("."):
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    return value
+
+
+def run_mission(mission, robot_id="mission"):
+    ''' Runs a mission (see the top of this file) as fast as possible and returns its report. '''
+    config = merge_config(mission.get("config", {}), {"recorder": {"path": None}})
+    config["sim"] = dict(config.get("sim", {}), speed=None)
+    steps = sorted(mission.get("steps", []), key=lambda step: step["at"])
+    for step in steps:
+        if step["op"] not in COMMANDS and step["op"] != "goto":
+            raise ValueError("Mission step %r: unknown op, choose from %s, goto" % (step, ", ".join(COMMANDS)))
+    robot = SimRobot(robot_id, config)
+    simulator = robot.simulator
+    started = time.perf_counter()
+    try:
+        for step in steps:
+            simulator.run_until(step["at"])
+            simulator.command(step["op"], *step.get("args", []))
+        simulator.run_until(mission["duration"])
+        wall = time.perf_counter() - started
+        report = {
+            "time": simulator.now,
+            "wall": wall,
+            "speedup": simulator.now / wall if wall else None,
+            "steps": simulator.steps,
+            "model": robot.model.state(),
+            "estimate": robot.estimator.as_dict(),
+            "state": robot.powerhorse.snapshot.as_dict(),
+            "safety": robot.safety.stats(),
+            "scheduler": robot.scheduler.stats(),
+            "loops": {loop.name: loop.stats() for loop in simulator.loops},
+        }
+    finally:
+        robot.close()
+    results = {}
+    for path, (low, high) in mission.get("expect", {}).items():
+        value = lookup(report, path)
+        results[path] = {"value": value, "min": low, "max": high,
+                         "ok": isinstance(value, (int, float)) and low <= value <= high}
+    report["expect"] = results
+    report["ok"] = all(result["ok"] for result in results.values())
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run scripted missions on a simulated PowerHorse")
+    parser.add_argument("missions", nargs="+", help="mission files, see the top of powerhorse_sim.py")
+    args = parser.parse_args(argv)
+    reports = {}
+    # the motor classes print as they go, keep stdout for the reports
+    with contextlib.redirect_stdout(sys.stderr):
+        for path in args.missions:
+            with open(path) as f:
+                reports[path] = run_mission(json.load(f))
+    print(json.dumps(reports, indent=2, default=str))
+    failed = [path for path, report in reports.items() if not report["ok"]]
+    for path in failed:
+        print("%s: failed %s" % (path, ", ".join(name for name, result in reports[path]["expect"].items()
+                                                  if not result["ok"])), file=sys.stderr)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,136 @@
+#!/usr/bin/python
+
+# Versioned snapshot of the PowerHorse state for the GET routes.
+# Every change bumps a monotonically increasing version; each section is only
+# re-serialised the first time it is read after it has changed, so polling an
+# idle robot just hands back the same cached bytes.
+#
+# Clients that poll can skip the body altogether. Each section's ETag is its version,
+# so moving the arm doesn't make a cached /tracks stale. The ETag is prefixed with an
+# epoch chosen at startup, as versions start again from 0 when the API restarts. It is
+# a weak ETag (W/"epoch-version") as it names a version of the state rather than exact
+# bytes. A client sending it back in If-None-Match gets a 304 without the body while
+# the section is unchanged, which costs a dict lookup and no serialising.
+#
+# Clients that want to hear about a change as soon as it happens long-poll with
+# ?since={version} instead of polling often. The request waits on an asyncio future
+# rather than holding a thread, so any number of them cost only memory. Changes come
+# from the scheduler's thread, which wakes the futures with call_soon_threadsafe. All
+# waiters share one list and are all woken by any change, each checks its own section
+# and waits again if that hasn't changed; the robot changes far less often than that
+# costs anything. A long-poll that times out (after 30 seconds, LONG_POLL_TIMEOUT in
+# the API) is answered with the current state, or a 304 if it also sent If-None-Match,
+# and the client simply polls again.
+
+import asyncio
+import copy
+import json
+import os
+import threading
+
+SECTIONS = ("tracks", "arm", "light", "camera")
+
+
+class StateSnapshot:
+    ''' Keeps the serialised state of a PowerHorse, one cached body per section.
+
+    Arguments:
+    powerhorse = the PowerHorse whose state is served
+    '''
+    def __init__(self, powerhorse):
+        self.powerhorse = powerhorse
+        # the epoch keeps ETags from a previous run of the API from matching
+        self.epoch = os.urandom(4).hex()
+        self.version = 0
+        self.versions = dict.fromkeys(SECTIONS, 0)
+        self._rendered = {}
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._waiters = []
+
+    def state(self, section):
+        # Bodies match what the routes have always returned
+        powerhorse = self.powerhorse
+        if section == "tracks":
+            return powerhorse.tracks
+        if section == "arm":
+            return {"joints": powerhorse.arm}
+        if section == "light":
+            return {"light": powerhorse.light, "brightness": powerhorse.light_brightness, "pattern": powerhorse.light_pattern}
+        return {"camera": powerhorse.camera_angle, "tilt": powerhorse.camera_tilt}
+
+    def mark_changed(self, *sections, version=None, versions=None):
+        ''' Bumps the version of the given sections (all of them if none given)
+        and wakes up anybody long-polling for a change.
+        A mirror of another process's snapshot passes that process's `version`
+        and section `versions` instead, so ETags match whichever process answers.
+        '''
+        with self._lock:
+            self.version = version if version is not None else self.version + 1
+            if versions is not None:
+                self.versions.update(versions)
+            else:
+                for section in sections or SECTIONS:
+                    self.versions[section] = self.version
+            self._changed.notify_all()
+            waiters, self._waiters = self._waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_wake, future)
+
+    def render(self, section):
+        ''' Returns (version, body, etag) for a section, serialising it only if
+        it has changed since the last render.
+        '''
+        version = self.versions[section]
+        cached = self._rendered.get(section)
+        if cached is not None and cached[0] == version:
+            return cached
+        # The version is read before dumping, so a change that lands mid-render
+        # leaves a stale version behind and the next read renders again
+        body = json.dumps(self.state(section), separators=(",", ":")).encode()
+        cached = (version, body, 'W/"%s-%d"' % (self.epoch, version))
+        self._rendered[section] = cached
+        return cached
+
+    def wait(self, section, since, timeout):
+        ''' Blocks until the section (or with section None, any section) is newer
+        than `since` or the timeout expires. Returns True if it changed.
+        '''
+        versions = self.versions
+        with self._lock:
+            if section is None:
+                return self._changed.wait_for(lambda: self.version > since, timeout)
+            return self._changed.wait_for(lambda: versions[section] > since, timeout)
+
+    def as_dict(self):
+        ''' The state of every section together, with the version it was taken at. '''
+        with self._lock:
+            state = copy.deepcopy({section: self.state(section) for section in SECTIONS})
+            state["version"] = self.version
+        return state
+
+    async def wait_async(self, section, since, timeout):
+        ''' asyncio flavour of wait() for the long-poll routes. '''
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            with self._lock:
+                if self.versions[section] > since:
+                    return True
+                future = loop.create_future()
+                self._waiters.append((loop, future))
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return False
+            try:
+                await asyncio.wait_for(future, remaining)
+            except asyncio.TimeoutError:
+                with self._lock:
+                    if (loop, future) in self._waiters:
+                        self._waiters.remove((loop, future))
+                return self.versions[section] > since
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
@@ -0,0 +1,160 @@
+#!/usr/bin/python
+
+# Lightweight latency tracing for the PowerHorse.
+# A sampled request gets a trace; spans opened while it is current (in the handler,
+# on the scheduler thread, down to the gpiozero and I2C writes) are kept in a ring
+# and can be exported in the Chrome trace format (load it in chrome://tracing or
+# https://ui.perfetto.dev) or summarised per route. When a request isn't sampled a
+# span costs one context variable lookup.
+
+import contextvars
+import functools
+import itertools
+import os
+import random
+import threading
+import time
+from collections import deque
+
+_current = contextvars.ContextVar("trace_span", default=None)
+_ids = itertools.count(1)
+
+
+class _NoSpan:
+    # Handed out when nothing is being traced
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def rename(self, name):
+        pass
+
+_NO_SPAN = _NoSpan()
+
+
+class Span:
+    __slots__ = ("tracer", "trace", "id", "parent", "name", "start", "token")
+
+    def __init__(self, tracer, trace, parent, name):
+        self.tracer = tracer
+        self.trace = trace
+        self.id = next(_ids)
+        self.parent = parent
+        self.name = name
+        self.start = 0.0
+        self.token = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.token = _current.set(self)
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        _current.reset(self.token)
+        self.tracer.spans.append((self.trace, self.id, self.parent, self.name, self.start, end, threading.get_ident()))
+        return False
+
+    def rename(self, name):
+        self.name = name
+
+
+class Tracer:
+    ''' Collects spans of sampled traces.
+
+    Arguments:
+    sample_rate = fraction of traces recorded, 0 to 1
+    capacity = number of spans kept, the oldest are dropped first
+    '''
+    def __init__(self, sample_rate=0.01, capacity=20000):
+        self.sample_rate = sample_rate
+        self.spans = deque(maxlen=capacity)
+
+    def trace(self, name, force=False):
+        ''' Starts a new trace if this one is sampled (or forced), returns a span context manager. '''
+        if force or (self.sample_rate > 0 and random.random() < self.sample_rate):
+            return Span(self, next(_ids), None, name)
+        return _NO_SPAN
+
+    def span(self, name):
+        ''' A child span of the current one, a no-op when nothing is being traced. '''
+        parent = _current.get()
+        if parent is None:
+            return _NO_SPAN
+        return Span(self, parent.trace, parent.id, name)
+
+    def traced(self, name):
+        ''' Decorator wrapping every call of a function in a span. '''
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                parent = _current.get()
+                if parent is None:
+                    return fn(*args, **kwargs)
+                with Span(self, parent.trace, parent.id, name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record(self, name, start, end):
+        ''' Adds a span that has already finished, e.g. time spent waiting in a queue. '''
+        parent = _current.get()
+        if parent is not None:
+            self.spans.append((parent.trace, next(_ids), parent.id, name, start, end, threading.get_ident()))
+
+    def active(self):
+        return _current.get() is not None
+
+    def clear(self):
+        self.spans.clear()
+
+    def chrome_trace(self):
+        ''' The recorded spans as a Chrome trace event document. '''
+        pid = os.getpid()
+        events = []
+        for trace, span_id, parent, name, start, end, tid in list(self.spans):
+            events.append({"name": name, "ph": "X", "ts": start * 1e6, "dur": (end - start) * 1e6,
+                           "pid": pid, "tid": tid, "args": {"trace": trace, "span": span_id, "parent": parent}})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def breakdown(self):
+        ''' Where the time goes per route: for each root span name the number of traces,
+        the mean total and the mean self time (time not in a child span) of each span name.
+        '''
+        traces = {}
+        for span in list(self.spans):
+            traces.setdefault(span[0], []).append(span)
+        routes = {}
+        for spans in traces.values():
+            roots = [span for span in spans if span[2] is None]
+            if not roots:
+                # the root is still running or has been dropped from the ring
+                continue
+            child_time = {}
+            for trace, span_id, parent, name, start, end, tid in spans:
+                if parent is not None:
+                    child_time[parent] = child_time.get(parent, 0.0) + (end - start)
+            route = routes.setdefault(roots[0][3], {"count": 0, "total": 0.0, "spans": {}})
+            route["count"] += 1
+            route["total"] += roots[0][5] - roots[0][4]
+            for trace, span_id, parent, name, start, end, tid in spans:
+                totals = route["spans"].setdefault(name, [0.0, 0.0])
+                totals[0] += end - start
+                totals[1] += (end - start) - child_time.get(span_id, 0.0)
+        result = {}
+        for name, route in routes.items():
+            count = route["count"]
+            result[name] = {
+                "count": count,
+                "mean_ms": route["total"] / count * 1000,
+                "spans": {span: {"mean_ms": total / count * 1000, "self_ms": own / count * 1000,
+                                 "share": own / route["total"] if route["total"] else 0.0}
+                          for span, (total, own) in sorted(route["spans"].items(), key=lambda item: -item[1][1])},
+            }
+        return result
+
+
+# The process-wide tracer, the sample rate can be set with POWERHORSE_TRACE_SAMPLE
+tracer = Tracer(float(os.environ.get("POWERHORSE_TRACE_SAMPLE", "0.01")))
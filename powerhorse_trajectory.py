@@ -0,0 +1,357 @@
+#!/usr/bin/python
+
+# Track routes compiled ahead of time into PCA9685 register plans.
+# A route is a timeline of throttle and differential steps. The compiler runs the same
+# mixing as PowerHorse.set_tracks over the whole route at once with NumPy and works out,
+# for every tick, the registers of the six track channels and which of them changed since
+# the tick before. Playing the plan back is then one I2C block write of just the changed
+# registers per tick, at fixed deadlines, with nothing left to work out on the way.
+#
+# A timeline is CSV with a header (time,throttle,differential, time in seconds) or JSON,
+# a list of {"time": ..., "throttle": ..., "differential": ...} or of [time, throttle, differential].
+# Each step holds until the next one (or, with ramp, moves steadily towards it) and the route
+# ends at the last step's time with the tracks stopped.
+#
+#   python powerhorse_trajectory.py compile inspection.csv inspection.plan --rate 50
+#   python powerhorse_trajectory.py show inspection.plan
+#   python powerhorse_trajectory.py play inspection.plan
+#
+# A plan plays on a running robot through PUT /powerhorse/trajectory; any other command to
+# the tracks, a stop or a safety rule stepping in, ends it.
+
+import argparse
+import csv
+import json
+import struct
+import sys
+import threading
+import time
+
+import numpy as np
+
+from powerhorse_robot import CONTROL_RATE, MotorDriver
+from powerhorse_scheduler import current_source
+
+MAGIC = b"PHTP"
+VERSION = 1
+# magic, version, first channel, channels, ticks a second, ticks
+HEADER = struct.Struct("<4sHBBdI")
+# registers of the track channels, first and last channel changed since the tick before
+# (NO_CHANGE if none), and the tracks state the tick leaves behind
+FRAME = np.dtype([("registers", "u1", (24,)), ("first", "u1"), ("last", "u1"),
+                  ("throttle", "<f8"), ("differential", "<f8"), ("duty", "<f8", (2,))])
+NO_CHANGE = 0xFF
+
+# First ON_L register, each channel has ON_L, ON_H, OFF_L, OFF_H
+LED0_ON_L = 0x06
+
+# The track channels plans are compiled for, the default ones of MotorDriver
+_driver = MotorDriver(None)
+PWM_CHANNELS = _driver.speed_channels
+IN_CHANNELS = _driver.input_channels
+FIRST_CHANNEL = min(PWM_CHANNELS + sum(IN_CHANNELS, ()))
+CHANNELS = 6
+
+
+def mix_tracks_array(throttle, differential):
+    ''' powerhorse_robot.mix_tracks over whole arrays: returns (forward, left, right). '''
+    throttle = np.clip(throttle, -100, 100)
+    differential = np.clip(differential, -100, 100)
+    forward = throttle >= 0
+    speed = np.abs(throttle)
+    left = np.where(differential > 50, speed * ((differential - 50) / 50),
+                    np.where(differential > 0, speed * (1 - differential / 50), speed))
+    right = np.where(differential < -50, speed * ((-differential - 50) / 50),
+                     np.where(differential < 0, speed * (1 + differential / 50), speed))
+    return forward, np.clip(left, 0, 100), np.clip(right, 0, 100)
+
+
+def read_timeline(path):
+    ''' Reads a CSV or JSON timeline, returns arrays of times, throttles and differentials. '''
+    with open(path) as f:
+        if path.endswith(".json"):
+            steps = json.load(f)
+            rows = [(step["time"], step["throttle"], step.get("differential", 0)) if isinstance(step, dict)
+                    else tuple(step) for step in steps]
+        else:
+            rows = [(row["time"], row["throttle"], row.get("differential") or 0) for row in csv.DictReader(f)]
+    timeline = np.array(rows, dtype=float).reshape(-1, 3)
+    return timeline[:, 0], timeline[:, 1], timeline[:, 2]
+
+
+def compile_route(times, throttle, differential, rate=CONTROL_RATE, ramp=False):
+    ''' Compiles a timeline into a TrackPlan.
+
+    Arguments:
+    times = time of each step in seconds, increasing
+    throttle, differential = of each step, -100 to 100
+    rate = ticks a second the plan is played at
+    ramp = move steadily from one step to the next instead of holding each step
+    '''
+    times = np.asarray(times, dtype=float)
+    throttle = np.asarray(throttle, dtype=float)
+    differential = np.asarray(differential, dtype=float)
+    if len(times) == 0:
+        raise ValueError("The timeline is empty")
+    if np.any(np.diff(times) <= 0) or times[0] < 0:
+        raise ValueError("The timeline's times have to start at 0 or later and keep increasing")
+
+    # each step starts on the tick nearest its time; ticks run up to the end of the route,
+    # then one more stops the tracks
+    starts = np.round(times * rate)
+    ticks = np.arange(int(starts[-1]))
+    if ramp:
+        throttle = np.interp(ticks, starts, throttle, left=0)
+        differential = np.interp(ticks, starts, differential, left=0)
+    else:
+        step = np.searchsorted(starts, ticks, side="right") - 1
+        before = step < 0
+        throttle = np.where(before, 0, throttle[step])
+        differential = np.where(before, 0, differential[step])
+    throttle = np.append(np.clip(throttle, -100, 100), 0)
+    differential = np.append(differential, 0)
+
+    forward, left, right = mix_tracks_array(throttle, differential)
+    # the OFF counts MotorDriver.MotorRun would write, the ON counts are all 0
+    off = np.zeros((len(throttle), CHANNELS), dtype=np.uint16)
+    for side, speed in enumerate((left, right)):
+        off[:, PWM_CHANNELS[side] - FIRST_CHANNEL] = np.trunc(speed * int(4096 / 100))
+        in1, in2 = IN_CHANNELS[side]
+        off[:, in1 - FIRST_CHANNEL] = np.where(forward, 0, 4095)
+        off[:, in2 - FIRST_CHANNEL] = np.where(forward, 4095, 0)
+
+    frames = np.zeros(len(throttle), dtype=FRAME)
+    registers = frames["registers"].reshape(-1, CHANNELS, 4)
+    registers[:, :, 2] = off & 0xFF
+    registers[:, :, 3] = off >> 8
+    first, last = changed_span(off[:-1], off[1:])
+    # the first tick writes every channel, nothing is known about them before
+    frames["first"] = np.append(0, first)
+    frames["last"] = np.append(CHANNELS - 1, last)
+    frames["throttle"] = throttle
+    frames["differential"] = differential
+    sign = np.where(forward, 1.0, -1.0)
+    frames["duty"][:, 0] = sign * left
+    frames["duty"][:, 1] = sign * right
+    return TrackPlan(rate, frames)
+
+
+def changed_span(before, after):
+    ''' First and last channel that differ between rows of OFF counts, NO_CHANGE where none do. '''
+    changed = before != after
+    any_changed = changed.any(axis=1)
+    first = np.where(any_changed, changed.argmax(axis=1), NO_CHANGE)
+    last = np.where(any_changed, CHANNELS - 1 - changed[:, ::-1].argmax(axis=1), NO_CHANGE)
+    return first, last
+
+
+class TrackPlan:
+    ''' A compiled route, a frame of track registers per tick.
+
+    Arguments:
+    rate = ticks a second
+    frames = NumPy array of FRAME, one per tick
+    '''
+    def __init__(self, rate, frames):
+        self.rate = rate
+        self.frames = frames
+
+    @property
+    def ticks(self):
+        return len(self.frames)
+
+    @property
+    def duration(self):
+        return self.ticks / self.rate
+
+    def off_counts(self, tick):
+        registers = self.frames["registers"][tick].reshape(CHANNELS, 4).astype(np.uint16)
+        return registers[:, 2] | (registers[:, 3] << 8)
+
+    def to_bytes(self):
+        return HEADER.pack(MAGIC, VERSION, FIRST_CHANNEL, CHANNELS, self.rate, self.ticks) + self.frames.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        if len(data) < HEADER.size:
+            raise ValueError("Not a PowerHorse track plan")
+        magic, version, first_channel, channels, rate, ticks = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not a PowerHorse track plan, or one from another version")
+        if not rate > 0:
+            raise ValueError("The plan's rate is %g ticks a second" % rate)
+        if (first_channel, channels) != (FIRST_CHANNEL, CHANNELS):
+            raise ValueError("The plan was compiled for track channels %d-%d" % (first_channel, first_channel + channels - 1))
+        if len(data) != HEADER.size + ticks * FRAME.itemsize:
+            raise ValueError("The plan is %d bytes, %d ticks need %d" % (len(data), ticks, HEADER.size + ticks * FRAME.itemsize))
+        return cls(rate, np.frombuffer(data, dtype=FRAME, offset=HEADER.size).copy())
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            f.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            return cls.from_bytes(f.read())
+
+    def summary(self):
+        writes = self.frames["first"] != NO_CHANGE
+        spans = self.frames["last"][writes].astype(int) - self.frames["first"][writes] + 1
+        return {"rate": self.rate, "ticks": self.ticks, "duration": self.duration, "bytes": len(self.to_bytes()),
+                "writes": int(writes.sum()), "register_bytes": int(spans.sum() * 4),
+                "throttle": [float(self.frames["throttle"].min()), float(self.frames["throttle"].max())]}
+
+    def player(self, powerhorse):
+        ''' A TrackPlayer for a PowerHorse's tracks, ready to start. '''
+        if powerhorse.track_motors.channels != _driver.channels:
+            raise ValueError("Plans are compiled for the tracks on PCA9685 channels %s, this robot's are on %s"
+                             % (_driver.channels, powerhorse.track_motors.channels))
+        return TrackPlayer(powerhorse, self)
+
+
+class TrackPlayer:
+    ''' Plays a TrackPlan from a thread of its own, writing each tick's registers at its deadline.
+    A tick that is missed altogether is skipped, the next one written brings every channel
+    up to date. A tick whose throttle is outside the tracks' limits, because a safety rule has
+    narrowed them since the route started, ends the route: the plan's last tick is written
+    instead, stopping the tracks.
+
+    Arguments:
+    powerhorse = the PowerHorse whose tracks are driven
+    plan = the TrackPlan
+    '''
+    def __init__(self, powerhorse, plan):
+        self.powerhorse = powerhorse
+        self.plan = plan
+        frames = plan.frames
+        # everything a tick does, worked out before the first one
+        self.blocks = [None if frame["first"] == NO_CHANGE else
+                       (LED0_ON_L + 4 * (FIRST_CHANNEL + frame["first"]),
+                        frame["registers"][frame["first"] * 4:(frame["last"] + 1) * 4].tolist())
+                       for frame in frames]
+        self.states = [(float(frame["throttle"]), float(frame["differential"]), tuple(frame["duty"].tolist()))
+                       for frame in frames]
+        self.tick = 0
+        self.writes = 0
+        self.skipped = 0
+        self.late_max = 0.0
+        self.aborted = False
+        self.started = None
+        self.finished = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def playing(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="trajectory", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def _run(self):
+        current_source.set("trajectory")
+        interval = 1 / self.plan.rate
+        ticks = self.plan.ticks
+        self.started = start = time.monotonic()
+        written = None
+        tick = 0
+        while tick < ticks:
+            delay = start + tick * interval - time.monotonic()
+            if delay > 0:
+                if self._stop.wait(delay):
+                    break
+            elif self._stop.is_set():
+                break
+            else:
+                self.late_max = max(self.late_max, -delay)
+                # catch up with the latest tick that's due rather than play out the missed ones
+                due = min(int(-delay / interval) + tick, ticks - 1)
+                self.skipped += due - tick
+                tick = due
+            low, high = self.powerhorse.throttle_limits
+            if not low <= self.states[tick][0] <= high:
+                self.aborted = True
+                tick = ticks - 1
+            if written is not None and written != tick - 1:
+                self._write_span(written, tick)
+            else:
+                self._write(self.blocks[tick])
+            if written is None or self.states[tick] != self.states[written]:
+                self._publish(self.states[tick])
+            written = tick
+            self.tick = tick = tick + 1
+        self.finished = time.monotonic()
+
+    def _write(self, block):
+        if block is not None:
+            self.powerhorse.pwm.writeBlock(*block)
+            self.writes += 1
+
+    def _write_span(self, before, tick):
+        first, last = changed_span(self.plan.off_counts(before)[None], self.plan.off_counts(tick)[None])
+        if first[0] != NO_CHANGE:
+            registers = self.plan.frames["registers"][tick]
+            self._write((LED0_ON_L + 4 * (FIRST_CHANNEL + first[0]), registers[first[0] * 4:(last[0] + 1) * 4].tolist()))
+
+    def _publish(self, state):
+        powerhorse = self.powerhorse
+        throttle, differential, duty = state
+        powerhorse.tracks["throttle"] = throttle
+        powerhorse.tracks["differential"] = differential
+        powerhorse.track_duty = duty
+        powerhorse.snapshot.mark_changed("tracks")
+        powerhorse._record("tracks", "set_tracks", (throttle, differential), duty)
+
+    def stats(self):
+        return {"playing": self.playing, "tick": self.tick, "ticks": self.plan.ticks, "rate": self.plan.rate,
+                "position": self.tick / self.plan.rate, "duration": self.plan.duration, "writes": self.writes,
+                "skipped": self.skipped, "aborted": self.aborted, "late_max_ms": self.late_max * 1000}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compile PowerHorse track routes into register plans and play them")
+    commands = parser.add_subparsers(dest="command", required=True)
+    compile_parser = commands.add_parser("compile", help="compile a CSV or JSON timeline into a plan")
+    compile_parser.add_argument("timeline")
+    compile_parser.add_argument("plan")
+    compile_parser.add_argument("--rate", type=float, default=CONTROL_RATE, help="ticks a second")
+    compile_parser.add_argument("--ramp", action="store_true", help="move steadily between steps instead of holding them")
+    show_parser = commands.add_parser("show", help="describe a plan")
+    show_parser.add_argument("plan")
+    play_parser = commands.add_parser("play", help="play a plan on this machine's robot, with the API not running")
+    play_parser.add_argument("plan")
+    args = parser.parse_args(argv)
+
+    if args.command == "compile":
+        times, throttle, differential = read_timeline(args.timeline)
+        started = time.perf_counter()
+        plan = compile_route(times, throttle, differential, args.rate, args.ramp)
+        elapsed = time.perf_counter() - started
+        plan.save(args.plan)
+        print("Compiled %d steps into %d ticks in %.1f ms" % (len(times), plan.ticks, elapsed * 1000))
+        print(json.dumps(plan.summary()))
+    elif args.command == "show":
+        print(json.dumps(TrackPlan.load(args.plan).summary()))
+    else:
+        from powerhorse_robot import PowerHorse
+        plan = TrackPlan.load(args.plan)
+        powerhorse = PowerHorse()
+        powerhorse.play_trajectory(plan)
+        player = powerhorse.trajectory
+        try:
+            while player.playing:
+                time.sleep(0.1)
+        finally:
+            powerhorse.set_tracks(0, 0)
+        print(json.dumps(player.stats()))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
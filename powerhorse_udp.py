@@ -0,0 +1,212 @@
+#!/usr/bin/python
+
+# Compact UDP teleop protocol for the PowerHorse.
+# A teleop client sends fixed-size setpoint frames, one per control tick, each
+# carrying the whole desired state. A lost frame is simply superseded by the next
+# one, and frames that arrive late or out of order are dropped rather than applied,
+# so a stale command can never hold up a newer one the way a TCP retransmit does.
+# The listener sends state echo frames back to its clients a few times a second.
+# The tracks and arm joints a client sets moving are leased to it and renewed by every frame,
+# so if the client goes quiet they are stopped once the lease runs out ("leases": {"udp": ...}).
+
+import asyncio
+import socket
+import struct
+import time
+
+from powerhorse_robot import JOINTS
+from powerhorse_scheduler import SAFETY, MOTION, COSMETIC, ALL
+
+MAGIC = b"PH"
+VERSION = 1
+SETPOINT = 0
+STATE = 1
+FLAG_STOP = 0x01
+
+# magic, version, kind, sequence, timestamp (us), throttle, differential,
+# shoulder, elbow, wrist, gripper, camera angle, light, flags
+FRAME = struct.Struct("<2sBBIQbb4bhBB")
+
+# A client silent for longer than this starts a new session, its sequence may restart
+SESSION_TIMEOUT = 2.0
+
+
+def _power(value):
+    return int(max(min(value, 100), -100))
+
+
+def pack_frame(kind, seq, throttle, differential, joints, camera, light, flags=0, timestamp=None):
+    if timestamp is None:
+        timestamp = int(time.time() * 1000000)
+    return FRAME.pack(MAGIC, VERSION, kind, seq & 0xFFFFFFFF, timestamp,
+                      _power(throttle), _power(differential), *[_power(power) for power in joints],
+                      int(max(min(camera, 32767), -32768)), int(bool(light)), flags)
+
+
+def unpack_frame(data):
+    ''' Returns the frame as a dict, or None if it isn't a frame of this version. '''
+    if len(data) != FRAME.size:
+        return None
+    magic, version, kind, seq, timestamp, throttle, differential, s, e, w, g, camera, light, flags = FRAME.unpack(data)
+    if magic != MAGIC or version != VERSION:
+        return None
+    return {"kind": kind, "seq": seq, "timestamp": timestamp, "throttle": throttle,
+            "differential": differential, "joints": (s, e, w, g), "camera": camera,
+            "light": bool(light), "flags": flags}
+
+
+def newer(seq, last):
+    # serial number comparison, so the 32 bit sequence can wrap around
+    return 0 < ((seq - last) & 0xFFFFFFFF) < 0x80000000
+
+
+class ClientSession:
+    __slots__ = ("seq", "timestamp", "seen")
+
+    def __init__(self, frame):
+        self.seq = frame["seq"]
+        self.timestamp = frame["timestamp"]
+        self.seen = time.monotonic()
+
+
+class UdpTeleop(asyncio.DatagramProtocol):
+    ''' Applies setpoint frames to a Robot through its scheduler.
+
+    Only the actuators whose setpoint changed since the last applied frame are sent
+    to the scheduler, so a steady stream of identical frames costs no bus traffic.
+
+    Arguments:
+    robot = the Robot from the registry
+    echo_interval = seconds between state echo frames
+    '''
+    def __init__(self, robot, echo_interval=0.1):
+        self.robot = robot
+        self.echo_interval = echo_interval
+        self.transport = None
+        self.sessions = {}
+        self.applied = None
+        self.last_seq = 0
+        self.counters = {"received": 0, "applied": 0, "stale": 0, "malformed": 0}
+        self._echo_task = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self._echo_task = asyncio.get_running_loop().create_task(self._echo())
+
+    def connection_lost(self, exc):
+        if self._echo_task is not None:
+            self._echo_task.cancel()
+
+    def datagram_received(self, data, addr):
+        self.counters["received"] += 1
+        frame = unpack_frame(data)
+        if frame is None or frame["kind"] != SETPOINT:
+            self.counters["malformed"] += 1
+            return
+        session = self.sessions.get(addr)
+        now = time.monotonic()
+        if session is None or now - session.seen > SESSION_TIMEOUT:
+            self.sessions[addr] = ClientSession(frame)
+        elif newer(frame["seq"], session.seq) and frame["timestamp"] > session.timestamp:
+            session.seq = frame["seq"]
+            session.timestamp = frame["timestamp"]
+            session.seen = now
+        else:
+            self.counters["stale"] += 1
+            return
+        self.counters["applied"] += 1
+        self.last_seq = frame["seq"]
+        self.apply(frame, "udp:%s:%d" % addr[:2])
+
+    def apply(self, frame, holder="udp"):
+        scheduler = self.robot.scheduler
+        leases = self.robot.leases
+        ttl = self.robot.config["leases"]["udp"]
+        if frame["flags"] & FLAG_STOP:
+            scheduler.submit(ALL, SAFETY, "stop", source="udp")
+            leases.release(ALL)
+            self.applied = None
+            return
+        # the stream keeps the leases of whatever it is moving, see powerhorse_lease.py
+        leases.renew(holder)
+        last = self.applied
+        if last is None or (frame["throttle"], frame["differential"]) != (last["throttle"], last["differential"]):
+            scheduler.submit("tracks", MOTION, "set_tracks", frame["throttle"], frame["differential"], source="udp")
+            self._lease("tracks", holder, ttl if frame["throttle"] else None)
+        for i, joint in enumerate(JOINTS):
+            if last is None or frame["joints"][i] != last["joints"][i]:
+                scheduler.submit("arm." + joint, MOTION, "set_arm", joint, frame["joints"][i], source="udp")
+                self._lease("arm." + joint, holder, ttl if frame["joints"][i] else None)
+        if last is None or frame["camera"] != last["camera"]:
+            scheduler.submit("camera", COSMETIC, "set_camera", frame["camera"], source="udp")
+        if last is None or frame["light"] != last["light"]:
+            scheduler.submit("light", COSMETIC, "set_light", frame["light"], source="udp")
+        self.applied = frame
+
+    def _lease(self, actuator, holder, ttl):
+        # nothing moving needs stopping
+        if ttl:
+            self.robot.leases.grant(actuator, holder, ttl)
+        else:
+            self.robot.leases.release(actuator)
+
+    def state_frame(self):
+        powerhorse = self.robot.powerhorse
+        return pack_frame(STATE, self.last_seq, powerhorse.tracks["throttle"], powerhorse.tracks["differential"],
+                          powerhorse.arm_power, powerhorse.camera_angle, powerhorse.light)
+
+    async def _echo(self):
+        while True:
+            await asyncio.sleep(self.echo_interval)
+            now = time.monotonic()
+            for addr, session in list(self.sessions.items()):
+                if now - session.seen > SESSION_TIMEOUT:
+                    del self.sessions[addr]
+            if self.sessions:
+                frame = self.state_frame()
+                for addr in self.sessions:
+                    self.transport.sendto(frame, addr)
+
+    def stats(self):
+        return dict(self.counters, clients=len(self.sessions))
+
+
+async def start_udp(robot, host, port, echo_interval=0.1):
+    ''' Starts listening for setpoint frames for `robot`, returns the UdpTeleop. '''
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_datagram_endpoint(
+        lambda: UdpTeleop(robot, echo_interval), local_addr=(host, port))
+    return protocol
+
+
+class UdpTeleopClient:
+    ''' Minimal blocking client, for teleop scripts and loopback testing.
+
+    Arguments:
+    host, port = where the robot's UDP listener is
+    '''
+    def __init__(self, host, port):
+        self.address = (host, port)
+        self.seq = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, throttle=0, differential=0, joints=(0, 0, 0, 0), camera=0, light=False, stop=False):
+        self.seq += 1
+        self.sock.sendto(pack_frame(SETPOINT, self.seq, throttle, differential, joints, camera, light,
+                                    FLAG_STOP if stop else 0), self.address)
+        return self.seq
+
+    def receive_state(self, timeout=1.0):
+        ''' Waits for the next state echo frame, returns it as a dict or None on timeout. '''
+        self.sock.settimeout(timeout)
+        try:
+            while True:
+                data, addr = self.sock.recvfrom(FRAME.size)
+                frame = unpack_frame(data)
+                if frame is not None and frame["kind"] == STATE:
+                    return frame
+        except socket.timeout:
+            return None
+
+    def close(self):
+        self.sock.close()
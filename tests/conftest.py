@@ -0,0 +1,28 @@
+import os
+import sys
+
+import pytest
+from fastapi.testclient import TestClient
+
+# The modules live at the top of the repository, and the tests drive simulated robots
+# (powerhorse_sim.py) rather than the hardware
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("POWERHORSE_SIM", "1")
+os.environ.pop("POWERHORSE_SHM", None)
+os.environ.pop("POWERHORSE_ROBOTS", None)
+
+
+@pytest.fixture(scope="session")
+def client():
+    # The API's robots are made when it is imported and closed when the app shuts down,
+    # so every test shares one app started once
+    import powerhorse_control_api
+    with TestClient(powerhorse_control_api.app) as client:
+        yield client
+
+
+@pytest.fixture
+def recording(tmp_path):
+    # Where a test's flight recording goes, the recorder is off by default and recordings
+    # never land in the repository
+    return str(tmp_path / "powerhorse.rec")
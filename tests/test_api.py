@@ -0,0 +1,54 @@
+import pytest
+
+
+def test_arm_joint(client):
+    assert client.put("/powerhorse/arm/wrist/30").json() == {"joint": "wrist", "power": 30}
+    assert client.get("/powerhorse/arm/wrist").json() == {"joint": "wrist", "power": 30}
+    client.put("/powerhorse/arm/stop")
+
+
+@pytest.mark.parametrize("method, path", [("get", "/powerhorse/arm/knee"), ("put", "/powerhorse/arm/knee/30"),
+                                          ("put", "/powerhorse/arm/stop/knee")])
+def test_unknown_arm_joint(client, method, path):
+    response = getattr(client, method)(path)
+    assert response.status_code == 404
+    assert "shoulder, elbow, wrist, gripper" in response.json()["detail"]
+
+
+def test_batch_arguments_are_converted(client):
+    response = client.post("/powerhorse/batch", json=[{"op": "set_camera", "args": ["12"]},
+                                                      {"op": "set_arm", "args": ["wrist", "25"]}])
+    assert response.status_code == 200
+    assert [result["ok"] for result in response.json()["results"]] == [True, True]
+    assert client.get("/powerhorse/camera").json()["camera"] == 12
+    assert client.get("/powerhorse/arm/wrist").json()["power"] == 25
+    client.put("/powerhorse/arm/stop")
+
+
+@pytest.mark.parametrize("command", [{"op": "set_arm", "args": ["wrist", "abc"]},
+                                     {"op": "set_tracks", "args": [{"x": 1}, 0]},
+                                     {"op": "set_light", "args": ["yes"]},
+                                     {"op": "set_camera", "args": [12.5]},
+                                     {"op": "set_light_pattern", "args": [3]},
+                                     {"op": "set_tracks", "args": [10]}])
+def test_batch_with_bad_arguments_is_refused(client, command):
+    response = client.post("/powerhorse/batch", json=[{"op": "set_light", "args": [True]}, command])
+    assert response.status_code == 422
+    assert command["op"] in response.json()["detail"]
+
+
+@pytest.mark.parametrize("power", [0, 5, -10, "nan"])
+def test_goto_with_power_inside_the_deadband_is_refused(client, power):
+    # the wrist's deadband is 10% duty, it would never move and the target never clear
+    response = client.put("/powerhorse/arm/wrist/goto/40", params={"power": power})
+    assert response.status_code == 422
+    assert "deadband" in response.json()["detail"]
+    assert "wrist" not in client.get("/powerhorse/estimate").json()["targets"]
+
+
+def test_goto_sets_a_target(client):
+    response = client.put("/powerhorse/arm/wrist/goto/40", params={"power": 30})
+    assert response.json() == {"joint": "wrist", "target": 40}
+    assert client.get("/powerhorse/estimate").json()["targets"]["wrist"] == 40
+    client.put("/powerhorse/arm/stop")
+    client.put("/powerhorse/estimate/reset")
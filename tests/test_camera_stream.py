@@ -0,0 +1,44 @@
+import asyncio
+import time
+
+from powerhorse_camera_stream import CameraStream, FrameSource
+
+
+class CountingSource(FrameSource):
+    def __init__(self):
+        self.count = 0
+
+    def read(self):
+        time.sleep(0.005)
+        self.count += 1
+        return b"\xff\xd8frame %06d\xff\xd9" % self.count
+
+
+def test_viewers_share_frames_and_skip_ahead():
+    stream = CameraStream(CountingSource(), linger=0)
+
+    async def watch(delay):
+        frames = []
+        viewer = stream.frames_of()
+        async for header, frame in viewer:
+            frames.append((header, frame))
+            # a slow send, several frames are produced meanwhile
+            await asyncio.sleep(delay)
+            if len(frames) == 3:
+                break
+        await viewer.aclose()
+        return frames
+
+    async def both():
+        return await asyncio.gather(watch(0.05), watch(0.05))
+
+    first, second = asyncio.run(both())
+    for header, frame in first:
+        assert header.endswith(b"Content-Length: %d\r\n\r\n" % len(frame))
+    numbers = [int(frame[8:14]) for header, frame in first]
+    assert numbers == sorted(set(numbers))
+    assert numbers[-1] - numbers[0] > 2
+    # the same bytes object went to both viewers, nothing was copied per viewer
+    shared = {id(frame) for header, frame in first} & {id(frame) for header, frame in second}
+    assert shared
+    assert stream.viewers == 0
@@ -0,0 +1,156 @@
+import asyncio
+import threading
+
+import httpx
+import pytest
+
+import powerhorse_control_api
+from powerhorse_client import AsyncPowerHorseClient, Fleet, PowerHorseError
+
+
+class RecordingTransport(httpx.ASGITransport):
+    # The API in this process, remembering each request and the status it got
+    def __init__(self):
+        super().__init__(app=powerhorse_control_api.app)
+        self.exchanges = []
+
+    async def handle_async_request(self, request):
+        response = await super().handle_async_request(request)
+        self.exchanges.append((request, response.status_code))
+        return response
+
+
+def run(test, **kwargs):
+    # Runs `test(robot_client, transport)` against the default robot, the app is started by
+    # the session's `client` fixture
+    async def go():
+        transport = RecordingTransport()
+        async with AsyncPowerHorseClient("http://powerhorse", transport=transport, **kwargs) as robot_client:
+            return await test(robot_client, transport)
+    return asyncio.run(go())
+
+
+def test_single_commands_share_the_connection_pool(client):
+    async def test(robot_client, transport):
+        # more commands at once than there are connections, on actuators of their own
+        results = await asyncio.gather(robot_client.command("set_camera", 40), robot_client.command("set_camera_tilt", 30),
+                                       robot_client.command("set_light_brightness", 60), robot_client.command("set_light_pattern", "solid"))
+        return results, await robot_client.state("camera"), await robot_client.state("light")
+    results, camera, light = run(test, connections=2)
+    assert len(results) == 4
+    assert camera == {"camera": 40, "tilt": 30}
+    assert light["brightness"] == 60 and light["pattern"] == "solid"
+
+
+def test_batch_results_in_order(client):
+    robot = powerhorse_control_api.registry.default
+
+    async def test(robot_client, transport):
+        return await robot_client.batch([("set_light", True), ("set_light_brightness", 40), ("set_camera_tilt", 20)])
+    results = run(test)
+    assert [result["ok"] for result in results] == [True, True, True]
+    assert robot.powerhorse.light and robot.powerhorse.light_brightness == 40
+
+
+def test_batch_command_cancelled_by_a_stop(client, monkeypatch):
+    # A command still queued behind a slow one when the batch's stop arrives comes back as
+    # {"ok": False, "status": 409, ...} while the rest of the batch goes through
+    robot = powerhorse_control_api.registry.default
+    release = threading.Event()
+    set_camera = robot.powerhorse.set_camera
+    monkeypatch.setattr(robot.powerhorse, "set_camera", lambda angle: release.wait(5) and set_camera(angle))
+    busy = robot.scheduler.submit("camera", 2, "set_camera", 45)
+
+    async def test(robot_client, transport):
+        asyncio.get_running_loop().call_later(0.2, release.set)
+        return await robot_client.batch([("set_arm", "wrist", 30), ("stop",)])
+    cancelled, stopped = run(test)
+    busy.result(5)
+    assert cancelled["ok"] is False and cancelled["status"] == 409 and "cancelled" in cancelled["detail"]
+    assert stopped["ok"] is True
+
+
+def test_batch_with_a_bad_command_sends_nothing(client):
+    robot = powerhorse_control_api.registry.default
+    robot.scheduler.wait_idle(5)
+    tilt = robot.powerhorse.snapshot.as_dict()["camera"]
+
+    async def test(robot_client, transport):
+        with pytest.raises(PowerHorseError) as raised:
+            await robot_client.batch([("set_camera_tilt", 70), ("set_arm", "knee", 30)])
+        return raised.value
+    error = run(test)
+    assert error.status == 404
+    assert robot.powerhorse.snapshot.as_dict()["camera"] == tilt
+
+
+def test_one_command_at_a_time_without_the_batch_endpoint(client):
+    async def test(robot_client, transport):
+        robot_client._features = {"batch": False, "long_poll": False}
+        results = await robot_client.batch([("set_camera", 20), ("set_arm", "knee", 30)])
+        return results, [request.method for request, status in transport.exchanges]
+    (sent, refused), methods = run(test)
+    assert sent["ok"] is True
+    assert refused == {"ok": False, "status": 404, "detail": "Unknown joint knee, choose from shoulder, elbow, wrist, gripper"}
+    assert methods == ["PUT", "PUT"]
+
+
+def watch_light(robot_client, transport):
+    # The first two light states watch() yields, the light toggled in between
+    async def test():
+        states = robot_client.watch("light", interval=0.05)
+        first = await states.__anext__()
+        asyncio.get_running_loop().call_later(0.2, lambda: asyncio.ensure_future(robot_client.command("set_light", not first["light"])))
+        second = await asyncio.wait_for(states.__anext__(), 5)
+        await states.aclose()
+        return first, second
+    return test()
+
+
+def test_watch_long_polls_with_since(client):
+    async def test(robot_client, transport):
+        first, second = await watch_light(robot_client, transport)
+        return first, second, [request for request, status in transport.exchanges if request.method == "GET" and request.url.path.endswith("/light")]
+    first, second, requests = run(test)
+    assert second["light"] is not first["light"]
+    assert "since" not in requests[0].url.params
+    assert all("since" in request.url.params for request in requests[1:])
+    # one held request is answered by the change, no polling in between
+    assert len(requests) == 2
+
+
+def test_watch_polls_with_etag(client):
+    async def test(robot_client, transport):
+        robot_client._features = {"batch": True, "long_poll": False}
+        first, second = await watch_light(robot_client, transport)
+        return first, second, [(request, status) for request, status in transport.exchanges if request.method == "GET"]
+    first, second, exchanges = run(test)
+    assert second["light"] is not first["light"]
+    assert "if-none-match" not in exchanges[0][0].headers
+    # polls before the change are answered 304 without a body
+    unchanged = [request for request, status in exchanges if status == 304]
+    assert unchanged
+    assert all(request.headers["if-none-match"] for request in unchanged)
+    assert exchanges[-1][1] == 200
+
+
+@pytest.fixture(scope="module")
+def second_robot(client):
+    registry = powerhorse_control_api.registry
+    robot = registry.get("beta") or registry.add("beta", {"recorder": {"path": None}})
+    return robot
+
+
+def test_fleet_broadcast_to_two_robots(second_robot):
+    registry = powerhorse_control_api.registry
+
+    async def test():
+        transport = httpx.ASGITransport(app=powerhorse_control_api.app)
+        async with Fleet.from_api("http://powerhorse", [registry.default_id, "beta", "gamma"], transport=transport) as fleet:
+            return await fleet.broadcast("set_camera", 35)
+    results = asyncio.run(test())
+    for robot_id in (registry.default_id, "beta"):
+        assert results[robot_id]["ok"] is True
+        assert results[robot_id]["latency_ms"] >= 0
+        assert registry.get(robot_id).powerhorse.snapshot.as_dict()["camera"]["camera"] == 35
+    assert results["gamma"]["ok"] is False and results["gamma"]["status"] == 404
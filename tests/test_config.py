@@ -0,0 +1,62 @@
+import json
+
+import pytest
+
+from powerhorse_config import ConfigError, bcm, compile_layout, main
+from powerhorse_registry import merge_config
+from powerhorse_sim import SimPowerHorse
+
+
+@pytest.mark.parametrize("pin, number", [("BOARD11", 17), ("board40", 21), ("GPIO4", 4), ("BCM27", 27), (17, 17)])
+def test_pins_are_turned_into_bcm_numbers(pin, number):
+    assert bcm(pin) == number
+
+
+@pytest.mark.parametrize("pin", ["BOARD1", "BOARD41", 28, "pin 7", None, True])
+def test_pins_that_dont_exist_are_refused(pin):
+    with pytest.raises(ValueError):
+        bcm(pin)
+
+
+def test_default_layout_compiles_to_bcm_pins():
+    layout = compile_layout(merge_config({}))
+    shoulder = layout.joints[layout.joint_index["shoulder"]]
+    # MOTOR1 is on header pins 11, 15 and 13
+    assert shoulder.pins == {"e": 17, "f": 22, "r": 27}
+    assert layout.arrows["1"] == 13
+    assert layout.track_channels == (0, 1, 2, 5, 3, 4)
+
+
+def test_motor_wired_the_other_way_round_swaps_its_pins():
+    layout = compile_layout(merge_config({"arm": {"shoulder": {"config": 2}}}))
+    assert layout.joints[0].pins == {"e": 17, "f": 27, "r": 22}
+
+
+def test_invalid_layout_lists_every_problem():
+    config = merge_config({
+        # BOARD11 is GPIO17, already MOTOR1's enable pin
+        "motor_shield": {"motors": {"MOTOR2": {"enable": "GPIO17"}}},
+        "lights": {"channels": [0, 16]},
+        "arm": {"gripper": {"motor": "MOTOR9"}},
+    })
+    with pytest.raises(ConfigError) as raised:
+        compile_layout(config)
+    message = str(raised.value)
+    assert "MOTOR1 enable (arm.shoulder) and MOTOR2 enable (arm.elbow) are both on GPIO17" in message
+    assert "tracks left pwm and light are both on PCA9685 channel 0" in message
+    assert "light: PCA9685 channel 16 does not exist" in message
+    assert "arm.gripper: there is no motor 'MOTOR9'" in message
+
+
+def test_robot_with_an_invalid_layout_is_refused_before_any_pin_is_touched():
+    with pytest.raises(ConfigError):
+        SimPowerHorse(merge_config({"track_channels": {"right": {"pwm": 0}}}))
+
+
+def test_checking_a_robots_file(tmp_path, capsys):
+    path = tmp_path / "robots.json"
+    path.write_text(json.dumps({"robots": {"alpha": {}, "beta": {"lights": {"channels": [3]}}}}))
+    assert main([str(path)]) == 1
+    out = capsys.readouterr().out
+    assert "alpha: ok" in out
+    assert "beta: The robot's hardware layout has problems" in out
@@ -0,0 +1,34 @@
+import time
+
+import pytest
+
+pytest.importorskip("gradio")
+
+from gr_interface import CommandThrottle
+from powerhorse_scheduler import MOTION
+
+
+class FlakyScheduler:
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, actuator, priority, op, *args, source="other"):
+        if not self.submitted:
+            self.submitted.append(None)
+            raise RuntimeError("Scheduler is closed")
+        self.submitted.append((actuator, op, args))
+
+
+def test_throttle_survives_a_failed_submit(capsys):
+    scheduler = FlakyScheduler()
+    throttle = CommandThrottle(scheduler, rate=100)
+    throttle.send("tracks", MOTION, "set_throttle", 10)
+    deadline = time.monotonic() + 2
+    while len(scheduler.submitted) < 1 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    throttle.send("tracks", MOTION, "set_throttle", 20)
+    while len(scheduler.submitted) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert throttle._thread.is_alive()
+    assert scheduler.submitted[1] == ("tracks", "set_throttle", (20,))
+    assert "Scheduler is closed" in capsys.readouterr().err
@@ -0,0 +1,120 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+
+from powerhorse_control_api import lease_ttl
+from powerhorse_lease import LeaseKeeper
+from powerhorse_scheduler import SAFETY
+from powerhorse_sim import SimRobot
+
+CONFIG = {"ttl": None, "max": 30, "udp": 1.0}
+
+
+class RecordingScheduler:
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, actuator, priority, op, *args, source="other"):
+        self.submitted.append((actuator, priority, op, args, source))
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_lease_runs_out_unless_renewed():
+    scheduler, clock = RecordingScheduler(), Clock()
+    leases = LeaseKeeper(scheduler, CONFIG, clock=clock)
+    leases.grant("tracks", "alice", 1)
+    leases.grant("arm.elbow", "alice", 2)
+    clock.now = 0.8
+    assert leases.heartbeat("alice") == 2
+    leases.tick(1.5)
+    assert scheduler.submitted == []
+    leases.tick(1.9)
+    assert scheduler.submitted == [("tracks", SAFETY, "set_tracks", (0, 0), "lease")]
+    leases.tick(2.9)
+    assert scheduler.submitted[1] == ("arm.elbow", SAFETY, "set_arm", ("elbow", 0), "lease")
+    assert leases.stats()["expired"] == 2
+    assert leases.leases == {} and leases.held == {}
+
+
+def test_released_and_taken_over_leases_dont_stop_anything():
+    scheduler, clock = RecordingScheduler(), Clock()
+    leases = LeaseKeeper(scheduler, CONFIG, clock=clock)
+    leases.grant("tracks", "alice", 1)
+    leases.grant("arm.wrist", "alice", 1)
+    # a command without a lease ends the one on its actuator
+    leases.update("arm", "bob", None)
+    leases.grant("tracks", "bob", 5)
+    leases.tick(2)
+    assert scheduler.submitted == []
+    assert leases.stats()["leases"]["tracks"]["holder"] == "bob"
+    leases.tick(5)
+    assert scheduler.submitted == [("tracks", SAFETY, "set_tracks", (0, 0), "lease")]
+
+
+def test_ttl_is_capped():
+    leases = LeaseKeeper(RecordingScheduler(), dict(CONFIG, max=3), clock=Clock())
+    leases.grant("tracks", "alice", 60)
+    assert leases.leases["tracks"].ttl == 3
+
+
+def test_timer_thread_expires_leases():
+    scheduler = RecordingScheduler()
+    leases = LeaseKeeper(scheduler, CONFIG)
+    leases.start()
+    try:
+        leases.grant("tracks", "alice", 0.05)
+        deadline = time.monotonic() + 2
+        while not scheduler.submitted and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert scheduler.submitted == [("tracks", SAFETY, "set_tracks", (0, 0), "lease")]
+    finally:
+        leases.close()
+
+
+def test_simulated_leases_follow_the_virtual_clock():
+    robot = SimRobot("lease-test", {"sim": {"speed": None}, "recorder": {"path": None}})
+    try:
+        simulator = robot.simulator
+        simulator.command("set_tracks", 40, 0)
+        robot.leases.grant("tracks", "alice", 1)
+        simulator.run_until(0.9)
+        assert robot.powerhorse.tracks["throttle"] == 40
+        simulator.run_until(1.2)
+        robot.scheduler.wait_idle()
+        assert robot.powerhorse.tracks["throttle"] == 0
+        assert robot.leases.stats()["expired"] == 1
+    finally:
+        robot.close()
+
+
+def robot_with(ttl):
+    return SimpleNamespace(config={"leases": dict(CONFIG, ttl=ttl)}, leases=object())
+
+
+def test_default_ttl_is_a_maximum():
+    robot = robot_with(2)
+    assert lease_ttl(robot, None) == 2
+    assert lease_ttl(robot, 0.5) == 0.5
+    assert lease_ttl(robot, 10) == 2
+    for ttl in (0, -1, float("nan")):
+        with pytest.raises(HTTPException) as exc:
+            lease_ttl(robot, ttl)
+        assert exc.value.status_code == 422
+
+
+def test_ttl_without_a_default():
+    robot = robot_with(None)
+    assert lease_ttl(robot, None) is None
+    assert lease_ttl(robot, 0) is None
+    assert lease_ttl(robot, 10) == 10
+    with pytest.raises(HTTPException):
+        lease_ttl(robot, -1)
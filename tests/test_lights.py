@@ -0,0 +1,62 @@
+import pytest
+
+from powerhorse_lights import BRIGHTNESS, Lights
+from powerhorse_sim import FULL, SimPCA9685
+from powerhorse_trajectory import LED0_ON_L
+
+CHANNELS = [12, 13]
+
+
+def registers(pwm, channel):
+    # ON and OFF counts of a channel and whether its full-on and full-off bits are set
+    on_l, on_h, off_l, off_h = pwm.bus.regs[LED0_ON_L + 4 * channel:LED0_ON_L + 4 * channel + 4]
+    return {"on": (on_h & 0x0F) << 8 | on_l, "off": (off_h & 0x0F) << 8 | off_l,
+            "full_on": bool(on_h & FULL), "full_off": bool(off_h & FULL)}
+
+
+def make_lights():
+    pwm = SimPCA9685(0x40)
+    return pwm, Lights(pwm, {"channels": CHANNELS}, 20)
+
+
+def test_full_on_and_off_use_the_full_bits():
+    pwm, lights = make_lights()
+    lights.set(on=True)
+    for channel in CHANNELS:
+        assert registers(pwm, channel)["full_on"] and not registers(pwm, channel)["full_off"]
+        assert pwm.bus.duty(channel) == 1.0
+    lights.set(on=False)
+    for channel in CHANNELS:
+        assert registers(pwm, channel)["full_off"]
+        assert pwm.bus.duty(channel) == 0.0
+
+
+def test_brightness_is_a_phase_shifted_pulse():
+    pwm, lights = make_lights()
+    lights.set(on=True)
+    lights.set(brightness=50)
+    duty = BRIGHTNESS[50]
+    # gamma corrected, half brightness is well under half duty
+    assert 0 < duty < 4096 // 4
+    for channel, phase in zip(CHANNELS, (0, 2048)):
+        assert registers(pwm, channel) == {"on": phase, "off": phase + duty, "full_on": False, "full_off": False}
+        assert pwm.bus.duty(channel) * 4096 == duty
+
+
+def test_blink_pattern_steps_with_the_loop():
+    pwm, lights = make_lights()
+    lights.set(on=True, pattern="blink")
+    seen = []
+    for step in range(40):
+        lights.tick(step / 20)
+        seen.append(pwm.bus.duty(CHANNELS[0]))
+    # 1 Hz, half on, for two seconds
+    assert seen == ([1.0] * 10 + [0.0] * 10) * 2
+    # only the changes are written, to both lights
+    assert lights.writes == 4 * len(CHANNELS)
+
+
+def test_unknown_pattern_is_refused():
+    pwm, lights = make_lights()
+    with pytest.raises(ValueError, match="Unknown light pattern"):
+        lights.set(pattern="disco")
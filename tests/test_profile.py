@@ -0,0 +1,54 @@
+import asyncio
+import time
+
+from powerhorse_profile import LoopLagMonitor
+
+
+async def blocking_handler():
+    time.sleep(0.2)
+
+
+def watch(monitor):
+    async def run():
+        monitor.start(asyncio.get_running_loop())
+        await asyncio.sleep(0.05)
+        await asyncio.create_task(blocking_handler())
+        await asyncio.sleep(0.05)
+        monitor.stop()
+    asyncio.run(run())
+
+
+def test_stall_is_reported_with_its_coroutine():
+    monitor = LoopLagMonitor(threshold=0.05)
+    watch(monitor)
+    stalls = monitor.report()["stalls"]
+    assert len(stalls) == 1
+    assert stalls[0]["task"] == "blocking_handler"
+    assert stalls[0]["blocked_ms"] >= 150
+    assert any("blocking_handler" in line for line in stalls[0]["stack"])
+
+
+def test_monitor_can_be_restarted():
+    monitor = LoopLagMonitor(threshold=0.05)
+    watch(monitor)
+    watch(monitor)
+    assert len(monitor.report()["stalls"]) == 2
+
+
+async def blocking_route():
+    time.sleep(0.2)
+    return {}
+
+
+def test_stall_in_a_route_names_the_route(client):
+    # Under the server the outermost coroutine is the server's own request task, the stall
+    # has to be put down to the endpoint that blocked
+    import powerhorse_control_api
+    app = powerhorse_control_api.app
+    app.add_api_route("/test/blocking", blocking_route, methods=["GET"])
+    try:
+        assert client.get("/test/blocking").status_code == 200
+        stalls = client.get("/admin/loop-lag").json()["stalls"]
+    finally:
+        app.router.routes[:] = [route for route in app.router.routes if getattr(route, "path", None) != "/test/blocking"]
+    assert stalls[-1]["task"] == "blocking_route"
@@ -0,0 +1,69 @@
+import asyncio
+
+import pytest
+
+from powerhorse_ratelimit import FORGET, Coalesced, RateLimiter, TokenBucket, current_client
+from powerhorse_robot import DEFAULT_CONFIG
+from powerhorse_scheduler import MOTION, SAFETY
+
+LIMITS = dict(DEFAULT_CONFIG["limits"], bus_rate=200, actuator_rate=20, burst=5, idle=2.0)
+
+
+def test_token_bucket_bursts_then_refills():
+    bucket = TokenBucket(10, 3, 0.0)
+    for _ in range(3):
+        assert bucket.delay(0.0) == 0
+        bucket.take()
+    assert bucket.delay(0.0) == pytest.approx(0.1)
+    assert bucket.delay(0.05) == pytest.approx(0.05)
+    assert bucket.delay(0.1) == 0
+    bucket.take()
+    # never more than the burst, however long it has been
+    assert bucket.delay(100.0) == 0
+    assert bucket.tokens == 3
+
+
+def test_bus_is_shared_between_active_clients():
+    limiter = RateLimiter(LIMITS)
+    alice = limiter._client("alice", 0.0)
+    assert alice.share.rate == 200
+    bob = limiter._client("bob", 0.5)
+    assert alice.share.rate == bob.share.rate == 100
+    # bob goes quiet and stops counting once a sweep finds the client idle
+    limiter._client("alice", 2.1)
+    assert limiter.active == {"alice", "bob"}
+    limiter._client("alice", 4.2)
+    assert limiter.active == {"alice"}
+    assert alice.share.rate == 200
+    limiter._client("bob", 4.3)
+    assert alice.share.rate == bob.share.rate == 100
+
+
+def test_gone_clients_are_forgotten():
+    limiter = RateLimiter(LIMITS)
+    for i in range(1000):
+        limiter._client("client%d" % i, i * 0.001)
+    streaming = limiter._client("streaming", 1.0)
+    streaming.streams = 1
+    limiter._client("alice", FORGET + 5)
+    assert set(limiter.clients) == {"alice", "streaming"}
+    assert limiter.active == {"alice", "streaming"}
+    assert limiter.clients["alice"].share.rate == 100
+
+
+def admit_all(limiter, commands):
+    async def run():
+        current_client.set("alice")
+        return await asyncio.gather(*[limiter.admit(*command) for command in commands], return_exceptions=True)
+    return asyncio.run(run())
+
+
+def test_over_the_limit_waits_and_the_latest_wins():
+    limiter = RateLimiter(dict(LIMITS, actuator_rate=50, burst=1))
+    results = admit_all(limiter, [("tracks", MOTION, "set_tracks")] * 3 + [("tracks", SAFETY, "set_tracks")])
+    assert results[0] is None and results[3] is None
+    assert isinstance(results[1], Coalesced)
+    assert results[2] is None
+    stats = limiter.stats()
+    assert stats["active"] == 1
+    assert stats["totals"] == {"admitted": 1, "delayed": 1, "coalesced": 1, "refused_streams": 0}
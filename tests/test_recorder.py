@@ -0,0 +1,55 @@
+import struct
+
+from powerhorse_recorder import HEADER_SIZE, RECORD, FlightRecorder, read_records
+from powerhorse_sim import SimRobot
+
+
+def record(recorder, count):
+    for i in range(count):
+        recorder.record("api", "tracks", "set_tracks", (i, -i))
+
+
+def test_ring_keeps_the_newest_records(recording):
+    recorder = FlightRecorder(recording, capacity=8)
+    record(recorder, 21)
+    recorder.close()
+    records = list(read_records(recording))
+    assert [r["index"] for r in records] == list(range(13, 21))
+    assert [r["values"][:2] for r in records] == [[i, -i] for i in range(13, 21)]
+    assert all(r["source"] == "api" and r["op"] == "set_tracks" for r in records)
+
+
+def test_reopened_recording_is_appended_to(recording):
+    recorder = FlightRecorder(recording, capacity=8)
+    record(recorder, 5)
+    recorder.close()
+    recorder = FlightRecorder(recording, capacity=8)
+    record(recorder, 5)
+    recorder.close()
+    assert [r["index"] for r in read_records(recording)] == list(range(2, 10))
+
+
+def test_torn_write_is_not_read_back(recording):
+    # A writer that died part way through a record: the count in the header was never moved
+    # on, and the slot it was writing held the oldest record
+    recorder = FlightRecorder(recording, capacity=8)
+    record(recorder, 11)
+    slot = HEADER_SIZE + (11 % 8) * RECORD.size
+    struct.pack_into("<I", recorder.map, slot, 11)
+    struct.pack_into("<f", recorder.map, slot + 16, 99.0)
+    recorder.close()
+    records = list(read_records(recording))
+    assert [r["index"] for r in records] == list(range(4, 11))
+    assert all(r["values"][0] != 99 for r in records)
+
+
+def test_robot_records_its_commands(recording):
+    robot = SimRobot("recorded", {"recorder": {"path": recording, "capacity": 64}})
+    try:
+        robot.scheduler.submit("tracks", 1, "set_tracks", 30, 10).result(2)
+        robot.scheduler.submit("camera", 2, "set_camera", 45).result(2)
+    finally:
+        robot.close()
+    commands = [(r["actuator"], r["op"], r["values"][:2]) for r in read_records(recording) if r["op"] != "stop"]
+    assert ("tracks", "set_tracks", [30, 10]) in commands
+    assert ("camera", "set_camera", [45, 0]) in commands
@@ -0,0 +1,55 @@
+import pytest
+
+from powerhorse_sim import SimRobot
+
+
+def robot_facing_obstacle(rule):
+    # driving straight at an obstacle 1.5 m ahead, the front ultrasonic sensor triggered within 30 cm
+    robot = SimRobot("safety", {"sim": {"speed": None, "obstacles": [{"x": 1.5, "y": 0, "r": 0.2}]},
+                                "sensors": {"front": {"type": "ULTRASONIC", "boundary": 30}},
+                                "safety": {"rules": [dict(rule, sensor="front")]}})
+    return robot, robot.simulator
+
+
+def test_stop_rule_stops_the_tracks_and_holds_them():
+    robot, sim = robot_facing_obstacle({"action": "stop"})
+    powerhorse = robot.powerhorse
+    try:
+        sim.command("set_tracks", 60, 0)
+        sim.run_until(3)
+        assert powerhorse.tracks["throttle"] == 60 and robot.safety.trips == 0
+        sim.run_until(8)
+        assert powerhorse.tracks["throttle"] == 0
+        assert powerhorse.throttle_limits == (-100, 0)
+        assert robot.safety.trips == 1
+        # stopped short of the obstacle
+        assert robot.model.state()["pose"]["x"] < 1.5 - 0.2 - 0.2
+
+        # forward is refused while triggered, backing away isn't, and clears the rule
+        sim.command("set_tracks", 50, 0)
+        assert powerhorse.tracks["throttle"] == 0
+        sim.command("set_tracks", -40, 0)
+        assert powerhorse.tracks["throttle"] == -40
+        sim.run_until(10)
+        assert powerhorse.throttle_limits == (-100, 100)
+    finally:
+        robot.close()
+
+
+def test_cap_rule_slows_the_tracks_with_distance():
+    robot, sim = robot_facing_obstacle({"action": "cap", "near": 10, "far": 60})
+    powerhorse = robot.powerhorse
+    try:
+        sim.command("set_tracks", 80, 0)
+        sim.run_until(1)
+        assert powerhorse.throttle_limits == (-100, 100)
+        sim.run_until(3)
+        low, high = powerhorse.throttle_limits
+        distance = powerhorse.sensors["front"].lastRead
+        assert high == pytest.approx(100 * (distance - 10) / 50)
+        assert 0 < high < 80
+        assert powerhorse.tracks["throttle"] == pytest.approx(high)
+        assert robot.safety.trips >= 1
+    finally:
+        robot.close()
+
@@ -0,0 +1,45 @@
+import pytest
+
+from powerhorse_servo import Servo
+from powerhorse_sim import SimPCA9685
+
+
+def pulse_us(pwm, channel, freq=50):
+    # the pulse width the channel's registers give, ON at 0
+    return pwm.bus.duty(channel) / freq * 1e6
+
+
+def test_servo_slews_to_its_target():
+    pwm = SimPCA9685(0x40)
+    servo = Servo(pwm, 50, {"channel": 14, "speed": 120})
+    assert servo.move_to(60) == 60
+    positions = []
+    for i in range(40):
+        servo.tick(i * 0.02)
+        positions.append(servo.position)
+    # no faster than 120 degrees a second, 2.4 per tick of 20 ms
+    steps = [b - a for a, b in zip([0.0] + positions, positions)]
+    assert all(0 <= step <= 2.4 + 1e-9 for step in steps)
+    assert positions[13] == pytest.approx(31.2)
+    assert positions[-1] == 60
+    # 500 to 2500 us over -90 to 90 degrees
+    assert pulse_us(pwm, 14) == pytest.approx(500 + 2000 * 150 / 180, abs=10)
+
+
+def test_servo_at_its_target_is_not_written_again():
+    pwm = SimPCA9685(0x40)
+    servo = Servo(pwm, 50, {"channel": 14, "speed": 120})
+    servo.move_to(10)
+    for i in range(10):
+        servo.tick(i * 0.02)
+    writes = servo.writes
+    for i in range(10, 20):
+        servo.tick(i * 0.02)
+    assert servo.writes == writes
+    assert not servo.stats()["moving"]
+
+
+def test_servo_target_is_clipped_to_its_range():
+    servo = Servo(SimPCA9685(0x40), 50, {"channel": 14, "min_angle": -45, "max_angle": 45})
+    assert servo.move_to(200) == 45
+    assert servo.move_to(-200) == -45
@@ -0,0 +1,140 @@
+import asyncio
+import multiprocessing
+import struct
+import time
+from multiprocessing import shared_memory
+from types import SimpleNamespace
+
+import pytest
+
+from powerhorse_shm import (DONE, ENTRY, SIZE, SLOT, SLOT_SIZE, SLOTS_OFFSET, STATE, STATE_OFFSET,
+                            OwnerUnavailable, RemoteRobot, RemoteScheduler, SharedMemoryOwner, read_seqlocked)
+from powerhorse_ratelimit import current_client
+from powerhorse_scheduler import MOTION
+from powerhorse_sim import SimRobot
+
+PAIR = struct.Struct("<IxxxxQQ")
+
+
+def write_seqlocked(buf, offset, write):
+    SharedMemoryOwner._write_seqlocked(SimpleNamespace(buf=buf), offset, write)
+
+
+def test_seqlock_round_trip():
+    buf = bytearray(SIZE)
+    # snapshot version, section versions, then the doubles
+    values = [1, 2, 3, 4, 5] + [0.5] * 26
+    write_seqlocked(buf, STATE_OFFSET, lambda seq: STATE.pack_into(buf, STATE_OFFSET, seq, *values))
+    read = read_seqlocked(buf, STATE_OFFSET, STATE)
+    assert read[0] == 2
+    assert list(read[1:]) == values
+
+
+def write_states(name, stop):
+    # in a process of its own, as the owner is: every double of each state written is the same
+    block = shared_memory.SharedMemory(name)
+    buf = block.buf
+    n = 0
+    while not stop.is_set():
+        n += 1
+        values = [n, 0, 0, 0, 0] + [float(n)] * 26
+        write_seqlocked(buf, STATE_OFFSET, lambda seq: STATE.pack_into(buf, STATE_OFFSET, seq, *values))
+    del buf
+    block.close()
+
+
+def test_seqlock_never_returns_a_torn_read_across_processes():
+    block = shared_memory.SharedMemory(create=True, size=SIZE)
+    context = multiprocessing.get_context("fork")
+    stop = context.Event()
+    writer = context.Process(target=write_states, args=(block.name, stop))
+    writer.start()
+    try:
+        buf = block.buf
+        reads = 0
+        deadline = time.monotonic() + 1.0
+        while time.monotonic() < deadline:
+            values = read_seqlocked(buf, STATE_OFFSET, STATE)
+            assert values[0] % 2 == 0
+            assert set(values[6:]) == {float(values[1])}
+            reads += 1
+        assert reads > 1000
+    finally:
+        stop.set()
+        writer.join()
+        del buf
+        block.close()
+        block.unlink()
+
+
+def test_seqlock_write_never_finished_raises():
+    buf = bytearray(64)
+    # an owner that died between the two halves of a write leaves the sequence odd
+    struct.pack_into("<I", buf, 0, 7)
+    started = time.monotonic()
+    with pytest.raises(OwnerUnavailable):
+        read_seqlocked(buf, 0, PAIR, timeout=0.05)
+    assert time.monotonic() - started < 1
+
+
+def test_resolve_reads_state_after_statuses():
+    buf = bytearray(SIZE)
+    refreshed = []
+    remote = SimpleNamespace(buf=buf, slot=0, check_owner=lambda: None, wake=lambda: None,
+                             refresh=lambda: refreshed.append(buf[entry + 4]),
+                             result_of=lambda op: {"refreshed": list(refreshed)})
+    scheduler = RemoteScheduler(remote)
+    entry = SLOTS_OFFSET + SLOT.size
+    future = scheduler.submit("tracks", 1, "set_tracks", 10, 0)
+    assert SLOT.unpack_from(buf, SLOTS_OFFSET)[0] == 1
+    assert ENTRY.unpack_from(buf, entry)[1] == 0
+
+    scheduler.resolve()
+    assert not future.done()
+    buf[entry + 4] = DONE
+    scheduler.resolve()
+    # the state the result is built from was read once the status was seen
+    assert future.result() == {"refreshed": [0, DONE]}
+    assert not scheduler.outstanding
+
+
+def test_leases_are_kept_by_the_owner():
+    # An owner and a worker in one process: the worker's commands carry the client and TTL,
+    # the owner's LeaseKeeper holds the leases and stops the tracks when they run out
+    robot = SimRobot("shm-leases", {"sim": {"speed": None}})
+    owner = SharedMemoryOwner(robot)
+    remote = None
+
+    async def run():
+        nonlocal remote
+        running = True
+
+        async def serve():
+            while running:
+                owner.poll()
+                await asyncio.sleep(0.001)
+        server = asyncio.ensure_future(serve())
+        await asyncio.sleep(0.01)
+        remote = RemoteRobot("shm-leases", {})
+        try:
+            current_client.set("alice")
+            await remote.command("tracks", MOTION, "set_tracks", 40, 0, ttl=0.5)
+            lease = robot.leases.stats()["leases"]["tracks"]
+            assert lease["holder"] == "alice" and lease["ttl"] == 0.5
+            assert await remote.heartbeat("alice") == 1
+            assert await remote.heartbeat("bob") == 0
+        finally:
+            running = False
+            await server
+
+    try:
+        asyncio.run(run())
+        robot.simulator.run_until(robot.simulator.now + 1)
+        robot.scheduler.wait_idle(2)
+        assert robot.powerhorse.tracks["throttle"] == 0
+        assert robot.leases.stats()["expired"] == 1
+    finally:
+        if remote is not None:
+            remote.close()
+        owner.close()
+        robot.close()
@@ -0,0 +1,46 @@
+import json
+import time
+
+from powerhorse_sim import SimRobot, main, run_mission
+
+# The README's mission: drive at an obstacle with a stop rule while the elbow goes to 40 degrees
+MISSION = {
+    "config": {"sensors": {"front": {"type": "ULTRASONIC", "boundary": 30}},
+               "safety": {"rules": [{"sensor": "front", "action": "stop"}]},
+               "sim": {"obstacles": [{"x": 3, "y": 0, "r": 0.3}]}},
+    "duration": 600,
+    "steps": [{"at": 1, "op": "set_tracks", "args": [80, 0]},
+              {"at": 2, "op": "goto", "args": ["elbow", 40]}],
+    "expect": {"model.collisions": [0, 0], "safety.trips": [1, 1], "estimate.joints.elbow": [38, 42]},
+}
+
+
+def test_mission_runs_faster_than_real_time():
+    started = time.perf_counter()
+    report = run_mission(MISSION)
+    wall = time.perf_counter() - started
+    assert report["ok"], report["expect"]
+    assert report["time"] >= 600
+    # ten virtual minutes in a small part of that
+    assert wall < 60
+    assert report["speedup"] > 10
+
+
+def test_mission_with_an_unmet_expectation_fails(tmp_path, capsys):
+    mission = dict(MISSION, duration=5, expect={"model.pose.x": [10, 20]})
+    path = tmp_path / "mission.json"
+    path.write_text(json.dumps(mission))
+    assert main([str(path)]) == 1
+    assert "failed model.pose.x" in capsys.readouterr().err
+
+
+def test_clock_is_paced_by_its_speed():
+    # a simulated robot served by the API, its clock running at ten times real time
+    robot = SimRobot("paced", {"sim": {"speed": 10}})
+    try:
+        time.sleep(0.5)
+        stats = robot.simulator.stats()
+    finally:
+        robot.close()
+    assert 3 < stats["time"] < 6
+    assert stats["speed"] == 10
@@ -0,0 +1,61 @@
+import asyncio
+import threading
+from types import SimpleNamespace
+
+from powerhorse_state import StateSnapshot
+
+
+def snapshot():
+    powerhorse = SimpleNamespace(tracks={"throttle": 0, "differential": 0}, arm={"wrist": 0}, light=False,
+                                 light_brightness=100, light_pattern="solid", camera_angle=0, camera_tilt=0)
+    return powerhorse, StateSnapshot(powerhorse)
+
+
+def test_render_is_cached_per_section():
+    powerhorse, state = snapshot()
+    version, body, etag = state.render("tracks")
+    assert body == b'{"throttle":0,"differential":0}'
+    assert state.render("tracks")[1] is body
+    state.mark_changed("arm")
+    assert state.render("tracks") == (version, body, etag)
+    powerhorse.tracks["throttle"] = 40
+    state.mark_changed("tracks")
+    version2, body2, etag2 = state.render("tracks")
+    assert version2 > version and etag2 != etag
+    assert body2 == b'{"throttle":40,"differential":0}'
+    assert etag2 == 'W/"%s-%d"' % (state.epoch, version2)
+
+
+def test_long_poll_wakes_on_its_section_only():
+    powerhorse, state = snapshot()
+
+    async def run():
+        waiting = asyncio.ensure_future(state.wait_async("tracks", state.versions["tracks"], 2))
+        await asyncio.sleep(0.05)
+        threading.Thread(target=state.mark_changed, args=("light",)).start()
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+        threading.Thread(target=state.mark_changed, args=("tracks",)).start()
+        return await waiting
+
+    assert asyncio.run(run()) is True
+    assert asyncio.run(state.wait_async("arm", state.versions["arm"], 0.05)) is False
+
+
+def test_etag_304(client):
+    response = client.get("/powerhorse/light")
+    etag = response.headers["etag"]
+    assert response.status_code == 200
+    again = client.get("/powerhorse/light", headers={"If-None-Match": etag})
+    assert again.status_code == 304
+    assert again.content == b""
+    assert again.headers["etag"] == etag
+    assert client.get("/powerhorse/light", headers={"If-None-Match": 'W/"other", ' + etag}).status_code == 304
+
+    client.put("/powerhorse/light/on")
+    changed = client.get("/powerhorse/light", headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.json()["light"] is True
+    assert changed.headers["etag"] != etag
+    assert int(changed.headers["x-state-version"]) > int(response.headers["x-state-version"])
+    client.put("/powerhorse/light/off")
@@ -0,0 +1,51 @@
+import time
+
+import numpy as np
+import pytest
+
+from powerhorse_robot import DEFAULT_CONFIG
+from powerhorse_sim import SimPowerHorse
+from powerhorse_trajectory import HEADER, TrackPlan, compile_route
+
+
+def route():
+    return compile_route(np.array([0.0, 0.1, 0.3]), np.array([40.0, 80.0, 80.0]), np.array([0.0, 20.0, 20.0]), 50)
+
+
+def test_plan_round_trip():
+    plan = route()
+    copy = TrackPlan.from_bytes(plan.to_bytes())
+    assert copy.rate == plan.rate
+    # 15 ticks of the route and one stopping the tracks
+    assert copy.ticks == plan.ticks == 16
+    assert copy.frames.tobytes() == plan.frames.tobytes()
+    assert copy.summary() == plan.summary()
+
+
+@pytest.mark.parametrize("rate", [0.0, -50.0, float("nan")])
+def test_plan_with_a_bad_rate_is_refused(rate):
+    data = bytearray(route().to_bytes())
+    magic, version, first, channels, _, ticks = HEADER.unpack_from(data)
+    HEADER.pack_into(data, 0, magic, version, first, channels, rate, ticks)
+    with pytest.raises(ValueError):
+        TrackPlan.from_bytes(bytes(data))
+
+
+def test_truncated_plan_is_refused():
+    with pytest.raises(ValueError):
+        TrackPlan.from_bytes(route().to_bytes()[:-1])
+
+
+def test_route_stops_at_narrowed_limits():
+    powerhorse = SimPowerHorse(DEFAULT_CONFIG)
+    plan = route()
+    powerhorse.play_trajectory(plan)
+    player = powerhorse.trajectory
+    # a safety rule narrows the limits once the route is under way, below its later steps
+    powerhorse.throttle_limits = (-100, 60)
+    while player.playing:
+        time.sleep(0.01)
+    assert player.aborted
+    assert player.tick == plan.ticks
+    assert powerhorse.tracks["throttle"] == 0
+    assert powerhorse.track_duty == (0.0, 0.0)
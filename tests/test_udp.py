@@ -0,0 +1,69 @@
+import asyncio
+
+from powerhorse_sim import SimRobot
+from powerhorse_udp import FRAME, SETPOINT, UdpTeleopClient, pack_frame, start_udp
+
+
+async def received(teleop, count):
+    # Waits until the listener has taken in `count` datagrams and the scheduler has run them
+    while teleop.counters["received"] < count:
+        await asyncio.sleep(0.005)
+    await asyncio.to_thread(teleop.robot.scheduler.wait_idle, 2)
+
+
+def test_setpoints_over_loopback():
+    robot = SimRobot("udp", {"recorder": {"path": None}})
+    powerhorse = robot.powerhorse
+
+    async def run():
+        teleop = await asyncio.wait_for(start_udp(robot, "127.0.0.1", 0, echo_interval=0.05), 2)
+        client = UdpTeleopClient(*teleop.transport.get_extra_info("sockname"))
+        try:
+            client.send(throttle=40, differential=-10, joints=(0, 0, 20, 0), camera=30, light=True)
+            await received(teleop, 1)
+            assert powerhorse.tracks == {"throttle": 40, "differential": -10}
+            assert powerhorse.arm_power[2] == 20
+            assert powerhorse.camera_angle == 30 and powerhorse.light
+
+            # the state is echoed back to the client
+            echo = await asyncio.to_thread(client.receive_state, 2)
+            assert echo["seq"] == 1 and echo["throttle"] == 40
+
+            # a repeated sequence number, an older one and a newer one with an older timestamp
+            # are all dropped
+            first = client.send(throttle=60)
+            sock = client.sock
+            sock.sendto(pack_frame(SETPOINT, first, -50, 0, (0, 0, 0, 0), 0, False), client.address)
+            sock.sendto(pack_frame(SETPOINT, first - 1, -50, 0, (0, 0, 0, 0), 0, False), client.address)
+            sock.sendto(pack_frame(SETPOINT, first + 1, -50, 0, (0, 0, 0, 0), 0, False, timestamp=1), client.address)
+            await received(teleop, 5)
+            assert teleop.counters["stale"] == 3
+            assert powerhorse.tracks["throttle"] == 60
+
+            # datagrams that aren't frames of this version are ignored
+            wrong_version = bytearray(pack_frame(SETPOINT, first + 2, -50, 0, (0, 0, 0, 0), 0, False))
+            wrong_version[2] = 99
+            sock.sendto(b"not a frame", client.address)
+            sock.sendto(b"\x00" * FRAME.size, client.address)
+            sock.sendto(bytes(wrong_version), client.address)
+            await received(teleop, 8)
+            assert teleop.counters["malformed"] == 3
+            assert powerhorse.tracks["throttle"] == 60
+
+            # the client's next frame still goes through, and a stop frame stops everything
+            client.seq = first + 2
+            client.send(throttle=25, joints=(0, 0, 20, 0))
+            await received(teleop, 9)
+            assert powerhorse.tracks["throttle"] == 25
+            client.send(stop=True)
+            await received(teleop, 10)
+            assert powerhorse.tracks["throttle"] == 0 and powerhorse.arm_power[2] == 0
+            assert teleop.counters["applied"] == 4
+        finally:
+            client.close()
+            teleop.transport.close()
+
+    try:
+        asyncio.run(run())
+    finally:
+        robot.close()